@@ -11,33 +11,196 @@ Discord Bot - Пересылка сообщений в Telegram
 
 Структура:
 - ConfigManager: управление конфигурацией
+- TempStorage: временные файлы по сообщениям и фоновая уборка
 - MessageHandler: обработка сообщений и работа с Telegram API
 - ChannelSelect: UI компонент для выбора канала
 - События Discord: on_message, on_message_edit, on_message_delete
-- Слэш-команды: /set, /help, /status
+- Слэш-команды: /set, /help, /status, /perf
 """
 
 import discord
 from discord import app_commands
 import json
 import os
+import atexit
+import contextlib
+import contextvars
 import logging
-from typing import Optional, List
+import queue
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, List, NamedTuple
 import aiohttp
 import asyncio
-from bs4 import BeautifulSoup
-from bs4.element import Tag
+import cProfile
+import functools
+import gzip
+import hashlib
+import io
+import pstats
+import random
 import re
+import shutil
+import signal
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+import tracemalloc
+import uuid
+from collections import deque, OrderedDict
 from discord import ui
 import datetime
 from dotenv import load_dotenv
 
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d] %(message)s'
-)
+# Необязательные ускорители: при отсутствии пакетов бот работает на стандартных asyncio и json.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
+
+LOG_TEXT_FORMAT = '%(asctime)s %(levelname)-8s [%(filename)s:%(lineno)d]%(context)s %(message)s'
+# Одинаковые предупреждения и ошибки: не больше LOG_REPEAT_BURST за LOG_REPEAT_WINDOW_SECONDS.
+LOG_REPEAT_WINDOW_SECONDS = 60
+LOG_REPEAT_BURST = 5
+
+# Поля корреляции (ID исходного сообщения, тип события) для всех записей лога текущей задачи.
+log_context: contextvars.ContextVar = contextvars.ContextVar('log_context', default={})
+
+
+class LogContextFilter(logging.Filter):
+    """Добавляет в запись поля корреляции из log_context"""
+    def filter(self, record: logging.LogRecord) -> bool:
+        if hasattr(record, 'context_fields'):
+            # Итог подавленных повторов: поля уже взяты из исходной записи
+            return True
+        fields = log_context.get()
+        record.context_fields = fields
+        record.context = ''.join(f' [{key}={value}]' for key, value in fields.items())
+        return True
+
+
+class RepeatedLogFilter(logging.Filter):
+    """
+    Ограничивает повторяющиеся предупреждения и ошибки (например, тысячи одинаковых ошибок
+    при недоступном Telegram): в окне пропускается не больше burst одинаковых строк,
+    а по закрытии окна отдельной строкой сообщается, сколько было подавлено
+    """
+    def __init__(self, window: float, burst: int, handler: logging.Handler):
+        super().__init__()
+        self.window = window
+        self.burst = burst
+        self.handler = handler
+        # ключ строки -> [начало окна, число повторов, первая подавленная запись]
+        self._seen: dict = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.burst <= 0:
+            return True
+        message = record.getMessage()
+        key = (record.name, record.levelno, message)
+        now = time.monotonic()
+        with self._lock:
+            state = self._seen.get(key)
+            if state is None or now - state[0] >= self.window:
+                self._seen[key] = [now, 1, None]
+                if len(self._seen) > 1000:
+                    for stale in [k for k, v in self._seen.items() if now - v[0] >= self.window and v[2] is None]:
+                        del self._seen[stale]
+                return True
+            state[1] += 1
+            if state[1] == self.burst + 1:
+                # Первая подавленная строка: итог сообщит таймер в конце окна, даже если повторов больше не будет
+                state[2] = record
+                timer = threading.Timer(state[0] + self.window - now, self._report, (key, state))
+                timer.daemon = True
+                timer.start()
+            return state[1] <= self.burst
+
+    def _report(self, key: tuple, state: list) -> None:
+        with self._lock:
+            suppressed = state[1] - self.burst
+            if self._seen.get(key) is state:
+                del self._seen[key]
+        summary = logging.makeLogRecord(state[2].__dict__)
+        summary.msg = f"{key[2]} (повторилось ещё {suppressed} раз за {self.window:g} с)"
+        summary.args = None
+        summary.exc_info = None
+        summary.exc_text = None
+        summary.created = time.time()
+        self.handler.handle(summary)
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Одна JSON-строка на запись: время, уровень, место в коде, сообщение и поля корреляции"""
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'ts': datetime.datetime.fromtimestamp(record.created, datetime.timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'where': f"{record.filename}:{record.lineno}",
+            'msg': record.getMessage(),
+        }
+        data.update(getattr(record, 'context_fields', None) or {})
+        if record.exc_info:
+            data['exc'] = self.formatException(record.exc_info)
+        return json.dumps(data, ensure_ascii=False, default=str)
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """
+    Кладёт запись в очередь без форматирования: строка собирается уже в потоке QueueListener,
+    поэтому медленный stdout (драйвер логов Docker) не тормозит цикл событий
+    """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+_log_listener: Optional[QueueListener] = None
+
+
+def setup_logging() -> None:
+    """
+    Настраивает логирование через очередь и фоновый поток
+    LOG_LEVEL — уровень (INFO по умолчанию), LOG_FORMAT=json — вывод JSON-строками
+    Повторный вызов (после загрузки .env) перенастраивает вывод
+    """
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+    else:
+        atexit.register(lambda: _log_listener is not None and _log_listener.stop())
+
+    stream_handler = logging.StreamHandler()
+    if (os.getenv('LOG_FORMAT') or 'text').lower() == 'json':
+        stream_handler.setFormatter(JsonLogFormatter())
+    else:
+        stream_handler.setFormatter(logging.Formatter(LOG_TEXT_FORMAT))
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    queue_handler = NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(LogContextFilter())
+    queue_handler.addFilter(RepeatedLogFilter(LOG_REPEAT_WINDOW_SECONDS, LOG_REPEAT_BURST, queue_handler))
+
+    root = logging.getLogger()
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+    root.addHandler(queue_handler)
+    root.setLevel(getattr(logging, (os.getenv('LOG_LEVEL') or 'INFO').upper(), logging.INFO))
+    logging.getLogger('discord').setLevel(logging.WARNING)
+
+    _log_listener = QueueListener(log_queue, stream_handler, respect_handler_level=True)
+    _log_listener.start()
+
+
+setup_logging()
 logger = logging.getLogger(__name__)
-logging.getLogger('discord').setLevel(logging.WARNING)
 
 CONFIG_FILE = 'config.json'
 
@@ -45,160 +208,2092 @@ CONFIG_FILE = 'config.json'
 SOURCE_CHANNEL_ID: Optional[int] = None
 CHANNELS: dict[str, int] = {}
 TRSH_DIR = 'trsh'
+# Каталог для локального состояния бота (хеш слеш-команд и т.п.).
+DATA_DIR = 'data'
+COMMAND_HASH_FILE = 'commands.sha256'
+# Пауза перед повтором неудавшейся синхронизации слеш-команд (удваивается до максимума).
+COMMAND_SYNC_RETRY_SECONDS = 30
+COMMAND_SYNC_RETRY_MAX_SECONDS = 1800
+STATE_FILE = 'state.db'
+# Таймауты Telegram API (сек) и автомат-предохранитель.
+TELEGRAM_CONNECT_TIMEOUT = 10
+TELEGRAM_READ_TIMEOUT = 60
+BREAKER_FAILURE_THRESHOLD = 5
+BREAKER_RESET_SECONDS = 30
+# Планировщик Telegram: обработчики лёгких операций, параллельные загрузки медиа, темп запросов.
+TELEGRAM_WORKERS = 4
+TELEGRAM_MEDIA_CONCURRENCY = 1
+TELEGRAM_RATE_PER_SECOND = 25
+STATE_FLUSH_INTERVAL_SECONDS = 1
+# Сколько последних записей маппинга загружать в память при запуске.
+MAPPING_CACHE_SIZE = 5000
+# Сколько ID недавно пересланных сообщений помнить для защиты от повторных событий.
+DEDUP_CAPACITY = 10000
+# Догонялка после простоя: максимум сообщений, размер пачки и параллельность подготовки.
+BACKFILL_LIMIT = 500
+BACKFILL_BATCH_SIZE = 10
+BACKFILL_CONCURRENCY = 4
+# Сколько последних пересланных сообщений сверять на правки и удаления.
+BACKFILL_SYNC_LIMIT = 200
+# Файлы в trsh/ старше этого возраста (сек) удаляет фоновая уборка.
+TEMP_MAX_AGE_SECONDS = 3600
+# Предел размера trsh/ (МБ): при превышении удаляются самые старые неактивные каталоги.
+TEMP_QUOTA_MB = 512
+TEMP_JANITOR_INTERVAL_SECONDS = 300
+# Профилирование по команде /perf: длительность по умолчанию и верхняя граница, сколько строк в отчёте
+PERF_DEFAULT_SECONDS = 15
+PERF_MAX_SECONDS = 120
+PERF_TOP_ENTRIES = 40
+# Сторож цикла событий: порог задержки, после которого снимается стек, и период сводки
+LOOP_BLOCK_THRESHOLD_MS = 200
+LOOP_WATCHDOG_REPORT_SECONDS = 600
+# Несколько реплик: single — одна реплика без координации, standby — активная и горячий резерв,
+# partition — сообщения делятся между репликами по ID (message.id % REPLICA_PARTITIONS)
+REPLICA_MODE = 'single'
+REPLICA_PARTITIONS = 2
+LEASE_TTL_SECONDS = 15
+# Сколько секунд при остановке ждать текущие пересылки; незавершённое сохраняется до следующего запуска
+SHUTDOWN_TIMEOUT = 20
+# Спаны пересылки: трасса сохраняется целиком, если операция шла дольше SPANS_SLOW_MS или
+# завершилась ошибкой; остальные — в SPANS_SAMPLE_PERCENT процентах случаев
+SPANS_SLOW_MS = 2000
+SPANS_SAMPLE_PERCENT = 1
+
+
+def _parse_int_env(name: str) -> Optional[int]:
+    raw = os.getenv(name)
+    if raw is None or raw == "":
+        return None
+    try:
+        return int(raw)
+    except ValueError:
+        logger.error("Некорректное значение переменной окружения %s: %r (ожидается число)", name, raw)
+        return None
+
+
+def _load_channels_from_env() -> Optional[dict]:
+    """
+    CHANNELS_JSON should be a JSON object: {"новости": 123, "ивент-события": 456}
+    """
+    raw = os.getenv("CHANNELS_JSON")
+    if raw is None or raw.strip() == "":
+        return None
+    try:
+        parsed = json.loads(raw)
+    except json.JSONDecodeError as e:
+        logger.error("Некорректный JSON в CHANNELS_JSON: %s", e)
+        return None
+    if not isinstance(parsed, dict):
+        logger.error("CHANNELS_JSON должен быть JSON-объектом (словарём) name->id")
+        return None
+
+    result: dict[str, int] = {}
+    for k, v in parsed.items():
+        if not isinstance(k, str) or not k.strip():
+            logger.error("CHANNELS_JSON содержит пустой/некорректный ключ канала")
+            return None
+        try:
+            channel_id = int(v)
+        except (TypeError, ValueError):
+            logger.error("CHANNELS_JSON: id канала для %r должен быть числом, получено: %r", k, v)
+            return None
+        result[k.strip().lower()] = channel_id
+
+    if not result:
+        logger.error("CHANNELS_JSON пустой — нужен хотя бы один канал")
+        return None
+    return result
+
+
+def _env_int(name: str, default: int) -> int:
+    value = _parse_int_env(name)
+    return default if value is None else value
+
+
+class TelegramTarget(NamedTuple):
+    """Чат Telegram для пересылки и, для форумов, ID темы"""
+    chat_id: str
+    thread_id: Optional[int] = None
+
+    @property
+    def key(self) -> str:
+        return f"{self.chat_id}:{self.thread_id}" if self.thread_id else self.chat_id
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_telegram_targets(raw: str) -> tuple:
+    """
+    TELEGRAM_GROUP_ID: один или несколько чатов через запятую, для темы форума — chat_id:thread_id
+    Пример: -1001234567890,-1009876543210:42
+    """
+    targets = []
+    for part in raw.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        chat_id, _, thread = part.partition(':')
+        thread_id = None
+        if thread:
+            try:
+                thread_id = int(thread)
+            except ValueError:
+                logger.error("TELEGRAM_GROUP_ID: ID темы должен быть числом, получено: %r", part)
+                continue
+        targets.append(TelegramTarget(chat_id.strip(), thread_id))
+    return tuple(targets)
+
+
+def telegram_targets() -> tuple:
+    return _parse_telegram_targets(os.getenv('TELEGRAM_GROUP_ID') or '')
+
+
+def telegram_chat_id_from_key(key: str) -> str:
+    return key.partition(':')[0]
+
+
+def init_runtime_config() -> None:
+    global SOURCE_CHANNEL_ID, CHANNELS, CONFIG_FILE, DATA_DIR
+    global TEMP_MAX_AGE_SECONDS, TEMP_QUOTA_MB, TEMP_JANITOR_INTERVAL_SECONDS
+    global TELEGRAM_CONNECT_TIMEOUT, TELEGRAM_READ_TIMEOUT, BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS
+    global TELEGRAM_WORKERS, TELEGRAM_MEDIA_CONCURRENCY, TELEGRAM_RATE_PER_SECOND
+    global MAPPING_CACHE_SIZE, DEDUP_CAPACITY, BACKFILL_LIMIT, BACKFILL_BATCH_SIZE, BACKFILL_CONCURRENCY, BACKFILL_SYNC_LIMIT
+    global LOOP_BLOCK_THRESHOLD_MS, LOOP_WATCHDOG_REPORT_SECONDS
+    global REPLICA_MODE, REPLICA_PARTITIONS, LEASE_TTL_SECONDS, SHUTDOWN_TIMEOUT
+    global SPANS_SLOW_MS, SPANS_SAMPLE_PERCENT
+
+    cfg_file = os.getenv('CONFIG_FILE')
+    if cfg_file:
+        CONFIG_FILE = cfg_file
+    DATA_DIR = os.getenv('DATA_DIR') or DATA_DIR
+
+    # Load from config file (optional) first, then let env override.
+    if os.path.exists(CONFIG_FILE):
+        try:
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                if SOURCE_CHANNEL_ID is None:
+                    src = data.get("source_channel_id")
+                    if src is not None:
+                        try:
+                            SOURCE_CHANNEL_ID = int(src)
+                        except (TypeError, ValueError):
+                            logger.error("config: source_channel_id должен быть числом, получено: %r", src)
+                if not CHANNELS:
+                    ch = data.get("channels")
+                    if ch is not None:
+                        if isinstance(ch, dict):
+                            parsed: dict[str, int] = {}
+                            for k, v in ch.items():
+                                if not isinstance(k, str) or not k.strip():
+                                    logger.error("config: channels содержит пустой/некорректный ключ")
+                                    parsed = {}
+                                    break
+                                try:
+                                    parsed[k.strip().lower()] = int(v)
+                                except (TypeError, ValueError):
+                                    logger.error("config: channels[%r] должен быть числом, получено: %r", k, v)
+                                    parsed = {}
+                                    break
+                            if parsed:
+                                CHANNELS = parsed
+                        else:
+                            logger.error("config: channels должен быть объектом (словарём) name->id")
+        except json.JSONDecodeError as e:
+            logger.error("Ошибка чтения %s: %s", CONFIG_FILE, e)
+        except Exception as e:
+            logger.error("Ошибка загрузки %s: %s", CONFIG_FILE, e)
+
+    source_id = _parse_int_env("SOURCE_CHANNEL_ID")
+    if source_id is not None:
+        SOURCE_CHANNEL_ID = source_id
+
+    channels = _load_channels_from_env()
+    if channels is not None:
+        CHANNELS = channels
+
+    TEMP_MAX_AGE_SECONDS = _env_int("TEMP_MAX_AGE_SECONDS", TEMP_MAX_AGE_SECONDS)
+    TEMP_QUOTA_MB = _env_int("TEMP_QUOTA_MB", TEMP_QUOTA_MB)
+    TEMP_JANITOR_INTERVAL_SECONDS = _env_int("TEMP_JANITOR_INTERVAL_SECONDS", TEMP_JANITOR_INTERVAL_SECONDS)
+    TELEGRAM_CONNECT_TIMEOUT = _env_int("TELEGRAM_CONNECT_TIMEOUT", TELEGRAM_CONNECT_TIMEOUT)
+    TELEGRAM_READ_TIMEOUT = _env_int("TELEGRAM_READ_TIMEOUT", TELEGRAM_READ_TIMEOUT)
+    BREAKER_FAILURE_THRESHOLD = max(1, _env_int("BREAKER_FAILURE_THRESHOLD", BREAKER_FAILURE_THRESHOLD))
+    BREAKER_RESET_SECONDS = _env_int("BREAKER_RESET_SECONDS", BREAKER_RESET_SECONDS)
+    TELEGRAM_WORKERS = _env_int("TELEGRAM_WORKERS", TELEGRAM_WORKERS)
+    TELEGRAM_MEDIA_CONCURRENCY = _env_int("TELEGRAM_MEDIA_CONCURRENCY", TELEGRAM_MEDIA_CONCURRENCY)
+    TELEGRAM_RATE_PER_SECOND = _env_int("TELEGRAM_RATE_PER_SECOND", TELEGRAM_RATE_PER_SECOND)
+    MAPPING_CACHE_SIZE = _env_int("MAPPING_CACHE_SIZE", MAPPING_CACHE_SIZE)
+    DEDUP_CAPACITY = max(1, _env_int("DEDUP_CAPACITY", DEDUP_CAPACITY))
+    BACKFILL_LIMIT = _env_int("BACKFILL_LIMIT", BACKFILL_LIMIT)
+    BACKFILL_BATCH_SIZE = max(1, _env_int("BACKFILL_BATCH_SIZE", BACKFILL_BATCH_SIZE))
+    BACKFILL_CONCURRENCY = max(1, _env_int("BACKFILL_CONCURRENCY", BACKFILL_CONCURRENCY))
+    BACKFILL_SYNC_LIMIT = _env_int("BACKFILL_SYNC_LIMIT", BACKFILL_SYNC_LIMIT)
+    LOOP_BLOCK_THRESHOLD_MS = _env_int("LOOP_BLOCK_THRESHOLD_MS", LOOP_BLOCK_THRESHOLD_MS)
+    LOOP_WATCHDOG_REPORT_SECONDS = max(1, _env_int("LOOP_WATCHDOG_REPORT_SECONDS", LOOP_WATCHDOG_REPORT_SECONDS))
+    REPLICA_MODE = (os.getenv('REPLICA_MODE') or REPLICA_MODE).strip().lower()
+    REPLICA_PARTITIONS = max(1, _env_int("REPLICA_PARTITIONS", REPLICA_PARTITIONS))
+    LEASE_TTL_SECONDS = max(3, _env_int("LEASE_TTL_SECONDS", LEASE_TTL_SECONDS))
+    SHUTDOWN_TIMEOUT = max(0, _env_int("SHUTDOWN_TIMEOUT", SHUTDOWN_TIMEOUT))
+    SPANS_SLOW_MS = max(0, _env_int("SPANS_SLOW_MS", SPANS_SLOW_MS))
+    SPANS_SAMPLE_PERCENT = min(100, max(0, _env_int("SPANS_SAMPLE_PERCENT", SPANS_SAMPLE_PERCENT)))
+
+
+def validate_runtime_config() -> bool:
+    ok = True
+    if SOURCE_CHANNEL_ID is None:
+        logger.error("SOURCE_CHANNEL_ID не задан. Укажите его в .env / переменных окружения.")
+        ok = False
+    if not CHANNELS:
+        logger.error("CHANNELS_JSON не задан или пуст. Укажите словарь каналов в .env / переменных окружения.")
+        ok = False
+    if REPLICA_MODE not in ('single', 'standby', 'partition'):
+        logger.error("REPLICA_MODE должен быть single, standby или partition, получено: %r", REPLICA_MODE)
+        ok = False
+    return ok
+
+intents = discord.Intents.default()
+intents.messages = True
+intents.message_content = True
+bot = discord.Client(intents=intents)
+
+
+class ReplicaCommandTree(app_commands.CommandTree):
+    """Команду получают все реплики, отвечает только та, которой принадлежит ID взаимодействия"""
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        return replica.owns(interaction.id)
+
+    async def on_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError) -> None:
+        if isinstance(error, app_commands.CheckFailure) and not replica.owns(interaction.id):
+            return
+        await super().on_error(interaction, error)
+
+
+tree = ReplicaCommandTree(bot)
+
+message_mapping = {}
+start_time = None
+background_tasks: dict[str, asyncio.Task] = {}
+# Обработчики событий, которые ещё выполняются: при остановке их дожидаемся
+handler_tasks: set[asyncio.Task] = set()
+shutting_down = False
+
+"""
+Управление конфигурацией бота
+Хранение и загрузка ID целевого канала для пересылки сообщений
+"""
+class ConfigManager:
+    # (путь, mtime, значение): файл перечитывается только после изменения, а не на каждое событие
+    _cache: Optional[tuple] = None
+
+    @staticmethod
+    def load_target_channel() -> Optional[int]:
+        try:
+            mtime = os.stat(CONFIG_FILE).st_mtime_ns
+        except OSError:
+            mtime = None
+        cache = ConfigManager._cache
+        if mtime is not None and cache is not None and cache[:2] == (CONFIG_FILE, mtime):
+            return cache[2]
+        if mtime is None:
+            try:
+                with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+                    json.dump({'target_channel_id': None}, f, indent=2)
+            except Exception as e:
+                logger.warning("Не удалось создать файл конфигурации: %s", e)
+            return None
+        try:
+            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            value = data.get('target_channel_id')
+            ConfigManager._cache = (CONFIG_FILE, mtime, value)
+            return value
+        except json.JSONDecodeError as e:
+            logger.error("Ошибка чтения конфигурации: %s", e)
+            return None
+        except Exception as e:
+            logger.error("Ошибка при загрузке конфигурации: %s", e)
+            return None
+
+    @staticmethod
+    def save_target_channel(channel_id: int) -> bool:
+        try:
+            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
+                json.dump({'target_channel_id': channel_id}, f, indent=2)
+            return True
+        except Exception as e:
+            logger.error("Ошибка сохранения конфигурации: %s", e)
+            return False
+
+"""
+Временные файлы для пересылки
+Каждое сообщение получает собственный каталог в trsh/, поэтому одинаковые имена вложений
+из параллельных сообщений не перезаписывают друг друга. Каталог удаляется при выходе
+из контекстного менеджера, а забытые каталоги подчищает фоновая уборка с квотой.
+Реплики с общим trsh/ пишут каждая в свой подкаталог и убирают только его; подкаталоги
+остановленных реплик удаляются, когда их аренда истекла, а файлы старше TEMP_MAX_AGE_SECONDS.
+"""
+class TempScope:
+    def __init__(self, storage: 'TempStorage', directory: str):
+        self.storage = storage
+        self.directory = directory
+        self._detached = False
+
+    def path(self, filename: str) -> str:
+        """Возвращает свободный путь внутри каталога сообщения"""
+        name = os.path.basename(filename or '') or 'file'
+        base, ext = os.path.splitext(name)
+        candidate = os.path.join(self.directory, name)
+        counter = 1
+        while os.path.exists(candidate):
+            candidate = os.path.join(self.directory, f"{base}_{counter}{ext}")
+            counter += 1
+        return candidate
+
+    def detach(self) -> 'TempScope':
+        """Передаёт владение каталогом дальше: выход из with больше не удаляет файлы"""
+        self._detached = True
+        return self
+
+    def close(self) -> None:
+        shutil.rmtree(self.directory, ignore_errors=True)
+        self.storage._active.discard(self.directory)
+
+    def release(self) -> None:
+        """Удаляет каталог, если владение не передано через detach()"""
+        if not self._detached:
+            self.close()
+
+    def __enter__(self) -> 'TempScope':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self.release()
+
+
+class TempStorage:
+    def __init__(self, root: str):
+        self.root = root
+        # Общий trsh/ нескольких реплик, если каталоги этого процесса вынесены в подкаталог
+        self.shared: Optional[str] = None
+        self._active: set[str] = set()
+
+    def isolate(self, name: str) -> None:
+        """Переносит каталоги этого процесса в подкаталог name (ID реплики) общего trsh/"""
+        self.shared = self.root
+        self.root = os.path.join(self.shared, name)
+
+    def scope(self, tag) -> TempScope:
+        """Создаёт уникальный каталог для одного сообщения"""
+        directory = os.path.join(self.root, f"{tag}-{uuid.uuid4().hex[:8]}")
+        os.makedirs(directory, exist_ok=True)
+        self._active.add(directory)
+        return TempScope(self, directory)
+
+    def _entries(self) -> List[tuple]:
+        """Список (путь, mtime, размер) для содержимого корня trsh/"""
+        entries = []
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            path = os.path.join(self.root, name)
+            try:
+                if os.path.isdir(path):
+                    size = 0
+                    for dirpath, _, filenames in os.walk(path):
+                        for filename in filenames:
+                            try:
+                                size += os.path.getsize(os.path.join(dirpath, filename))
+                            except OSError:
+                                pass
+                else:
+                    size = os.path.getsize(path)
+                entries.append((path, os.path.getmtime(path), size))
+            except OSError:
+                continue
+        return entries
+
+    def usage(self) -> tuple:
+        """Возвращает (количество файлов, размер в байтах) в trsh/"""
+        files = 0
+        total = 0
+        for dirpath, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                try:
+                    total += os.path.getsize(os.path.join(dirpath, filename))
+                    files += 1
+                except OSError:
+                    pass
+        return files, total
+
+    def cleanup(self, max_age: float, quota_bytes: int) -> int:
+        """
+        Удаляет неактивные каталоги старше max_age, затем самые старые,
+        пока размер trsh/ не уложится в квоту. Возвращает число удалённых записей.
+        """
+        now = time.time()
+        removed = 0
+        remaining = []
+        for path, mtime, size in sorted(self._entries(), key=lambda entry: entry[1]):
+            if path in self._active:
+                remaining.append((path, size, False))
+                continue
+            if now - mtime > max_age:
+                self._remove(path)
+                removed += 1
+            else:
+                remaining.append((path, size, True))
+        total = sum(size for _, size, _ in remaining)
+        for path, size, removable in remaining:
+            if total <= quota_bytes:
+                break
+            if removable:
+                self._remove(path)
+                total -= size
+                removed += 1
+        return removed
+
+    def cleanup_orphans(self, max_age: float, live: set) -> int:
+        """
+        Удаляет подкаталоги реплик, которых нет среди live и которые не менялись дольше max_age
+        Возвращает число удалённых подкаталогов
+        """
+        if self.shared is None:
+            return 0
+        now = time.time()
+        removed = 0
+        try:
+            names = os.listdir(self.shared)
+        except FileNotFoundError:
+            return 0
+        for name in names:
+            path = os.path.join(self.shared, name)
+            if path == self.root or name in live or not os.path.isdir(path):
+                continue
+            try:
+                # Каталог реплики меняется при каждом новом сообщении, поэтому смотрим на самый свежий файл
+                mtime = max(
+                    [os.path.getmtime(path)]
+                    + [os.path.getmtime(os.path.join(path, entry)) for entry in os.listdir(path)]
+                )
+            except OSError:
+                continue
+            if now - mtime > max_age:
+                self._remove(path)
+                removed += 1
+        return removed
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        except OSError as e:
+            logger.warning("Не удалось удалить временный файл %s: %s", path, e)
+
+    async def janitor(self) -> None:
+        """Фоновая уборка trsh/ по возрасту и квоте"""
+        while True:
+            try:
+                await asyncio.sleep(TEMP_JANITOR_INTERVAL_SECONDS)
+                removed = await asyncio.to_thread(
+                    self.cleanup, TEMP_MAX_AGE_SECONDS, TEMP_QUOTA_MB * 1024 * 1024
+                )
+                if self.shared is not None:
+                    live = await asyncio.to_thread(state_store.lease_holders, 'replica:')
+                    removed += await asyncio.to_thread(self.cleanup_orphans, TEMP_MAX_AGE_SECONDS, live)
+                if removed:
+                    files, total = await asyncio.to_thread(self.usage)
+                    logger.info("Уборка trsh/: удалено %s, осталось %s файлов (%.1f МБ)", removed, files, total / 1024 / 1024)
+            except Exception as e:
+                logger.error("Ошибка в фоновой уборке временных файлов: %s", e, exc_info=True)
+
+
+temp_storage = TempStorage(TRSH_DIR)
+
+
+def json_dumps(data) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+def json_loads(raw: bytes):
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
+class TelegramUnavailable(Exception):
+    """Telegram недоступен: цепь разомкнута или запрос не дошёл до API"""
+
+
+class CircuitBreaker:
+    """
+    Автомат закрыт -> разомкнут -> полуоткрыт
+    После failure_threshold ошибок подряд запросы не выполняются reset_timeout секунд,
+    затем пропускается одна пробная попытка: успех закрывает цепь, ошибка снова размыкает
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._probe_started = 0.0
+
+    def allow(self) -> bool:
+        if self.state == self.CLOSED:
+            return True
+        now = time.monotonic()
+        if self.state == self.OPEN and now - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+        # Пробная попытка, которая так и не отчиталась, не должна блокировать цепь навсегда
+        probe_stuck = self._probe_in_flight and now - self._probe_started >= self.reset_timeout
+        if self.state == self.HALF_OPEN and (not self._probe_in_flight or probe_stuck):
+            self._probe_in_flight = True
+            self._probe_started = now
+            return True
+        return False
+
+    def record_success(self) -> None:
+        if self.state != self.CLOSED:
+            logger.info("Telegram снова доступен, цепь замкнута")
+        self.state = self.CLOSED
+        self.failures = 0
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self.failures += 1
+        self._probe_in_flight = False
+        if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != self.OPEN:
+                logger.warning("Telegram недоступен, цепь разомкнута на %s с", self.reset_timeout)
+            self.state = self.OPEN
+            self.opened_at = time.monotonic()
+
+"""
+Клиент Telegram Bot API
+Одна сессия aiohttp на весь процесс (пул соединений с api.telegram.org),
+сериализация запросов и разбор ответов через orjson, если он установлен.
+Явные таймауты и автомат-предохранитель не дают зависшему API держать задачи по 5 минут.
+"""
+class TelegramClient:
+    MAX_RATE_LIMIT_RETRIES = 3
+
+    def __init__(self, api_url: str = "https://api.telegram.org"):
+        # Адрес Bot API; воспроизведение трассы подставляет сюда локальный сервер
+        self.api_url = api_url
+        self._session: Optional[aiohttp.ClientSession] = None
+        self.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            timeout = aiohttp.ClientTimeout(
+                total=None,
+                connect=TELEGRAM_CONNECT_TIMEOUT,
+                sock_read=TELEGRAM_READ_TIMEOUT
+            )
+            self._session = aiohttp.ClientSession(timeout=timeout)
+        return self._session
+
+    async def request(
+        self,
+        token: str,
+        method: str,
+        payload: Optional[dict] = None,
+        form: Optional[aiohttp.FormData] = None
+    ) -> tuple:
+        """
+        Вызывает метод Bot API: JSON-телом или multipart-формой (для файлов)
+        При 429 выжидает retry_after, который сообщил Telegram
+        Возвращает (HTTP статус, разобранный ответ); нераспознанный ответ — пустой словарь
+        Бросает TelegramUnavailable, если цепь разомкнута, API не отвечает или отвечает 5xx
+        Каждая попытка — отдельный спан telegram.request с методом, статусом и размерами
+        """
+        url = f"{self.api_url}/bot{token}/{method}"
+        if form is not None:
+            kwargs = {'data': form}
+            request_bytes = None
+        else:
+            kwargs = {
+                'data': json_dumps(payload or {}),
+                'headers': {'Content-Type': 'application/json'}
+            }
+            request_bytes = len(kwargs['data'])
+        attempt = 0
+        while True:
+            with span_tracer.span('telegram.request', method=method, attempt=attempt + 1) as span:
+                if request_bytes is not None:
+                    span.set(request_bytes=request_bytes)
+                if not self.breaker.allow():
+                    raise TelegramUnavailable(f"цепь разомкнута, {method} отложен")
+                try:
+                    async with self._get_session().post(url, **kwargs) as resp:
+                        raw = await resp.read()
+                        try:
+                            result = json_loads(raw)
+                        except ValueError:
+                            result = {}
+                        status = resp.status
+                except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                    self.breaker.record_failure()
+                    raise TelegramUnavailable(f"{method}: {e!r}") from e
+                span.set(status=status, response_bytes=len(raw))
+                if status >= 500:
+                    self.breaker.record_failure()
+                    raise TelegramUnavailable(f"{method}: статус {status}")
+                self.breaker.record_success()
+                if not isinstance(result, dict):
+                    result = {}
+                # 429: ждём retry_after и повторяем; multipart-форму aiohttp повторно не отправляет,
+                # её повторяет вызывающий, собрав заново
+                retry_after = (result.get('parameters') or {}).get('retry_after')
+                if retry_after:
+                    span.set(retry_after=retry_after)
+            if status != 429 or form is not None or not retry_after or attempt >= self.MAX_RATE_LIMIT_RETRIES:
+                return status, result
+            attempt += 1
+            logger.warning("Telegram rate limit на %s, повтор через %s с", method, retry_after)
+            await asyncio.sleep(retry_after)
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+
+telegram_client = TelegramClient()
+
+
+class TelegramJob:
+    """
+    Операция Telegram для планировщика: фабрика корутины, полоса приоритета
+    и необязательная очистка после выполнения
+    """
+    LANE_DELETE = 0
+    LANE_EDIT = 1
+    LANE_TEXT = 2
+    LANE_MEDIA = 3
+
+    def __init__(self, name: str, factory, lane: int = LANE_TEXT, cleanup=None, spec: Optional[dict] = None):
+        self.name = name
+        self.factory = factory
+        self.lane = lane
+        self.cleanup = cleanup
+        # Описание операции в JSON, чтобы повторить её после перезапуска, если она не успела выполниться
+        self.spec = spec
+        self.seq = 0
+        self.future: Optional[asyncio.Future] = None
+        self.enqueued_at = 0.0
+        # Поля корреляции логов и родительский спан берутся из задачи, которая создала операцию
+        self.log_fields = log_context.get()
+        self.span = current_span.get()
+
+    def finish(self) -> None:
+        if self.cleanup is not None:
+            try:
+                self.cleanup()
+            except Exception as e:
+                logger.warning("Ошибка очистки после задачи Telegram «%s»: %s", self.name, e)
+
+    def resolve(self, result) -> None:
+        if self.future is not None and not self.future.done():
+            self.future.set_result(result)
+
+    def fail(self, error: BaseException) -> None:
+        if self.future is not None and not self.future.done():
+            self.future.set_exception(error)
+
+"""
+Планировщик операций Telegram
+Задачи идут по полосам приоритета: удаление > правка > текст > загрузка медиа.
+Тяжёлые загрузки выполняются вне общих обработчиков и ограничены отдельным лимитом,
+поэтому удаление и правки не ждут, пока уйдёт 40-мегабайтное видео.
+Общий темп запросов ограничен TELEGRAM_RATE_PER_SECOND, и бюджет достаётся задачам
+в порядке приоритета.
+Пока Telegram недоступен, задачи паркуются, а пересылка в Discord идёт без ожидания.
+Фоновый разборщик пробует первую отложенную задачу (она же пробный запрос полуоткрытой цепи)
+и при успехе возвращает остальные в очередь с исходным порядком.
+"""
+class TelegramScheduler:
+    PARKED = object()
+
+    def __init__(self, client: TelegramClient):
+        self.client = client
+        self.queue: asyncio.PriorityQueue = asyncio.PriorityQueue()
+        self.parked: deque = deque()
+        self.media_in_flight = 0
+        self.running: set = set()
+        self._media_semaphore: Optional[asyncio.Semaphore] = None
+        self._media_tasks: set = set()
+        self._seq = 0
+        self._next_slot = 0.0
+        self._pace_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+
+    def pending(self) -> int:
+        return self.queue.qsize() + self.media_in_flight
+
+    def _park(self, job: TelegramJob) -> None:
+        self.parked.append(job)
+        self._wakeup.set()
+        job.resolve(self.PARKED)
+        logger.info("Telegram недоступен, задача «%s» отложена (в очереди: %d)", job.name, len(self.parked))
+
+    def enqueue(self, job: TelegramJob) -> asyncio.Future:
+        loop = asyncio.get_running_loop()
+        job.future = loop.create_future()
+        self._seq += 1
+        job.seq = self._seq
+        job.enqueued_at = time.monotonic()
+        # Пока отложенные задачи не разобраны, новые встают за ними, чтобы не нарушать порядок
+        if self.parked:
+            self._park(job)
+        else:
+            self.queue.put_nowait((job.lane, job.seq, job))
+        return job.future
+
+    async def submit(self, job: TelegramJob):
+        """
+        Ставит задачу в очередь и ждёт её выполнения
+        Возвращает результат задачи либо PARKED, если Telegram недоступен и задача отложена
+        """
+        return await self.enqueue(job)
+
+    async def _pace(self) -> None:
+        """Не чаще TELEGRAM_RATE_PER_SECOND запусков задач в секунду"""
+        if TELEGRAM_RATE_PER_SECOND <= 0:
+            return
+        async with self._pace_lock:
+            now = time.monotonic()
+            delay = self._next_slot - now
+            self._next_slot = max(now, self._next_slot) + 1 / TELEGRAM_RATE_PER_SECOND
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    async def _execute(self, job: TelegramJob) -> None:
+        token = log_context.set(job.log_fields)
+        span_token = current_span.set(job.span)
+        try:
+            with span_tracer.span(
+                'telegram.job',
+                job=job.name,
+                lane=job.lane,
+                queue_ms=round((time.monotonic() - job.enqueued_at) * 1000, 1)
+            ):
+                result = await job.factory()
+        except TelegramUnavailable:
+            self._park(job)
+            return
+        except Exception as e:
+            job.finish()
+            job.fail(e)
+            return
+        finally:
+            self.running.discard(job)
+            current_span.reset(span_token)
+            log_context.reset(token)
+        job.finish()
+        job.resolve(result)
+
+    async def _run_media(self, job: TelegramJob) -> None:
+        try:
+            async with self._media_semaphore:
+                await self._pace()
+                await self._execute(job)
+        finally:
+            self.media_in_flight -= 1
+
+    async def _worker(self) -> None:
+        while True:
+            _, _, job = await self.queue.get()
+            # Взятые из очереди задачи (включая медиа, ждущие своего лимита) считаются выполняемыми
+            self.running.add(job)
+            try:
+                if job.lane == TelegramJob.LANE_MEDIA:
+                    # Загрузка идёт отдельной задачей: обработчик сразу берёт следующую лёгкую операцию
+                    self.media_in_flight += 1
+                    task = asyncio.create_task(self._run_media(job))
+                    self._media_tasks.add(task)
+                    task.add_done_callback(self._media_tasks.discard)
+                else:
+                    await self._pace()
+                    await self._execute(job)
+            except Exception as e:
+                logger.error("Ошибка задачи Telegram «%s»: %s", job.name, e, exc_info=True)
+            finally:
+                self.queue.task_done()
+
+    async def _drain_parked(self) -> None:
+        """Фоновый разбор отложенных задач"""
+        while True:
+            try:
+                if not self.parked:
+                    self._wakeup.clear()
+                    await self._wakeup.wait()
+                    continue
+                job = self.parked[0]
+                token = log_context.set(job.log_fields)
+                span_token = current_span.set(job.span)
+                try:
+                    with span_tracer.span('telegram.job', job=job.name, lane=job.lane, parked=True):
+                        await job.factory()
+                except TelegramUnavailable:
+                    await asyncio.sleep(1)
+                    continue
+                except Exception as e:
+                    logger.error("Ошибка отложенной задачи Telegram «%s»: %s", job.name, e, exc_info=True)
+                finally:
+                    current_span.reset(span_token)
+                    log_context.reset(token)
+                self.parked.popleft()
+                job.finish()
+                # Telegram снова отвечает: остальное возвращаем в очередь с исходными номерами
+                while self.parked:
+                    parked_job = self.parked.popleft()
+                    self.queue.put_nowait((parked_job.lane, parked_job.seq, parked_job))
+                logger.info("Отложенные задачи Telegram возвращены в очередь")
+            except Exception as e:
+                logger.error("Ошибка разбора отложенных задач Telegram: %s", e, exc_info=True)
+
+    def idle(self) -> bool:
+        """Нет задач в очереди и в работе (отложенные из-за недоступности Telegram не считаются)"""
+        return self.queue.empty() and not self.running and not self.media_in_flight
+
+    def take_unfinished(self) -> List[TelegramJob]:
+        """Снимает все невыполненные задачи (в работе, в очереди, отложенные) в исходном порядке"""
+        jobs = list(self.running)
+        while not self.queue.empty():
+            jobs.append(self.queue.get_nowait()[2])
+            self.queue.task_done()
+        jobs.extend(job for job in self.parked if job not in jobs)
+        self.parked.clear()
+        for task in self._media_tasks:
+            task.cancel()
+        return sorted(jobs, key=lambda job: job.seq)
+
+    async def run(self) -> None:
+        """Запускает обработчики очереди и разбор отложенных задач"""
+        self._media_semaphore = asyncio.Semaphore(max(1, TELEGRAM_MEDIA_CONCURRENCY))
+        workers = [asyncio.create_task(self._worker()) for _ in range(max(1, TELEGRAM_WORKERS))]
+        workers.append(asyncio.create_task(self._drain_parked()))
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+
+telegram_scheduler = TelegramScheduler(telegram_client)
+
+"""
+Постоянное состояние бота
+SQLite-файл в DATA_DIR: маппинг пересланных сообщений и служебные значения
+(например, ID последнего пересланного сообщения). Изменения копятся в памяти
+и пишутся одной транзакцией в фоновом потоке, чтобы не блокировать цикл событий.
+Незавершённая при остановке работа пишется сразу, по строке на операцию: её делят реплики.
+"""
+class StateStore:
+    LAST_SOURCE_ID = 'last_source_id'
+
+    def __init__(self):
+        self.path: Optional[str] = None
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._pending_mapping: dict[int, Optional[bytes]] = {}
+        self._pending_values: dict[str, str] = {}
+        self._pending_processed: List[int] = []
+        self._values: dict[str, str] = {}
+        self.processed_limit = 10000
+
+    def open(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            # Базу могут писать несколько реплик: ждём чужую запись, а не падаем с database is locked
+            self._conn.execute('PRAGMA busy_timeout=5000')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS mapping (source_id INTEGER PRIMARY KEY, data BLOB NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS processed (source_id INTEGER PRIMARY KEY)')
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS lease (name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires REAL NOT NULL)'
+            )
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS unfinished '
+                '(id INTEGER PRIMARY KEY AUTOINCREMENT, source_id INTEGER NOT NULL, spec TEXT NOT NULL)'
+            )
+            self._values = dict(self._conn.execute('SELECT key, value FROM kv').fetchall())
+
+    def load_mapping(self, limit: int) -> dict:
+        """Загружает последние limit записей маппинга (по ID исходного сообщения)"""
+        if self._conn is None:
+            return {}
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT source_id, data FROM mapping ORDER BY source_id DESC LIMIT ?', (limit,)
+            ).fetchall()
+        result = {}
+        for source_id, data in reversed(rows):
+            try:
+                result[source_id] = json_loads(data)
+            except ValueError:
+                logger.warning("Повреждённая запись маппинга %s пропущена", source_id)
+        return result
+
+    def load_processed(self, limit: int) -> List[int]:
+        """ID последних обработанных исходных сообщений, от старых к новым"""
+        if self._conn is None:
+            return []
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT source_id FROM processed ORDER BY source_id DESC LIMIT ?', (limit,)
+            ).fetchall()
+        return [row[0] for row in reversed(rows)]
+
+    def mark_processed(self, source_id: int) -> None:
+        self._pending_processed.append(source_id)
+
+    def remember(self, source_id: int, entry: dict) -> None:
+        """Ставит запись маппинга в очередь на запись (снимок берётся сразу)"""
+        self._pending_mapping[source_id] = json_dumps(entry)
+
+    def forget(self, source_id: int) -> None:
+        self._pending_mapping[source_id] = None
+
+    def get_value(self, key: str) -> Optional[str]:
+        return self._values.get(key)
+
+    def set_value(self, key: str, value) -> None:
+        self._values[key] = str(value)
+        self._pending_values[key] = str(value)
+
+    def last_source_id(self, key: str = LAST_SOURCE_ID) -> Optional[int]:
+        value = self.get_value(key)
+        return int(value) if value else None
+
+    def advance_last_source_id(self, source_id: int, key: str = LAST_SOURCE_ID) -> None:
+        current = self.last_source_id(key)
+        if current is None or source_id > current:
+            self.set_value(key, source_id)
+
+    def load_entry(self, source_id: int):
+        """Запись маппинга из базы (с учётом ещё не записанных изменений) или None"""
+        if source_id in self._pending_mapping:
+            data = self._pending_mapping[source_id]
+            return json_loads(data) if data is not None else None
+        if self._conn is None:
+            return None
+        with self._lock:
+            row = self._conn.execute('SELECT data FROM mapping WHERE source_id = ?', (source_id,)).fetchone()
+        return json_loads(row[0]) if row else None
+
+    def reload_values(self) -> None:
+        """Перечитывает kv из базы (их могла обновить другая реплика); незаписанные свои важнее"""
+        if self._conn is None:
+            return
+        with self._lock:
+            values = dict(self._conn.execute('SELECT key, value FROM kv').fetchall())
+        values.update(self._pending_values)
+        self._values = values
+
+    def try_lease(self, name: str, holder: str, ttl: float) -> bool:
+        """Берёт или продлевает аренду name на ttl секунд, если она свободна, истекла или уже наша"""
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                now = time.time()
+                row = self._conn.execute('SELECT holder, expires FROM lease WHERE name = ?', (name,)).fetchone()
+                acquired = row is None or row[0] == holder or row[1] < now
+                if acquired:
+                    self._conn.execute(
+                        'INSERT OR REPLACE INTO lease (name, holder, expires) VALUES (?, ?, ?)',
+                        (name, holder, now + ttl)
+                    )
+                self._conn.execute('COMMIT')
+                return acquired
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    def release_lease(self, name: str, holder: str) -> None:
+        with self._lock:
+            self._conn.execute('DELETE FROM lease WHERE name = ? AND holder = ?', (name, holder))
+
+    def save_unfinished(self, specs: List[dict]) -> None:
+        """Добавляет операции для повтора при запуске (сразу, минуя отложенную запись)"""
+        if self._conn is None or not specs:
+            return
+        with self._lock:
+            self._conn.executemany(
+                'INSERT INTO unfinished (source_id, spec) VALUES (?, ?)',
+                [(spec['source_id'], json_dumps(spec).decode('utf-8')) for spec in specs]
+            )
+
+    def claim_unfinished(self, owns) -> List[dict]:
+        """
+        Забирает операции, чьи source_id принадлежат этой реплике (owns(source_id) истинно)
+        Выбор и удаление идут в одной транзакции: две реплики не получат одну операцию
+        """
+        if self._conn is None:
+            return []
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                rows = self._conn.execute('SELECT id, source_id, spec FROM unfinished ORDER BY id').fetchall()
+                mine = [(row_id, spec) for row_id, source_id, spec in rows if owns(source_id)]
+                self._conn.executemany('DELETE FROM unfinished WHERE id = ?', [(row_id,) for row_id, _ in mine])
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+        return [json_loads(spec) for _, spec in mine]
+
+    def lease_holders(self, prefix: str) -> set:
+        """Держатели действующих аренд с именем на prefix"""
+        with self._lock:
+            rows = self._conn.execute(
+                'SELECT holder FROM lease WHERE name LIKE ? AND expires >= ?', (prefix + '%', time.time())
+            ).fetchall()
+        return {row[0] for row in rows}
+
+    def count_leases(self, prefix: str) -> int:
+        """Число действующих аренд с именем на prefix"""
+        with self._lock:
+            row = self._conn.execute(
+                'SELECT COUNT(*) FROM lease WHERE name LIKE ? AND expires >= ?', (prefix + '%', time.time())
+            ).fetchone()
+        return row[0]
+
+    def _write(self, mapping: dict, values: dict, processed: List[int]) -> None:
+        with self._lock:
+            self._conn.execute('BEGIN IMMEDIATE')
+            try:
+                for source_id, data in mapping.items():
+                    if data is None:
+                        self._conn.execute('DELETE FROM mapping WHERE source_id = ?', (source_id,))
+                    else:
+                        self._conn.execute(
+                            'INSERT OR REPLACE INTO mapping (source_id, data) VALUES (?, ?)', (source_id, data)
+                        )
+                for key, value in values.items():
+                    if key.startswith(self.LAST_SOURCE_ID):
+                        # Прогресс только растёт, даже если другая реплика записала больший ID раньше нас
+                        self._conn.execute(
+                            'INSERT INTO kv (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE '
+                            'SET value = excluded.value WHERE CAST(excluded.value AS INTEGER) > CAST(kv.value AS INTEGER)',
+                            (key, value)
+                        )
+                    else:
+                        self._conn.execute('INSERT OR REPLACE INTO kv (key, value) VALUES (?, ?)', (key, value))
+                if processed:
+                    self._conn.executemany(
+                        'INSERT OR IGNORE INTO processed (source_id) VALUES (?)', [(i,) for i in processed]
+                    )
+                    self._conn.execute(
+                        'DELETE FROM processed WHERE source_id NOT IN '
+                        '(SELECT source_id FROM processed ORDER BY source_id DESC LIMIT ?)',
+                        (self.processed_limit,)
+                    )
+                self._conn.execute('COMMIT')
+            except Exception:
+                self._conn.execute('ROLLBACK')
+                raise
+
+    async def flush(self) -> None:
+        """Записывает накопленные изменения в фоновом потоке"""
+        if self._conn is None or not (self._pending_mapping or self._pending_values or self._pending_processed):
+            return
+        mapping, self._pending_mapping = self._pending_mapping, {}
+        values, self._pending_values = self._pending_values, {}
+        processed, self._pending_processed = self._pending_processed, []
+        try:
+            await asyncio.to_thread(self._write, mapping, values, processed)
+        except Exception:
+            # Возвращаем несохранённое обратно, не затирая более свежие изменения
+            for source_id, data in mapping.items():
+                self._pending_mapping.setdefault(source_id, data)
+            for key, value in values.items():
+                self._pending_values.setdefault(key, value)
+            self._pending_processed.extend(processed)
+            raise
+
+    async def flusher(self) -> None:
+        """Фоновая запись состояния на диск"""
+        while True:
+            try:
+                await asyncio.sleep(STATE_FLUSH_INTERVAL_SECONDS)
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка записи состояния в %s: %s", self.path, e, exc_info=True)
+
+
+state_store = StateStore()
+
+
+def telegram_message_ids(entry) -> dict:
+    """
+    ID копий сообщения в Telegram: {ключ чата: message_id}
+    Старые записи маппинга хранили один ID — он относится к первому чату из TELEGRAM_GROUP_ID
+    """
+    if not isinstance(entry, dict):
+        return {}
+    ids = entry.get('telegram')
+    if isinstance(ids, dict):
+        return {key: message_id for key, message_id in ids.items() if message_id}
+    if ids:
+        targets = telegram_targets()
+        return {targets[0].key: ids} if targets else {}
+    return {}
+
+
+async def lookup_mapping(source_id: int):
+    """
+    Запись маппинга из памяти, а при промахе — из базы: сообщение могла переслать другая реплика
+    или оно старше MAPPING_CACHE_SIZE последних
+    """
+    entry = message_mapping.get(source_id)
+    if entry is None and state_store.path is not None:
+        entry = await asyncio.to_thread(state_store.load_entry, source_id)
+        if entry is not None:
+            message_mapping[source_id] = entry
+    return entry
+
+
+def remember_mapping(source_id: int, entry: dict) -> None:
+    """Обновляет маппинг в памяти и ставит запись в очередь на сохранение"""
+    message_mapping[source_id] = entry
+    state_store.remember(source_id, entry)
+
+
+def forget_mapping(source_id: int) -> None:
+    message_mapping.pop(source_id, None)
+    state_store.forget(source_id)
+
+
+"""
+Защита от повторной пересылки
+После переподключения Discord может прислать MESSAGE_CREATE повторно. Сообщения, которые
+уже пересылаются, ждут результата первой пересылки, а недавно пересланные пропускаются.
+Список недавних ID хранится вместе с маппингом и переживает перезапуск.
+"""
+class ForwardDeduplicator:
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.in_flight: dict[int, asyncio.Task] = {}
+        self.recent: OrderedDict = OrderedDict()
+        # ID → [блокировка, число ожидающих]
+        self.locks: dict[int, list] = {}
+
+    def load(self, source_ids: List[int]) -> None:
+        for source_id in source_ids:
+            self._remember(source_id)
+
+    def is_known(self, source_id: int) -> bool:
+        return source_id in self.recent or source_id in self.in_flight
+
+    def _remember(self, source_id: int) -> None:
+        self.recent[source_id] = None
+        self.recent.move_to_end(source_id)
+        while len(self.recent) > self.capacity:
+            self.recent.popitem(last=False)
+
+    def _done(self, source_id: int, task: asyncio.Task) -> None:
+        self.in_flight.pop(source_id, None)
+        # Неудачную пересылку не запоминаем: повторное событие сможет её повторить
+        error = None if task.cancelled() else task.exception()
+        ok = not task.cancelled() and error is None and task.result() is not None
+        if ok:
+            self._remember(source_id)
+            state_store.mark_processed(source_id)
+        if error is not None and is_permanent_forward_error(error):
+            forward_progress.reject(source_id, error)
+        else:
+            forward_progress.finish(source_id, ok)
+
+    async def run(self, source_id: int, factory):
+        """
+        Выполняет пересылку один раз на ID исходного сообщения
+        Возвращает результат пересылки (в том числе чужой, если она уже идёт) или None для дубликата
+        """
+        if source_id in self.recent:
+            logger.info("Сообщение %s уже переслано, повторное событие пропущено", source_id)
+            forward_progress.finish(source_id, True)
+            return None
+        task = self.in_flight.get(source_id)
+        if task is None:
+            forward_progress.begin(source_id)
+            task = asyncio.ensure_future(factory())
+            self.in_flight[source_id] = task
+            task.add_done_callback(functools.partial(self._done, source_id))
+        else:
+            logger.info("Сообщение %s уже пересылается, ждём результат", source_id)
+        # shield: отмена одного из ожидающих обработчиков не прерывает общую пересылку
+        return await asyncio.shield(task)
+
+    @contextlib.asynccontextmanager
+    async def ordered(self, source_id: int):
+        """
+        Выполняет правку или удаление source_id после его пересылки и по порядку событий
+        Правка или удаление, пришедшие во время загрузки вложений, иначе не застанут маппинг,
+        а правка, закончившаяся после удаления, вернула бы удалённую запись
+        """
+        slot = self.locks.setdefault(source_id, [asyncio.Lock(), 0])
+        slot[1] += 1
+        try:
+            # Очередь блокировки занимается до первого await, поэтому сохраняет порядок событий
+            async with slot[0]:
+                task = self.in_flight.get(source_id)
+                if task is not None:
+                    logger.info("Сообщение %s ещё пересылается, ждём её завершения", source_id)
+                    # asyncio.wait не отменяет пересылку и не пробрасывает её ошибку
+                    await asyncio.wait({task})
+                yield
+        finally:
+            slot[1] -= 1
+            if not slot[1]:
+                del self.locks[source_id]
+
+
+forward_dedup = ForwardDeduplicator(DEDUP_CAPACITY)
+
+
+"""
+Водяной знак пересылки
+В хранилище записывается ID, до которого включительно все сообщения пересланы. Пока более
+раннее сообщение ещё пересылается или его пересылка не удалась, знак не сдвигается дальше него:
+иначе догонка после перезапуска начнёт с более позднего ID и пропущенное сообщение потеряется.
+Неудачная пересылка держит знак, пока догонка не перешлёт её или исходное сообщение не удалят;
+если Discord отклонил само сообщение (например, файл больше лимита), повтор не поможет и знак его не ждёт.
+Пока догонка читает историю, знак не проходит её курсор: живые пересылки более поздних сообщений
+не должны перескочить ещё не прочитанные.
+"""
+def is_permanent_forward_error(error: BaseException) -> bool:
+    """Discord отклонил само сообщение (слишком большой файл, неверное содержимое): повтор не поможет"""
+    return isinstance(error, discord.HTTPException) and error.status in (400, 413)
+
+
+class ForwardProgress:
+    def __init__(self):
+        self.pending: dict[str, set] = {}
+        self.failed: dict[str, set] = {}
+        self.done: dict[str, set] = {}
+        # Первый ID, который догонка ещё не прочитала из истории
+        self.cursor: Optional[int] = None
+
+    @staticmethod
+    def _keys(source_id: int) -> List[str]:
+        keys = [replica.progress_key(source_id)]
+        if replica.partitions > 1:
+            keys.append(StateStore.LAST_SOURCE_ID)
+        return keys
+
+    def begin(self, source_id: int) -> None:
+        """Отмечает начало пересылки: до её завершения знак не проходит этот ID"""
+        for key in self._keys(source_id):
+            self.pending.setdefault(key, set()).add(source_id)
+            self.failed.get(key, set()).discard(source_id)
+
+    def finish(self, source_id: int, ok: bool) -> None:
+        for key in self._keys(source_id):
+            pending = self.pending.get(key, set())
+            if not ok and source_id not in pending:
+                # Пересылку уже закрыл reject
+                continue
+            pending.discard(source_id)
+            (self.done if ok else self.failed).setdefault(key, set()).add(source_id)
+            self._advance(key)
+
+    def abandon(self, source_id: int) -> None:
+        """Пересылка прервана, не начавшись: ID считается неудачным, если ещё не завершён"""
+        if any(source_id in self.pending.get(key, ()) for key in self._keys(source_id)):
+            self.finish(source_id, False)
+
+    def reject(self, source_id: int, error: BaseException) -> None:
+        """Пересылку не повторить (is_permanent_forward_error): знак больше не ждёт этот ID"""
+        logger.warning("Сообщение %s не переслано, повторов не будет: %s", source_id, error)
+        for key in self._keys(source_id):
+            self.pending.get(key, set()).discard(source_id)
+            self.failed.get(key, set()).discard(source_id)
+            self.done.setdefault(key, set()).add(source_id)
+            self._advance(key)
+
+    def hold(self, cursor: Optional[int]) -> None:
+        """Догонка ещё не прочитала историю начиная с cursor: знак не проходит его; None снимает ограничение"""
+        self.cursor = cursor
+        for key in list(self.done):
+            self._advance(key)
+
+    def forget(self, source_id: int) -> None:
+        """Исходное сообщение удалено: повторять его пересылку больше не нужно"""
+        for key in self._keys(source_id):
+            if source_id in self.failed.get(key, ()):
+                self.failed[key].discard(source_id)
+                self._advance(key)
+
+    def _advance(self, key: str) -> None:
+        blockers = self.pending.get(key, set()) | self.failed.get(key, set())
+        if self.cursor is not None:
+            blockers.add(self.cursor)
+        limit = min(blockers) if blockers else None
+        done = self.done.get(key, set())
+        ready = {source_id for source_id in done if limit is None or source_id < limit}
+        if ready:
+            state_store.advance_last_source_id(max(ready), key)
+            done -= ready
+
+
+forward_progress = ForwardProgress()
+
+
+"""
+Координация нескольких реплик
+Реплики делят общую базу data/state.db и договариваются через аренды в таблице lease.
+Сообщения делятся на разделы по message.id; раздел обрабатывает только реплика, держащая
+его аренду. В режиме standby раздел один: его держит активная реплика, остальные в горячем
+резерве (подключены к Discord, кэш маппинга обновляется) и забирают аренду, когда она истекает.
+Правка и удаление попадают в тот же раздел, что и создание, а маппинг при промахе читается из базы.
+"""
+class ReplicaCoordinator:
+    def __init__(self):
+        self.replica_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.mode = 'single'
+        self.partitions = 1
+        # раздел -> время окончания нашей аренды
+        self.owned: dict[int, float] = {}
+
+    def configure(self, mode: str, partitions: int) -> None:
+        self.mode = mode
+        self.partitions = partitions if mode == 'partition' else 1
+
+    def partition_of(self, source_id: int) -> int:
+        return source_id % self.partitions
+
+    def owns(self, source_id: int) -> bool:
+        """Обрабатывает ли эта реплика событие с данным ID (сообщения или взаимодействия)"""
+        if self.mode == 'single':
+            return True
+        return self.owned.get(self.partition_of(source_id), 0) > time.time()
+
+    @property
+    def active(self) -> bool:
+        return self.mode == 'single' or any(expires > time.time() for expires in self.owned.values())
+
+    def progress_key(self, source_id: int) -> str:
+        """Ключ ID последнего пересланного сообщения для раздела, к которому относится source_id"""
+        if self.partitions == 1:
+            return StateStore.LAST_SOURCE_ID
+        return f"{StateStore.LAST_SOURCE_ID}:{self.partition_of(source_id)}"
+
+    def describe(self) -> str:
+        if self.mode == 'single':
+            return "одна реплика"
+        owned = sorted(p for p, expires in self.owned.items() if expires > time.time())
+        if self.mode == 'standby':
+            return f"{self.replica_id}: {'активная' if owned else 'резерв'}"
+        return f"{self.replica_id}: разделы {owned or 'нет'} из {self.partitions}"
+
+    async def _rebalance(self) -> List[int]:
+        """Продлевает свои аренды и забирает свободные разделы до своей доли; возвращает новые разделы"""
+        ttl = LEASE_TTL_SECONDS
+        await asyncio.to_thread(state_store.try_lease, f"replica:{self.replica_id}", self.replica_id, ttl)
+        live = max(1, await asyncio.to_thread(state_store.count_leases, 'replica:'))
+        share = -(-self.partitions // live)
+        gained = []
+        for partition in range(self.partitions):
+            held = partition in self.owned
+            if not held and len(self.owned) >= share:
+                continue
+            expires = time.time() + ttl
+            if await asyncio.to_thread(state_store.try_lease, f"partition:{partition}", self.replica_id, ttl):
+                self.owned[partition] = expires
+                if not held:
+                    gained.append(partition)
+            elif held:
+                del self.owned[partition]
+                logger.warning("Реплика %s потеряла раздел %s: аренду забрала другая реплика", self.replica_id, partition)
+        # Появились новые реплики — отдаём лишние разделы, их заберут на следующем круге
+        for partition in sorted(self.owned)[share:]:
+            await asyncio.to_thread(state_store.release_lease, f"partition:{partition}", self.replica_id)
+            del self.owned[partition]
+            logger.info("Реплика %s передала раздел %s", self.replica_id, partition)
+        return gained
+
+    async def _warm_up(self, gained: List[int]) -> None:
+        """Подхватывает состояние, записанное прежним владельцем разделов, и догоняет пропущенное"""
+        logger.info("Реплика %s стала активной для разделов %s", self.replica_id, gained)
+        await asyncio.to_thread(state_store.reload_values)
+        # Записи новых разделов в кэше могли устареть, пока их вёл прежний владелец: заменяем их целиком
+        mapping = await asyncio.to_thread(state_store.load_mapping, MAPPING_CACHE_SIZE)
+        for source_id in [source_id for source_id in message_mapping if self.partition_of(source_id) in gained]:
+            del message_mapping[source_id]
+        message_mapping.update(
+            (source_id, entry) for source_id, entry in mapping.items() if self.partition_of(source_id) in gained
+        )
+        forward_dedup.load(await asyncio.to_thread(state_store.load_processed, DEDUP_CAPACITY))
+        if bot.is_ready():
+            start_catch_up()
+
+    async def release(self) -> None:
+        """Отдаёт аренды при остановке, чтобы резерв не ждал их истечения"""
+        if self.mode == 'single' or state_store.path is None:
+            return
+        for partition in list(self.owned):
+            await asyncio.to_thread(state_store.release_lease, f"partition:{partition}", self.replica_id)
+        self.owned.clear()
+        await asyncio.to_thread(state_store.release_lease, f"replica:{self.replica_id}", self.replica_id)
+
+    async def run(self) -> None:
+        """Фоновое продление аренд; резервная реплика тем временем обновляет кэш маппинга"""
+        if self.mode == 'single':
+            return
+        logger.info("Реплика %s: режим %s, разделов %s", self.replica_id, self.mode, self.partitions)
+        while True:
+            try:
+                gained = await self._rebalance()
+                if gained:
+                    await self._warm_up(gained)
+                elif not self.active:
+                    mapping = await asyncio.to_thread(state_store.load_mapping, MAPPING_CACHE_SIZE)
+                    message_mapping.clear()
+                    message_mapping.update(mapping)
+            except Exception as e:
+                logger.error("Ошибка продления аренды реплики %s: %s", self.replica_id, e, exc_info=True)
+            await asyncio.sleep(LEASE_TTL_SECONDS / 3)
+
+
+replica = ReplicaCoordinator()
+
+
+"""
+Запись трассы событий исходного канала
+Создание, правка и удаление сообщений пишутся в сжатый JSONL (TRACE_FILE), чтобы потом
+проиграть всплеск нагрузки командой `python replay.py <трасса>`
+"""
+def trace_message_payload(message: discord.Message) -> dict:
+    """Поля сообщения, которые читают обработчики пересылки (без ссылок на файлы)"""
+    return {
+        'id': message.id,
+        'channel_id': message.channel.id,
+        'author_id': message.author.id,
+        'content': message.content,
+        'edited_at': message.edited_at.timestamp() if message.edited_at else None,
+        'attachments': [
+            {
+                'filename': attachment.filename,
+                'size': attachment.size,
+                'spoiler': attachment.is_spoiler(),
+                'description': attachment.description,
+            }
+            for attachment in message.attachments
+        ],
+        'embeds': [embed.to_dict() for embed in message.embeds],
+    }
+
+
+class TraceRecorder:
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.recorded = 0
+        self._pending: List[dict] = []
+
+    def open(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+
+    def record(self, event: str, payload: dict) -> None:
+        """Ставит событие в очередь на запись; без TRACE_FILE ничего не делает"""
+        if self.path is None:
+            return
+        self._pending.append({'t': time.time(), 'event': event, **payload})
+
+    def _write(self, events: List[dict]) -> None:
+        # Каждая дозапись — отдельный член gzip, gzip.open читает их подряд
+        with gzip.open(self.path, 'ab') as f:
+            f.write(b''.join(json_dumps(event) + b'\n' for event in events))
+
+    async def flush(self) -> None:
+        if self.path is None or not self._pending:
+            return
+        events, self._pending = self._pending, []
+        await asyncio.to_thread(self._write, events)
+        self.recorded += len(events)
+
+    async def flusher(self) -> None:
+        """Фоновая запись трассы на диск"""
+        while True:
+            try:
+                await asyncio.sleep(STATE_FLUSH_INTERVAL_SECONDS)
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка записи трассы в %s: %s", self.path, e, exc_info=True)
+
+
+trace_recorder = TraceRecorder()
+
+
+"""
+Сторож цикла событий
+Задача-пульс отмечается каждые 50 мс, а отдельный поток проверяет отметки. Если пульса нет
+дольше LOOP_BLOCK_THRESHOLD_MS, поток снимает стек главного потока через sys._current_frames():
+это и есть синхронный вызов, который держит цикл. После разблокировки в лог пишется
+длительность и стек, а место блокировки попадает в сводку худших мест.
+"""
+class LoopWatchdog:
+    HEARTBEAT_INTERVAL = 0.05
+
+    def __init__(self):
+        self.threshold = LOOP_BLOCK_THRESHOLD_MS / 1000
+        self.last_beat = time.monotonic()
+        self.max_lag = 0.0
+        self.blocks = 0
+        # место в коде -> [число блокировок, суммарная длительность, максимум]
+        self.offenders: dict[str, list] = {}
+        self._loop_thread_id: Optional[int] = None
+        self._stack: Optional[List[str]] = None
+        self._offender = ''
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def _capture(self) -> None:
+        """Поток сторожа: снимает стек главного потока один раз за эпизод блокировки"""
+        while True:
+            time.sleep(self.threshold / 4)
+            if time.monotonic() - self.last_beat < self.threshold:
+                continue
+            with self._lock:
+                if self._stack is not None:
+                    continue
+                frame = sys._current_frames().get(self._loop_thread_id)
+                if frame is not None:
+                    self._stack = LoopWatchdog.format_stack(frame)
+                    self._offender = LoopWatchdog.offender(frame)
+
+    @staticmethod
+    def format_stack(frame) -> List[str]:
+        """Стек без кадров самого цикла asyncio: начинается с обратного вызова, который держит цикл"""
+        frames = traceback.extract_stack(frame)
+        for index in range(len(frames) - 1, -1, -1):
+            if frames[index].name == '_run' and frames[index].filename.endswith(os.path.join('asyncio', 'events.py')):
+                frames = frames[index + 1:]
+                break
+        return traceback.format_list(frames)
+
+    @staticmethod
+    def offender(frame) -> str:
+        """Самый глубокий кадр из кода бота (или самый глубокий вообще): file:line (функция)"""
+        innermost = None
+        while frame is not None:
+            location = f"{os.path.basename(frame.f_code.co_filename)}:{frame.f_lineno} ({frame.f_code.co_name})"
+            innermost = innermost or location
+            if os.path.basename(frame.f_code.co_filename) == os.path.basename(__file__):
+                return location
+            frame = frame.f_back
+        return innermost or 'неизвестно'
+
+    def _record(self, lag: float) -> None:
+        with self._lock:
+            stack, self._stack = self._stack, None
+            location = self._offender if stack else 'стек не снят'
+        self.blocks += 1
+        stats = self.offenders.setdefault(location, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += lag
+        stats[2] = max(stats[2], lag)
+        logger.warning(
+            "Цикл событий был заблокирован на %.0f мс в %s\n%s",
+            lag * 1000, location, ''.join(stack or [])
+        )
+
+    def summary(self, limit: int = 5) -> List[str]:
+        """Худшие места блокировок по суммарной длительности"""
+        worst = sorted(self.offenders.items(), key=lambda item: item[1][1], reverse=True)[:limit]
+        return [
+            f"{location}: {count} раз, всего {total * 1000:.0f} мс, максимум {peak * 1000:.0f} мс"
+            for location, (count, total, peak) in worst
+        ]
+
+    async def run(self) -> None:
+        """Пульс в цикле событий и запуск потока-сторожа (LOOP_BLOCK_THRESHOLD_MS=0 отключает)"""
+        if LOOP_BLOCK_THRESHOLD_MS <= 0:
+            return
+        self.threshold = LOOP_BLOCK_THRESHOLD_MS / 1000
+        self._loop_thread_id = threading.get_ident()
+        self.last_beat = time.monotonic()
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._capture, name='loop-watchdog', daemon=True)
+            self._thread.start()
+        next_report = time.monotonic() + LOOP_WATCHDOG_REPORT_SECONDS
+        while True:
+            before = time.monotonic()
+            await asyncio.sleep(self.HEARTBEAT_INTERVAL)
+            now = time.monotonic()
+            self.last_beat = now
+            lag = now - before - self.HEARTBEAT_INTERVAL
+            self.max_lag = max(self.max_lag, lag)
+            if lag >= self.threshold:
+                self._record(lag)
+            elif self._stack is not None:
+                # Стек снят на границе порога, а блокировка оказалась короче — не приписываем его следующей
+                with self._lock:
+                    self._stack = None
+            if now >= next_report:
+                next_report = now + LOOP_WATCHDOG_REPORT_SECONDS
+                if self.offenders:
+                    logger.warning("Худшие блокировки цикла событий:\n%s", '\n'.join(self.summary()))
+
+
+loop_watchdog = LoopWatchdog()
+
+
+"""
+Спаны пересылки
+Каждое исходное сообщение получает трассу: trace_id выводится из ID сообщения, поэтому пересылка,
+правки и удаление одного сообщения попадают в одну трассу. Стадии — дочерние спаны: вложения,
+Tenor, отправка в Discord, задачи Telegram, загрузки и каждая попытка запроса к Bot API.
+Решение о сохранении принимается по завершении корневого спана (tail-based): медленные
+(дольше SPANS_SLOW_MS) и завершившиеся ошибкой операции сохраняются всегда, остальные — в
+SPANS_SAMPLE_PERCENT процентах. Сохранённые спаны пишутся в JSONL (SPANS_FILE) и/или
+отправляются в коллектор OTLP/HTTP в формате JSON (OTLP_ENDPOINT).
+"""
+current_span: contextvars.ContextVar = contextvars.ContextVar('current_span', default=None)
+
+
+class Span:
+    """Стадия операции; `with span:` делает её родителем для вложенных спанов"""
+    def __init__(self, tracer: 'SpanTracer', name: str, trace_id: str, parent: Optional['Span'], attributes: dict):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent.span_id if parent else None
+        self.root = parent.root if parent else self
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+        # Только у корня: завершённые спаны трассы до решения о сохранении и само решение
+        self.finished: List['Span'] = []
+        self.failed = False
+        self.sampled: Optional[bool] = None
+        self._token = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+    def set(self, **attributes) -> None:
+        self.attributes.update(attributes)
+
+    def fail(self, error) -> None:
+        self.error = str(error) or type(error).__name__
+        self.root.failed = True
+
+    def end(self) -> None:
+        if self.end_ns is None:
+            self.end_ns = time.time_ns()
+            self.tracer._finished(self)
+
+    def __enter__(self) -> 'Span':
+        self._token = current_span.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        current_span.reset(self._token)
+        if exc_type is asyncio.CancelledError:
+            self.fail('отменено')
+        elif exc is not None:
+            self.fail(exc)
+        self.end()
+        return False
+
+    def to_dict(self) -> dict:
+        return {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start_ns / 1e9,
+            'duration_ms': round(self.duration_ms, 3),
+            'attributes': self.attributes,
+            'error': self.error,
+        }
+
+    @staticmethod
+    def otlp_value(value) -> dict:
+        if isinstance(value, bool):
+            return {'boolValue': value}
+        if isinstance(value, int):
+            return {'intValue': str(value)}
+        if isinstance(value, float):
+            return {'doubleValue': value}
+        return {'stringValue': str(value)}
+
+    def to_otlp(self) -> dict:
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns or time.time_ns()),
+            'attributes': [{'key': key, 'value': Span.otlp_value(value)} for key, value in self.attributes.items()],
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.error:
+            span['status'] = {'code': 2, 'message': self.error}
+        return span
+
+
+class NoopSpan:
+    """Заглушка, когда трассировка выключена или у стадии нет родительской операции"""
+    def set(self, **attributes) -> None:
+        pass
+
+    def fail(self, error) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+    def __enter__(self) -> 'NoopSpan':
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class SpanTracer:
+    EXPORT_INTERVAL_SECONDS = 5
+    # Больше спанов в очереди на выгрузку не держим: коллектор недоступен — новые отбрасываются
+    MAX_PENDING = 20000
+
+    def __init__(self):
+        self.path: Optional[str] = None
+        self.endpoint: Optional[str] = None
+        self.exported = 0
+        self.dropped = 0
+        self._pending: List[Span] = []
+        self._session: Optional[aiohttp.ClientSession] = None
 
+    @property
+    def enabled(self) -> bool:
+        return self.path is not None or self.endpoint is not None
 
-def _parse_int_env(name: str) -> Optional[int]:
-    raw = os.getenv(name)
-    if raw is None or raw == "":
-        return None
-    try:
-        return int(raw)
-    except ValueError:
-        logger.error(f"Некорректное значение переменной окружения {name}: {raw!r} (ожидается число)")
-        return None
+    def configure(self, path: Optional[str], endpoint: Optional[str]) -> None:
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path or None
+        self.endpoint = endpoint or None
 
+    def span(self, name: str, source_id: Optional[int] = None, **attributes):
+        """
+        Начинает спан: с source_id — корень трассы сообщения, иначе — дочерний спан текущей стадии
+        Без включённой трассировки или вне операции над сообщением возвращает NOOP_SPAN
+        """
+        if not self.enabled:
+            return NOOP_SPAN
+        if source_id is not None:
+            attributes['message_id'] = source_id
+            return Span(self, name, f"{source_id:032x}", None, attributes)
+        parent = current_span.get()
+        if parent is None:
+            return NOOP_SPAN
+        return Span(self, name, parent.trace_id, parent, attributes)
 
-def _load_channels_from_env() -> Optional[dict]:
-    """
-    CHANNELS_JSON should be a JSON object: {"новости": 123, "ивент-события": 456}
-    """
-    raw = os.getenv("CHANNELS_JSON")
-    if raw is None or raw.strip() == "":
-        return None
-    try:
-        parsed = json.loads(raw)
-    except json.JSONDecodeError as e:
-        logger.error(f"Некорректный JSON в CHANNELS_JSON: {e}")
-        return None
-    if not isinstance(parsed, dict):
-        logger.error("CHANNELS_JSON должен быть JSON-объектом (словарём) name->id")
-        return None
+    def _finished(self, span: Span) -> None:
+        root = span.root
+        if span is root:
+            root.sampled = (
+                root.failed
+                or root.duration_ms >= SPANS_SLOW_MS
+                or random.random() * 100 < SPANS_SAMPLE_PERCENT
+            )
+            if root.sampled:
+                self._export(root.finished + [root])
+            root.finished = []
+        elif root.sampled is None:
+            root.finished.append(span)
+        elif root.sampled or span.error or span.duration_ms >= SPANS_SLOW_MS:
+            # Стадия пережила корень (например, задача Telegram ждала восстановления связи)
+            self._export([span])
 
-    result: dict[str, int] = {}
-    for k, v in parsed.items():
-        if not isinstance(k, str) or not k.strip():
-            logger.error("CHANNELS_JSON содержит пустой/некорректный ключ канала")
-            return None
-        try:
-            channel_id = int(v)
-        except (TypeError, ValueError):
-            logger.error(f"CHANNELS_JSON: id канала для {k!r} должен быть числом, получено: {v!r}")
-            return None
-        result[k.strip().lower()] = channel_id
+    def _export(self, spans: List[Span]) -> None:
+        if len(self._pending) + len(spans) > self.MAX_PENDING:
+            self.dropped += len(spans)
+            return
+        self._pending.extend(spans)
 
-    if not result:
-        logger.error("CHANNELS_JSON пустой — нужен хотя бы один канал")
-        return None
-    return result
+    def _write(self, records: List[dict]) -> None:
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(json_dumps(record) + b'\n' for record in records))
 
+    def otlp_payload(self, spans: List[Span]) -> dict:
+        resource = {
+            'service.name': os.getenv('OTEL_SERVICE_NAME') or 'bot-snd-msg',
+            'service.instance.id': replica.replica_id,
+        }
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': key, 'value': Span.otlp_value(value)} for key, value in resource.items()]},
+            'scopeSpans': [{'scope': {'name': 'bot-snd-msg'}, 'spans': [span.to_otlp() for span in spans]}],
+        }]}
 
-def init_runtime_config() -> None:
-    global SOURCE_CHANNEL_ID, CHANNELS, CONFIG_FILE
+    async def _post(self, spans: List[Span]) -> bool:
+        """Отправляет спаны в коллектор; True, только если он принял их (2xx)"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=10))
+        async with self._session.post(
+            self.endpoint,
+            data=json_dumps(self.otlp_payload(spans)),
+            headers={'Content-Type': 'application/json'}
+        ) as resp:
+            if 200 <= resp.status < 300:
+                return True
+            logger.warning("Коллектор OTLP %s ответил %s: %s", self.endpoint, resp.status, (await resp.text())[:200])
+            return False
 
-    cfg_file = os.getenv('CONFIG_FILE')
-    if cfg_file:
-        CONFIG_FILE = cfg_file
+    async def flush(self) -> None:
+        """Выгружает накопленные спаны; выгруженными считаются записанные в файл или принятые коллектором"""
+        if not self._pending:
+            return
+        spans, self._pending = self._pending, []
+        delivered = False
+        if self.path is not None:
+            try:
+                await asyncio.to_thread(self._write, [span.to_dict() for span in spans])
+                delivered = True
+            except OSError as e:
+                logger.warning("Не удалось записать %s спанов в %s: %s", len(spans), self.path, e)
+        if self.endpoint is not None:
+            try:
+                delivered = await self._post(spans) or delivered
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning("Не удалось отправить %s спанов в %s: %r", len(spans), self.endpoint, e)
+        if delivered:
+            self.exported += len(spans)
+        else:
+            self.dropped += len(spans)
 
-    # Load from config file (optional) first, then let env override.
-    if os.path.exists(CONFIG_FILE):
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-            if isinstance(data, dict):
-                if SOURCE_CHANNEL_ID is None:
-                    src = data.get("source_channel_id")
-                    if src is not None:
-                        try:
-                            SOURCE_CHANNEL_ID = int(src)
-                        except (TypeError, ValueError):
-                            logger.error(f"config: source_channel_id должен быть числом, получено: {src!r}")
-                if not CHANNELS:
-                    ch = data.get("channels")
-                    if ch is not None:
-                        if isinstance(ch, dict):
-                            parsed: dict[str, int] = {}
-                            for k, v in ch.items():
-                                if not isinstance(k, str) or not k.strip():
-                                    logger.error("config: channels содержит пустой/некорректный ключ")
-                                    parsed = {}
-                                    break
-                                try:
-                                    parsed[k.strip().lower()] = int(v)
-                                except (TypeError, ValueError):
-                                    logger.error(f"config: channels[{k!r}] должен быть числом, получено: {v!r}")
-                                    parsed = {}
-                                    break
-                            if parsed:
-                                CHANNELS = parsed
-                        else:
-                            logger.error("config: channels должен быть объектом (словарём) name->id")
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка чтения {CONFIG_FILE}: {e}")
-        except Exception as e:
-            logger.error(f"Ошибка загрузки {CONFIG_FILE}: {e}")
+    async def flusher(self) -> None:
+        """Фоновая выгрузка сохранённых спанов"""
+        if not self.enabled:
+            return
+        while True:
+            try:
+                await asyncio.sleep(self.EXPORT_INTERVAL_SECONDS)
+                await self.flush()
+            except Exception as e:
+                logger.error("Ошибка выгрузки спанов: %s", e, exc_info=True)
 
-    source_id = _parse_int_env("SOURCE_CHANNEL_ID")
-    if source_id is not None:
-        SOURCE_CHANNEL_ID = source_id
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
 
-    channels = _load_channels_from_env()
-    if channels is not None:
-        CHANNELS = channels
 
+span_tracer = SpanTracer()
 
-def validate_runtime_config() -> bool:
-    ok = True
-    if SOURCE_CHANNEL_ID is None:
-        logger.error("SOURCE_CHANNEL_ID не задан. Укажите его в .env / переменных окружения.")
-        ok = False
-    if not CHANNELS:
-        logger.error("CHANNELS_JSON не задан или пуст. Укажите словарь каналов в .env / переменных окружения.")
-        ok = False
-    return ok
 
-intents = discord.Intents.default()
-intents.messages = True
-intents.message_content = True
-bot = discord.Client(intents=intents)
-tree = app_commands.CommandTree(bot)
+class MediaKind(NamedTuple):
+    # Хеш содержимого; None для файла больше лимита загрузки
+    key: Optional[str]
+    format: str
+    size: int
+    # Метод Bot API для загрузки; None — файл больше лимита загрузки и не отправляется
+    method: Optional[str]
 
-message_mapping = {}
-start_time = None
 
 """
-Управление конфигурацией бота
-Хранение и загрузка ID целевого канала для пересылки сообщений
+Выбор метода Bot API по содержимому файла
+Тип определяется по сигнатуре (первые байты), а не по расширению: файлы без расширения,
+WebP, WebM и файлы с неверным расширением уходят нужным методом. Размеры и пропорции фото
+проверяются до загрузки; всё, что Telegram не примет как фото, анимацию или видео, сразу
+отправляется документом. Решение запоминается по хешу содержимого, а если Telegram всё же
+отклонил файл, для этого содержимого запоминается sendDocument.
 """
-class ConfigManager:
+class MediaClassifier:
+    FIELDS = {
+        'sendPhoto': 'photo',
+        'sendAnimation': 'animation',
+        'sendVideo': 'video',
+        'sendDocument': 'document',
+    }
+    # Ограничения Bot API: загрузка до 50 МБ, фото до 10 МБ, сумма сторон до 10000, пропорции до 1:20
+    UPLOAD_LIMIT = 50 * 1024 * 1024
+    PHOTO_LIMIT = 10 * 1024 * 1024
+    PHOTO_MAX_SIDES = 10000
+    PHOTO_MAX_RATIO = 20
+    HEAD_SIZE = 64 * 1024
+    CACHE_SIZE = 1024
+    # Основные бренды ISO-BMFF, которые Telegram принимает как видео; HEIC, AVIF, M4A, 3GP и прочие — документом
+    VIDEO_BRANDS = (b'isom', b'iso2', b'mp41', b'mp42', b'avc1', b'M4V ')
+    # Коды ошибок Bot API, которыми Telegram отклоняет сам загруженный файл
+    REJECTION_MARKERS = (
+        'PHOTO_INVALID_DIMENSIONS',
+        'PHOTO_SAVE_FILE_INVALID',
+        'PHOTO_EXT_INVALID',
+        'PHOTO_INVALID',
+        'IMAGE_PROCESS_FAILED',
+        'VIDEO_FILE_INVALID',
+        'VIDEO_CONTENT_TYPE_INVALID',
+    )
+
+    def __init__(self):
+        self._decisions: OrderedDict = OrderedDict()
+        # (путь, размер, mtime) -> хеш, чтобы не хешировать один файл для каждого чата заново
+        self._hashes: OrderedDict = OrderedDict()
+
     @staticmethod
-    def load_target_channel() -> Optional[int]:
-        if not os.path.exists(CONFIG_FILE):
-            try:
-                with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                    json.dump({'target_channel_id': None}, f, indent=2)
-            except Exception as e:
-                logger.warning(f"Не удалось создать файл конфигурации: {e}")
-            return None
-        try:
-            with open(CONFIG_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
-                return data.get('target_channel_id')
-        except json.JSONDecodeError as e:
-            logger.error(f"Ошибка чтения конфигурации: {e}")
-            return None
-        except Exception as e:
-            logger.error(f"Ошибка при загрузке конфигурации: {e}")
+    def sniff(head: bytes) -> str:
+        """Формат по сигнатуре: jpeg, png, gif, webp, webp-animated, mp4, mov, webm, avi или unknown"""
+        if head.startswith(b'\xff\xd8\xff'):
+            return 'jpeg'
+        if head.startswith(b'\x89PNG\r\n\x1a\n'):
+            return 'png'
+        if head[:6] in (b'GIF87a', b'GIF89a'):
+            return 'gif'
+        if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+            # Расширенный формат VP8X с флагом анимации
+            if head[12:16] == b'VP8X' and len(head) > 20 and head[20] & 0x02:
+                return 'webp-animated'
+            return 'webp'
+        if head[:4] == b'RIFF' and head[8:12] == b'AVI ':
+            return 'avi'
+        if head[4:8] == b'ftyp':
+            if head[8:12] == b'qt  ':
+                return 'mov'
+            if head[8:12] in MediaClassifier.VIDEO_BRANDS:
+                return 'mp4'
+        if head.startswith(b'\x1a\x45\xdf\xa3'):
+            return 'webm'
+        return 'unknown'
+
+    @staticmethod
+    def image_size(head: bytes, fmt: str) -> Optional[tuple]:
+        """(ширина, высота) из заголовка PNG, JPEG или WebP; None, если в начале файла их нет"""
+        if fmt == 'png' and len(head) >= 24:
+            return int.from_bytes(head[16:20], 'big'), int.from_bytes(head[20:24], 'big')
+        if fmt == 'webp' and len(head) >= 30:
+            chunk = head[12:16]
+            if chunk == b'VP8 ':
+                return int.from_bytes(head[26:28], 'little') & 0x3fff, int.from_bytes(head[28:30], 'little') & 0x3fff
+            if chunk == b'VP8L':
+                bits = int.from_bytes(head[21:25], 'little')
+                return (bits & 0x3fff) + 1, ((bits >> 14) & 0x3fff) + 1
+            if chunk == b'VP8X':
+                return int.from_bytes(head[24:27], 'little') + 1, int.from_bytes(head[27:30], 'little') + 1
+        if fmt == 'jpeg':
+            # Ищем маркер SOF среди сегментов заголовка
+            index = 2
+            while index + 9 < len(head):
+                if head[index] != 0xff:
+                    return None
+                marker = head[index + 1]
+                if 0xc0 <= marker <= 0xcf and marker not in (0xc4, 0xc8, 0xcc):
+                    height = int.from_bytes(head[index + 5:index + 7], 'big')
+                    width = int.from_bytes(head[index + 7:index + 9], 'big')
+                    return width, height
+                index += 2 + int.from_bytes(head[index + 2:index + 4], 'big')
+        return None
+
+    @staticmethod
+    def choose_method(fmt: str, size: int, dimensions: Optional[tuple]) -> Optional[str]:
+        if size > MediaClassifier.UPLOAD_LIMIT:
             return None
+        if fmt in ('jpeg', 'png', 'webp'):
+            if size > MediaClassifier.PHOTO_LIMIT:
+                return 'sendDocument'
+            if dimensions:
+                width, height = dimensions
+                if (
+                    not width or not height
+                    or width + height > MediaClassifier.PHOTO_MAX_SIDES
+                    or max(width, height) / min(width, height) > MediaClassifier.PHOTO_MAX_RATIO
+                ):
+                    return 'sendDocument'
+            return 'sendPhoto'
+        if fmt == 'gif':
+            return 'sendAnimation'
+        if fmt in ('mp4', 'mov'):
+            return 'sendVideo'
+        return 'sendDocument'
+
+    def _inspect(self, path: str) -> tuple:
+        """Хеш, формат, размер и стороны изображения; читает файл, поэтому вызывается в потоке"""
+        stat = os.stat(path)
+        memo = (path, stat.st_size, stat.st_mtime_ns)
+        with open(path, 'rb') as f:
+            head = f.read(self.HEAD_SIZE)
+            key = self._hashes.get(memo)
+            # Файл больше лимита загрузки не отправляется, хешировать его незачем
+            if key is None and stat.st_size <= self.UPLOAD_LIMIT:
+                f.seek(0)
+                key = hashlib.file_digest(f, 'sha256').hexdigest()
+        fmt = MediaClassifier.sniff(head)
+        return memo, key, fmt, stat.st_size, MediaClassifier.image_size(head, fmt)
+
+    def _remember(self, cache: OrderedDict, key, value) -> None:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > self.CACHE_SIZE:
+            cache.popitem(last=False)
+
+    async def classify(self, path: str) -> MediaKind:
+        memo, key, fmt, size, dimensions = await asyncio.to_thread(self._inspect, path)
+        if key is None:
+            return MediaKind(None, fmt, size, None)
+        self._remember(self._hashes, memo, key)
+        method = self._decisions.get(key)
+        if method is None:
+            method = MediaClassifier.choose_method(fmt, size, dimensions)
+        self._remember(self._decisions, key, method)
+        return MediaKind(key, fmt, size, method)
 
     @staticmethod
-    def save_target_channel(channel_id: int) -> bool:
-        try:
-            with open(CONFIG_FILE, 'w', encoding='utf-8') as f:
-                json.dump({'target_channel_id': channel_id}, f, indent=2)
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка сохранения конфигурации: {e}")
-            return False
+    def is_media_rejection(description: str) -> bool:
+        """
+        400 из-за самого файла (PHOTO_INVALID_DIMENSIONS, IMAGE_PROCESS_FAILED...), а не из-за текста,
+        прав или чата: "not enough rights to send photos" или "chat not found" документом не исправить
+        """
+        return any(marker in description for marker in MediaClassifier.REJECTION_MARKERS)
+
+    def demote(self, kind: MediaKind) -> None:
+        """Telegram отклонил файл выбранным методом: это содержимое дальше отправляется документом"""
+        self._remember(self._decisions, kind.key, 'sendDocument')
+
+
+media_classifier = MediaClassifier()
+
+
+class PreparedForward:
+    """Скачанные файлы и подготовленный контент сообщения перед отправкой"""
+    def __init__(self, scope: Optional[TempScope] = None):
+        self.scope = scope
+        self.files: List[discord.File] = []
+        self.saved_files: List[str] = []
+        self.media_file: Optional[str] = None
+        self.filtered_embeds: List[discord.Embed] = []
+        self.telegram_content: str = ""
+
+    def telegram_files(self) -> List[str]:
+        """Файлы для Telegram: сначала медиа из embed, затем вложения"""
+        files = []
+        if self.media_file and os.path.exists(self.media_file):
+            files.append(self.media_file)
+        files.extend(self.saved_files)
+        return files
 
 """
 Обработка сообщений: пересылка, редактирование, удаление
@@ -207,21 +2302,30 @@ class ConfigManager:
 """
 class MessageHandler:
     @staticmethod
-    async def download_gif(url: str, filename: str) -> Optional[str]:
-        try:
-            filepath = os.path.join(TRSH_DIR, filename)
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url) as resp:
-                    if resp.status == 200:
-                        with open(filepath, 'wb') as f:
-                            f.write(await resp.read())
-                        return filepath
-                    else:
-                        logger.error(f"Не удалось скачать файл: {url}, статус: {resp.status}")
-                        return None
-        except Exception as e:
-            logger.error(f"Ошибка при скачивании файла: {e}")
-            return None
+    async def download_gif(url: str, filepath: str) -> Optional[str]:
+        with span_tracer.span('media.download', url=url) as span:
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(url) as resp:
+                        span.set(status=resp.status)
+                        if resp.status == 200:
+                            data = await resp.read()
+                            span.set(bytes=len(data))
+                            await asyncio.to_thread(MessageHandler.write_file, filepath, data)
+                            return filepath
+                        else:
+                            logger.error("Не удалось скачать файл: %s, статус: %s", url, resp.status)
+                            span.fail(f"статус {resp.status}")
+                            return None
+            except Exception as e:
+                logger.error("Ошибка при скачивании файла: %s", e)
+                span.fail(e)
+                return None
+
+    @staticmethod
+    def write_file(filepath: str, data: bytes) -> None:
+        with open(filepath, 'wb') as f:
+            f.write(data)
 
     @staticmethod
     def extract_media_url(embeds: List[discord.Embed]) -> Optional[str]:
@@ -261,32 +2365,47 @@ class MessageHandler:
     
     @staticmethod
     async def extract_tenor_gif_url(page_url: str) -> Optional[str]:
-        try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'
-            }
-            async with aiohttp.ClientSession(headers=headers) as session:
-                async with session.get(page_url) as resp:
-                    if resp.status != 200:
-                        logger.error(f"Не удалось получить страницу Tenor: {page_url}, статус: {resp.status}")
-                        return None
-                    html = await resp.text()
-            soup = BeautifulSoup(html, 'html.parser')
-            meta = soup.find('meta', property='og:image')
-            content = meta.get('content') if isinstance(meta, Tag) and meta.has_attr('content') else None
-            if isinstance(content, str) and content.endswith('.gif'):
-                return content
-            for m in soup.find_all('meta'):
-                c = m.get('content') if isinstance(m, Tag) and m.has_attr('content') else None
-                if isinstance(c, str) and c.endswith('.gif'):
-                    return c
-            gif_links = re.findall(r'https?://[^\s"\']+\.gif', html)
-            if gif_links:
-                return gif_links[0]
-            return None
-        except Exception as e:
-            logger.error(f"Ошибка при парсинге Tenor: {e}")
-            return None
+        with span_tracer.span('tenor.scrape', url=page_url) as span:
+            try:
+                headers = {
+                    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36'
+                }
+                async with aiohttp.ClientSession(headers=headers) as session:
+                    async with session.get(page_url) as resp:
+                        span.set(status=resp.status)
+                        if resp.status != 200:
+                            logger.error("Не удалось получить страницу Tenor: %s, статус: %s", page_url, resp.status)
+                            span.fail(f"статус {resp.status}")
+                            return None
+                        html = await resp.text()
+                span.set(bytes=len(html))
+                # Разбор страницы занимает десятки миллисекунд, поэтому выполняется вне цикла событий
+                gif_url = await asyncio.to_thread(MessageHandler.find_tenor_gif_url, html)
+                span.set(found=gif_url is not None)
+                return gif_url
+            except Exception as e:
+                logger.error("Ошибка при парсинге Tenor: %s", e)
+                span.fail(e)
+                return None
+
+    @staticmethod
+    def find_tenor_gif_url(html: str) -> Optional[str]:
+        # bs4 нужен только для Tenor, поэтому импортируется при первом использовании
+        from bs4 import BeautifulSoup
+        from bs4.element import Tag
+        soup = BeautifulSoup(html, 'html.parser')
+        meta = soup.find('meta', property='og:image')
+        content = meta.get('content') if isinstance(meta, Tag) and meta.has_attr('content') else None
+        if isinstance(content, str) and content.endswith('.gif'):
+            return content
+        for m in soup.find_all('meta'):
+            c = m.get('content') if isinstance(m, Tag) and m.has_attr('content') else None
+            if isinstance(c, str) and c.endswith('.gif'):
+                return c
+        gif_links = re.findall(r'https?://[^\s"\']+\.gif', html)
+        if gif_links:
+            return gif_links[0]
+        return None
 
     @staticmethod
     def is_tenor_url(url: str) -> bool:
@@ -365,46 +2484,82 @@ class MessageHandler:
         5. Отправка в Telegram с форматированием и ссылкой на канал
         6. Сохранение маппинга для последующего редактирования/удаления
         """
-        global message_mapping
         try:
-            # Сохранение файлов из attachments
-            os.makedirs(TRSH_DIR, exist_ok=True)
-            saved_files = []  # Пути к сохраненным файлам для Telegram
-            files = []
-            for attachment in message.attachments:
-                # Создаем Discord.File для отправки в Discord
-                files.append(await attachment.to_file())
-                # Сохраняем файл для Telegram
+            with span_tracer.span(
+                'forward',
+                source_id=message.id,
+                attachments=len(message.attachments),
+                embeds=len(message.embeds)
+            ), temp_storage.scope(message.id) as scope:
+                prepared = await MessageHandler.prepare_forward(message, scope)
+                return await MessageHandler.deliver_forward(message, prepared, target_channel)
+        except Exception as e:
+            logger.error("Ошибка при перенаправлении сообщения %s: %s", message.id, e)
+            if is_permanent_forward_error(e):
+                forward_progress.reject(message.id, e)
+            return None
+
+    @staticmethod
+    async def prepare_forward(message: discord.Message, scope: TempScope) -> 'PreparedForward':
+        """
+        Скачивает вложения и медиа из embeds в каталог сообщения
+        Не отправляет ничего наружу, поэтому может выполняться параллельно для нескольких сообщений
+        """
+        # Сохранение файлов из attachments: одна загрузка на вложение, файл используется и Discord, и Telegram
+        prepared = PreparedForward(scope)
+        for attachment in message.attachments:
+            file_path = scope.path(attachment.filename)
+            with span_tracer.span('discord.attachment', filename=attachment.filename, bytes=attachment.size) as span:
                 try:
-                    file_path = os.path.join(TRSH_DIR, attachment.filename)
                     await attachment.save(file_path)
-                    saved_files.append(file_path)
                 except Exception as e:
-                    logger.warning(f"Не удалось сохранить файл {attachment.filename} для Telegram: {e}")
-            
-            media_url = MessageHandler.extract_media_url(message.embeds)
-            media_file = None
-            gif_url = None
-            # Если это Tenor — парсим страницу для .gif
-            if media_url and MessageHandler.is_tenor_url(media_url):
-                gif_url = await MessageHandler.extract_tenor_gif_url(media_url)
-            # Если нашли .gif — скачиваем и добавляем к файлам
-            if gif_url:
-                filename = gif_url.split("/")[-1].split("?")[0] or f"{message.id}.gif"
-                gif_path = await MessageHandler.download_gif(gif_url, filename)
-                if gif_path:
-                    files.append(discord.File(gif_path, filename=filename))
-                    media_file = gif_path
-            # Если не нашли .gif — fallback на обычную медиа-ссылку
-            elif media_url:
-                filename = media_url.split("/")[-1].split("?")[0] or f"{message.id}.media"
-                media_path = await MessageHandler.download_gif(media_url, filename)
-                if media_path:
-                    files.append(discord.File(media_path, filename=filename))
-                    media_file = media_path
-            filtered_embeds = MessageHandler.filter_embeds(message.embeds)
-            telegram_content = MessageHandler.convert_discord_to_telegram_html(message.content)
-            
+                    logger.warning("Не удалось сохранить файл %s для Telegram: %s", attachment.filename, e)
+                    span.fail(e)
+                    prepared.files.append(await attachment.to_file())
+                    continue
+            prepared.saved_files.append(file_path)
+            prepared.files.append(discord.File(
+                file_path,
+                filename=attachment.filename,
+                spoiler=attachment.is_spoiler(),
+                description=attachment.description
+            ))
+
+        media_url = MessageHandler.extract_media_url(message.embeds)
+        gif_url = None
+        # Если это Tenor — парсим страницу для .gif
+        if media_url and MessageHandler.is_tenor_url(media_url):
+            gif_url = await MessageHandler.extract_tenor_gif_url(media_url)
+        # Если нашли .gif — скачиваем и добавляем к файлам
+        if gif_url:
+            filename = gif_url.split("/")[-1].split("?")[0] or f"{message.id}.gif"
+            gif_path = await MessageHandler.download_gif(gif_url, scope.path(filename))
+            if gif_path:
+                prepared.files.append(discord.File(gif_path, filename=filename))
+                prepared.media_file = gif_path
+        # Если не нашли .gif — fallback на обычную медиа-ссылку
+        elif media_url:
+            filename = media_url.split("/")[-1].split("?")[0] or f"{message.id}.media"
+            media_path = await MessageHandler.download_gif(media_url, scope.path(filename))
+            if media_path:
+                prepared.files.append(discord.File(media_path, filename=filename))
+                prepared.media_file = media_path
+        prepared.filtered_embeds = MessageHandler.filter_embeds(message.embeds)
+        prepared.telegram_content = MessageHandler.convert_discord_to_telegram_html(message.content)
+        return prepared
+
+    @staticmethod
+    async def deliver_forward(
+        message: discord.Message,
+        prepared: 'PreparedForward',
+        target_channel: discord.TextChannel
+    ) -> Optional[discord.Message]:
+        """Отправляет подготовленное сообщение в Discord и Telegram и сохраняет маппинг"""
+        files = prepared.files
+        filtered_embeds = prepared.filtered_embeds
+        telegram_content = prepared.telegram_content
+
+        with span_tracer.span('discord.send', files=len(files), embeds=len(filtered_embeds)):
             sent_message = await target_channel.send(
                 content=message.content,
                 files=files,
@@ -412,78 +2567,176 @@ class MessageHandler:
                 stickers=message.stickers,
                 suppress_embeds=True
             )
-            
-            # Отправка сообщения в Telegram
-            # Подготавливаем файлы и форматируем текст с ссылкой на исходный канал
-            telegram_message_id = None
-            has_media = False
-            telegram_bot_token = os.getenv('TELEGRAM_TOKEN')
-            telegram_chat_id = os.getenv('TELEGRAM_GROUP_ID')
-            
-            if telegram_bot_token and telegram_chat_id:
-                telegram_files = []
-                if media_file and os.path.exists(media_file):
-                    telegram_files.append(media_file)
-                if saved_files:
-                    telegram_files.extend(saved_files)
-                
-                telegram_text = telegram_content if telegram_content else message.content
-                if not telegram_text and filtered_embeds:
-                    telegram_text = filtered_embeds[0].description or filtered_embeds[0].title or ""
-                
-                # Добавляем ссылку на исходный канал в начало сообщения
-                channel_name = None
-                for name, channel_id in CHANNELS.items():
-                    if channel_id == target_channel.id:
-                        channel_name = name.upper()
-                        break
-                
-                if channel_name:
-                    guild_id = target_channel.guild.id
-                    channel_url = f"https://discord.com/channels/{guild_id}/{target_channel.id}"
-                    channel_link = f'<a href="{channel_url}">Канал {channel_name}</a>\n\n'
-                    telegram_text = channel_link + (telegram_text if telegram_text else "")
-                
-                telegram_message_id = await MessageHandler.send_telegram_message(
-                    telegram_bot_token,
-                    telegram_chat_id,
-                    telegram_text,
-                    parse_mode='HTML',
-                    files=telegram_files if telegram_files else None
-                )
-                
-                has_media = bool(telegram_files)
-                
-                # Очистка временных файлов
-                for temp_file in telegram_files:
-                    if os.path.exists(temp_file) and temp_file != media_file:
-                        try:
-                            os.remove(temp_file)
-                        except Exception as e:
-                            logger.warning(f"Не удалось удалить временный файл: {e}")
-            
-            for saved_file in saved_files:
-                if os.path.exists(saved_file) and saved_file not in (telegram_files if telegram_bot_token and telegram_chat_id else []):
-                    try:
-                        os.remove(saved_file)
-                    except Exception as e:
-                        logger.warning(f"Не удалось удалить временный файл: {e}")
-            
-            message_mapping[message.id] = {
-                'discord': sent_message.id,
-                'telegram': telegram_message_id,
-                'has_media': has_media
-            }
-            
-            if media_file and os.path.exists(media_file):
+
+        # Отправка сообщения в Telegram
+        # Подготавливаем файлы и форматируем текст с ссылкой на исходный канал
+        has_media = False
+        telegram_bot_token = os.getenv('TELEGRAM_TOKEN')
+        targets = telegram_targets()
+
+        if telegram_bot_token and targets:
+            telegram_files = prepared.telegram_files()
+
+            telegram_text = telegram_content if telegram_content else message.content
+            if not telegram_text and filtered_embeds:
+                telegram_text = filtered_embeds[0].description or filtered_embeds[0].title or ""
+            telegram_text = MessageHandler.telegram_text(telegram_text, target_channel)
+
+            has_media = bool(telegram_files)
+
+        entry = {
+            'discord': sent_message.id,
+            'telegram': {},
+            'has_media': has_media,
+            'edited_at': message.edited_at.timestamp() if message.edited_at else None
+        }
+        if telegram_bot_token and targets:
+            # Актуальный текст для Telegram: правка, пришедшая до отправки, заменит его здесь
+            entry['text'] = telegram_text
+        remember_mapping(message.id, entry)
+
+        if telegram_bot_token and targets:
+            await MessageHandler.submit_forward_to_telegram(
+                message.id, telegram_bot_token, targets, telegram_text, telegram_files, prepared.scope
+            )
+        return sent_message
+
+    @staticmethod
+    def telegram_text(content: Optional[str], target_channel: discord.TextChannel) -> str:
+        """Текст для Telegram: ссылка на канал-назначение (если он есть в CHANNELS) и содержимое"""
+        channel_name = None
+        for name, channel_id in CHANNELS.items():
+            if channel_id == target_channel.id:
+                channel_name = name.upper()
+                break
+
+        if not channel_name:
+            return content or ""
+        guild_id = target_channel.guild.id
+        channel_url = f"https://discord.com/channels/{guild_id}/{target_channel.id}"
+        channel_link = f'<a href="{channel_url}">Канал {channel_name}</a>\n\n'
+        return channel_link + (content or "")
+
+    @staticmethod
+    async def submit_forward_to_telegram(
+        source_id: int,
+        telegram_bot_token: str,
+        targets: tuple,
+        text: str,
+        files: List[str],
+        scope: Optional[TempScope]
+    ):
+        """Ставит отправку в Telegram в планировщик и ждёт её (или откладывания)"""
+        # Файлы нужны Telegram-задаче и после выхода из with: при отложенной отправке
+        # каталог удалит сама задача
+        scope = scope.detach() if scope else None
+        return await telegram_scheduler.submit(TelegramJob(
+            f"отправка {source_id}",
+            lambda: MessageHandler.send_forward_to_telegram(source_id, telegram_bot_token, targets, text, files),
+            lane=TelegramJob.LANE_MEDIA if files else TelegramJob.LANE_TEXT,
+            cleanup=scope.close if scope else None,
+            spec={'op': 'send', 'source_id': source_id, 'text': text}
+        ))
+
+    @staticmethod
+    async def send_forward_to_telegram(
+        source_id: int,
+        telegram_bot_token: str,
+        targets: tuple,
+        text: str,
+        files: List[str]
+    ) -> dict:
+        """
+        Отправляет пересланное сообщение во все чаты Telegram и дописывает их ID в маппинг
+        Медиа загружается один раз, остальные чаты получают его по file_id параллельно
+        Чаты, куда сообщение уже ушло (например, до обрыва связи), повторно не отправляются
+        Если исходное сообщение удалили, пока задача ждала, отправка не выполняется
+        Текст берётся из маппинга на момент отправки, чтобы не потерять правки, пришедшие раньше неё
+        """
+        entry = message_mapping.get(source_id)
+        if not isinstance(entry, dict):
+            return {}
+        text = entry.get('text', text)
+        delivered = telegram_message_ids(entry)
+        pending = [target for target in targets if target.key not in delivered]
+        if not pending:
+            return delivered
+
+        sent_ids = {}
+        media = None
+        text_only = False
+        unavailable = None
+        if files:
+            # Загружаем в первый чат, пока не получим file_id (если чат отклонил файл — пробуем следующий)
+            while pending and media is None:
+                target = pending.pop(0)
                 try:
-                    os.remove(media_file)
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении временного файла: {e}")
-            return sent_message
-        except Exception as e:
-            logger.error(f"Ошибка при перенаправлении сообщения {message.id}: {e}")
-            return None
+                    sent = await MessageHandler.post_telegram_message(
+                        telegram_bot_token, target.chat_id, text, files=files, message_thread_id=target.thread_id
+                    )
+                except TelegramUnavailable as e:
+                    unavailable = e
+                    pending = []
+                    break
+                if not sent:
+                    continue
+                sent_ids[target.key] = sent.get('message_id')
+                media = MessageHandler.extract_media(sent)
+                if media is None:
+                    # Файл не загрузился (например, больше лимита Bot API) и ушёл только текст
+                    text_only = True
+                    break
+
+        if pending:
+            results = await asyncio.gather(
+                *(
+                    MessageHandler.post_telegram_message(
+                        telegram_bot_token,
+                        target.chat_id,
+                        text,
+                        files=None if media else files,
+                        message_thread_id=target.thread_id,
+                        media=media
+                    )
+                    for target in pending
+                ),
+                return_exceptions=True
+            )
+            for target, sent in zip(pending, results):
+                if isinstance(sent, TelegramUnavailable):
+                    unavailable = sent
+                elif isinstance(sent, BaseException):
+                    logger.error("Ошибка отправки в Telegram-чат %s: %s", target.key, sent)
+                elif sent:
+                    sent_ids[target.key] = sent.get('message_id')
+
+        entry = message_mapping.get(source_id)
+        if entry is None:
+            # Исходное сообщение удалили во время загрузки — убираем и копии
+            await asyncio.gather(*(
+                MessageHandler.delete_telegram_message(telegram_bot_token, telegram_chat_id_from_key(key), message_id)
+                for key, message_id in sent_ids.items() if message_id
+            ), return_exceptions=True)
+            return {}
+        if sent_ids and isinstance(entry, dict):
+            entry['telegram'] = {**telegram_message_ids(entry), **sent_ids}
+            if text_only:
+                # Правки такого сообщения идут через editMessageText, а не editMessageCaption
+                entry['has_media'] = False
+            remember_mapping(source_id, entry)
+            latest = entry.get('text', text)
+            if latest != text:
+                # Правка пришла во время загрузки и не застала ID в маппинге — применяем её сами
+                try:
+                    await MessageHandler.edit_forward_in_telegram(
+                        telegram_bot_token, sent_ids, latest, entry.get('has_media', False)
+                    )
+                except TelegramUnavailable as e:
+                    logger.warning("Не удалось применить правку %s к новой копии в Telegram: %s", source_id, e)
+        if unavailable is not None:
+            # Доставленное уже записано в маппинг, при повторе задача отправит только оставшиеся чаты
+            raise unavailable
+        return telegram_message_ids(entry)
 
     @staticmethod
     async def edit_forwarded_message(
@@ -495,154 +2748,279 @@ class MessageHandler:
         """
         global message_mapping
         try:
-            message_map = message_mapping.get(original_message.id)
-            if not message_map:
-                logger.warning(f"Нет маппинга для редактирования: {original_message.id}")
-                return False
+            with span_tracer.span('edit', source_id=original_message.id) as span:
+                async with forward_dedup.ordered(original_message.id):
+                    message_map = await lookup_mapping(original_message.id)
+                    if not message_map:
+                        logger.warning("Нет маппинга для редактирования: %s", original_message.id)
+                        span.fail("нет маппинга")
+                        return False
             
-            forwarded_message_id = message_map.get('discord') if isinstance(message_map, dict) else message_map
-            if not forwarded_message_id:
-                logger.warning(f"Нет Discord ID для редактирования: {original_message.id}")
-                return False
+                    forwarded_message_id = message_map.get('discord') if isinstance(message_map, dict) else message_map
+                    if not forwarded_message_id:
+                        logger.warning("Нет Discord ID для редактирования: %s", original_message.id)
+                        return False
             
-            try:
-                sent_message = await target_channel.fetch_message(forwarded_message_id)
-            except discord.NotFound:
-                logger.warning(f"Сообщение {forwarded_message_id} не найдено, удаляем из маппинга")
-                message_mapping.pop(original_message.id, None)
-                return False
+                    with span_tracer.span('discord.edit', discord_id=forwarded_message_id) as discord_span:
+                        try:
+                            sent_message = await target_channel.fetch_message(forwarded_message_id)
+                        except discord.NotFound:
+                            logger.warning("Сообщение %s не найдено, удаляем из маппинга", forwarded_message_id)
+                            discord_span.fail("сообщение не найдено")
+                            forget_mapping(original_message.id)
+                            return False
             
-            filtered_embeds = MessageHandler.filter_embeds(original_message.embeds)
-            await sent_message.edit(
-                content=original_message.content,
-                embeds=filtered_embeds
-            )
+                        filtered_embeds = MessageHandler.filter_embeds(original_message.embeds)
+                        await sent_message.edit(
+                            content=original_message.content,
+                            embeds=filtered_embeds
+                        )
             
-            # Редактирование в Telegram
-            telegram_message_id = message_map.get('telegram') if isinstance(message_map, dict) else None
-            has_media = message_map.get('has_media', False) if isinstance(message_map, dict) else False
-            if telegram_message_id:
-                telegram_bot_token = os.getenv('TELEGRAM_TOKEN')
-                telegram_chat_id = os.getenv('TELEGRAM_GROUP_ID')
-                if telegram_bot_token and telegram_chat_id:
-                    telegram_content = MessageHandler.convert_discord_to_telegram_html(original_message.content)
-                    
-                    channel_name = None
-                    for name, channel_id in CHANNELS.items():
-                        if channel_id == target_channel.id:
-                            channel_name = name.upper()
-                            break
-                    
-                    if channel_name:
-                        guild_id = target_channel.guild.id
-                        channel_url = f"https://discord.com/channels/{guild_id}/{target_channel.id}"
-                        channel_link = f'<a href="{channel_url}">Канал {channel_name}</a>\n\n'
-                        telegram_text = channel_link + (telegram_content if telegram_content else "")
-                    else:
-                        telegram_text = telegram_content if telegram_content else ""
-                    
-                    result = await MessageHandler.edit_telegram_message(
-                        telegram_bot_token,
-                        telegram_chat_id,
-                        telegram_message_id,
-                        telegram_text,
-                        has_media=has_media
+                    # Редактирование в Telegram
+                    telegram_bot_token = os.getenv('TELEGRAM_TOKEN')
+                    telegram_text = MessageHandler.telegram_text(
+                        MessageHandler.convert_discord_to_telegram_html(original_message.content), target_channel
                     )
-                    if not result:
-                        logger.warning(f"Не удалось отредактировать сообщение в Telegram: {telegram_message_id}")
+                    if isinstance(message_map, dict) and telegram_bot_token:
+                        # Если отправка в Telegram ещё в очереди, она возьмёт этот текст из маппинга
+                        message_map['text'] = telegram_text
+                        remember_mapping(original_message.id, message_map)
+                    telegram_ids = telegram_message_ids(message_map)
+                    has_media = message_map.get('has_media', False) if isinstance(message_map, dict) else False
+                    if telegram_ids:
+                        if telegram_bot_token:
+                            await telegram_scheduler.submit(TelegramJob(
+                                f"правка {original_message.id}",
+                                lambda: MessageHandler.edit_forward_in_telegram(
+                                    telegram_bot_token,
+                                    telegram_ids,
+                                    telegram_text,
+                                    has_media
+                                ),
+                                lane=TelegramJob.LANE_EDIT,
+                                spec={
+                                    'op': 'edit',
+                                    'source_id': original_message.id,
+                                    'telegram_ids': telegram_ids,
+                                    'text': telegram_text,
+                                    'has_media': has_media,
+                                }
+                            ))
             
-            return True
+                    if isinstance(message_map, dict) and original_message.edited_at:
+                        message_map['edited_at'] = original_message.edited_at.timestamp()
+                        remember_mapping(original_message.id, message_map)
+                    return True
         except Exception as e:
-            logger.error(f"Ошибка при редактировании сообщения {original_message.id}: {e}")
+            logger.error("Ошибка при редактировании сообщения %s: %s", original_message.id, e)
             return False
 
+    @staticmethod
+    async def edit_forward_in_telegram(
+        telegram_bot_token: str,
+        telegram_ids: dict,
+        text: str,
+        has_media: bool
+    ) -> bool:
+        """Редактирует все копии сообщения в чатах Telegram параллельно"""
+        keys = list(telegram_ids)
+        results = await asyncio.gather(*(
+            MessageHandler.edit_telegram_message(
+                telegram_bot_token,
+                telegram_chat_id_from_key(key),
+                telegram_ids[key],
+                text,
+                has_media=has_media
+            )
+            for key in keys
+        ), return_exceptions=True)
+        ok = True
+        for key, result in zip(keys, results):
+            if isinstance(result, TelegramUnavailable):
+                raise result
+            if result is not True:
+                logger.warning("Не удалось отредактировать сообщение в Telegram: %s (%s)", telegram_ids[key], key)
+                ok = False
+        return ok
+
+    @staticmethod
+    async def delete_forward_in_telegram(telegram_bot_token: str, telegram_ids: dict) -> bool:
+        """Удаляет все копии сообщения в чатах Telegram параллельно"""
+        results = await asyncio.gather(*(
+            MessageHandler.delete_telegram_message(telegram_bot_token, telegram_chat_id_from_key(key), message_id)
+            for key, message_id in telegram_ids.items()
+        ), return_exceptions=True)
+        for result in results:
+            if isinstance(result, TelegramUnavailable):
+                raise result
+        return all(result is True for result in results)
+
+    @staticmethod
+    def extract_media(sent: dict) -> Optional[tuple]:
+        """
+        (method, field_name, file_id) загруженного медиа из ответа Telegram для повторной отправки
+        без загрузки; метод берётся по тому, как Telegram сохранил файл (GIF приходит как animation)
+        """
+        photo = sent.get('photo')
+        if isinstance(photo, list) and photo and photo[-1].get('file_id'):
+            return 'sendPhoto', 'photo', photo[-1]['file_id']
+        for method in ('sendAnimation', 'sendVideo', 'sendDocument'):
+            field_name = MediaClassifier.FIELDS[method]
+            if isinstance(sent.get(field_name), dict) and sent[field_name].get('file_id'):
+                return method, field_name, sent[field_name]['file_id']
+        return None
+
     @staticmethod
     async def send_telegram_message(
         telegram_bot_token: str, 
         chat_id: str, 
         text: str, 
         parse_mode: str = 'HTML',
-        files: Optional[List] = None
+        files: Optional[List] = None,
+        message_thread_id: Optional[int] = None
     ) -> Optional[int]:
         """
         Отправляет сообщение в Telegram через Bot API
         Поддерживает отправку медиа-файлов (фото, видео, GIF, документы)
         Возвращает message_id или None при ошибке
         """
-        try:
-            if files and len(files) > 0:
-                file_path = files[0] if isinstance(files[0], str) else None
-                if file_path and os.path.exists(file_path):
-                    file_ext = os.path.splitext(file_path)[1].lower()
-                    if file_ext == '.gif':
-                        method = 'sendAnimation'
-                        field_name = 'animation'
-                    elif file_ext in ['.jpg', '.jpeg', '.png']:
-                        method = 'sendPhoto'
-                        field_name = 'photo'
-                    elif file_ext in ['.mp4', '.mov', '.avi']:
-                        method = 'sendVideo'
-                        field_name = 'video'
-                    else:
-                        method = 'sendDocument'
-                        field_name = 'document'
-                    
-                    url = f"https://api.telegram.org/bot{telegram_bot_token}/{method}"
-                    
-                    with open(file_path, 'rb') as f:
-                        form_data = aiohttp.FormData()
-                        form_data.add_field('chat_id', chat_id)
-                        form_data.add_field('disable_web_page_preview', 'true')
-                        if text:
-                            form_data.add_field('caption', text)
-                            form_data.add_field('parse_mode', parse_mode)
-                        form_data.add_field(field_name, f, filename=os.path.basename(file_path))
-                        
-                        async with aiohttp.ClientSession() as session:
-                            async with session.post(url, data=form_data) as resp:
-                                if resp.status == 200:
-                                    result = await resp.json()
-                                    if result.get('ok'):
-                                        return result.get('result', {}).get('message_id')
-                                    else:
-                                        logger.error(f"Ошибка отправки файла в Telegram: {result.get('description', 'Unknown error')}")
-                                        return None
-                                else:
-                                    logger.error(f"Ошибка при отправке файла в Telegram: статус {resp.status}")
-                                    return None
+        sent = await MessageHandler.post_telegram_message(
+            telegram_bot_token, chat_id, text, parse_mode, files, message_thread_id
+        )
+        return sent.get('message_id') if sent else None
+
+    @staticmethod
+    async def post_telegram_message(
+        telegram_bot_token: str,
+        chat_id: str,
+        text: str,
+        parse_mode: str = 'HTML',
+        files: Optional[List] = None,
+        message_thread_id: Optional[int] = None,
+        media: Optional[tuple] = None
+    ) -> Optional[dict]:
+        """
+        Отправляет сообщение в Telegram и возвращает объект Message из ответа API
+        media=(method, field_name, file_id) отправляет уже загруженный файл по file_id,
+        без повторной загрузки тела файла
+        """
+        with span_tracer.span('telegram.send', chat=chat_id) as span:
+            try:
+                if media:
+                    method, field_name, file_id = media
+                    span.set(method=method, file_id=True)
+                    data = {
+                        'chat_id': chat_id,
+                        field_name: file_id,
+                    }
+                    if text:
+                        data['caption'] = text
+                        data['parse_mode'] = parse_mode
+                    if message_thread_id:
+                        data['message_thread_id'] = message_thread_id
+                    status, result = await telegram_client.request(telegram_bot_token, method, data)
+                    if status == 200 and result.get('ok'):
+                        return result.get('result', {})
+                    logger.error("Ошибка отправки файла по file_id в Telegram: статус %s, %s", status, result.get('description', 'Unknown error'))
+                    span.fail(result.get('description') or f"статус {status}")
+                    return None
+
+                if files and len(files) > 0:
+                    file_path = files[0] if isinstance(files[0], str) else None
+                    kind = await media_classifier.classify(file_path) if file_path and os.path.exists(file_path) else None
+                    if kind is not None and kind.method is None:
+                        logger.warning(
+                            "Файл %s (%s МБ) больше лимита загрузки Telegram, отправляется только текст",
+                            os.path.basename(file_path), kind.size // (1024 * 1024)
+                        )
+                        span.set(filename=os.path.basename(file_path), bytes=kind.size, skipped_file=True)
+                    elif kind is not None:
+                        method = kind.method
+                        span.set(filename=os.path.basename(file_path), bytes=kind.size, format=kind.format)
+                        rate_limited = 0
+                        while True:
+                            span.set(method=method)
+                            with open(file_path, 'rb') as f:
+                                form_data = aiohttp.FormData()
+                                form_data.add_field('chat_id', chat_id)
+                                form_data.add_field('disable_web_page_preview', 'true')
+                                if message_thread_id:
+                                    form_data.add_field('message_thread_id', str(message_thread_id))
+                                if text:
+                                    form_data.add_field('caption', text)
+                                    form_data.add_field('parse_mode', parse_mode)
+                                form_data.add_field(MediaClassifier.FIELDS[method], f, filename=os.path.basename(file_path))
+
+                                status, result = await telegram_client.request(telegram_bot_token, method, form=form_data)
+                            # 429: клиент multipart-форму не повторяет, форма собирается заново на следующем круге
+                            retry_after = (result.get('parameters') or {}).get('retry_after')
+                            if status == 429 and retry_after and rate_limited < TelegramClient.MAX_RATE_LIMIT_RETRIES:
+                                rate_limited += 1
+                                logger.warning("Telegram rate limit на %s, повтор загрузки через %s с", method, retry_after)
+                                await asyncio.sleep(retry_after)
+                                continue
+                            if (
+                                status != 400 or method == 'sendDocument'
+                                or not MediaClassifier.is_media_rejection(result.get('description', ''))
+                            ):
+                                break
+                            # Telegram не принял файл как медиа: повторяем документом и запоминаем это
+                            logger.warning(
+                                "Telegram отклонил %s через %s (%s), повтор через sendDocument",
+                                os.path.basename(file_path), method, result.get('description', 'Unknown error')
+                            )
+                            media_classifier.demote(kind)
+                            method = 'sendDocument'
+                        if status == 200:
+                            if result.get('ok'):
+                                return result.get('result', {})
+                            else:
+                                logger.error("Ошибка отправки файла в Telegram: %s", result.get('description', 'Unknown error'))
+                                span.fail(result.get('description', 'Unknown error'))
+                                return None
+                        else:
+                            logger.error("Ошибка при отправке файла в Telegram: статус %s", status)
+                            span.fail(f"статус {status}")
+                            return None
             
-            if not text:
-                logger.warning("Пустой текст для отправки в Telegram и нет файлов")
-                return None
+                if not text:
+                    logger.warning("Пустой текст для отправки в Telegram и нет файлов")
+                    span.fail("пустой текст и нет файлов")
+                    return None
                 
-            url = f"https://api.telegram.org/bot{telegram_bot_token}/sendMessage"
-            data = {
-                'chat_id': chat_id,
-                'text': text,
-                'parse_mode': parse_mode,
-                'disable_web_page_preview': True
-            }
+                data = {
+                    'chat_id': chat_id,
+                    'text': text,
+                    'parse_mode': parse_mode,
+                    'disable_web_page_preview': True
+                }
+                if message_thread_id:
+                    data['message_thread_id'] = message_thread_id
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        if result.get('ok'):
-                            return result.get('result', {}).get('message_id')
-                        else:
-                            logger.error(f"Ошибка отправки сообщения в Telegram: {result.get('description', 'Unknown error')}")
-                            return None
+                span.set(method='sendMessage', text_length=len(text))
+                status, result = await telegram_client.request(telegram_bot_token, 'sendMessage', data)
+                if status == 200:
+                    if result.get('ok'):
+                        return result.get('result', {})
                     else:
-                        try:
-                            error_result = await resp.json()
-                            error_desc = error_result.get('description', 'Unknown error')
-                            logger.error(f"Ошибка при отправке сообщения в Telegram: статус {resp.status}, описание: {error_desc}")
-                        except:
-                            logger.error(f"Ошибка при отправке сообщения в Telegram: статус {resp.status}")
+                        logger.error("Ошибка отправки сообщения в Telegram: %s", result.get('description', 'Unknown error'))
+                        span.fail(result.get('description', 'Unknown error'))
                         return None
-        except Exception as e:
-            logger.error(f"Ошибка при отправке сообщения в Telegram: {e}")
-            return None
+                else:
+                    error_desc = result.get('description')
+                    if error_desc:
+                        logger.error("Ошибка при отправке сообщения в Telegram: статус %s, описание: %s", status, error_desc)
+                        span.fail(f"статус {status}: {error_desc}")
+                    else:
+                        logger.error("Ошибка при отправке сообщения в Telegram: статус %s", status)
+                        span.fail(f"статус {status}")
+                    return None
+            except TelegramUnavailable:
+                raise
+            except Exception as e:
+                logger.error("Ошибка при отправке сообщения в Telegram: %s", e)
+                span.fail(e)
+                return None
 
     @staticmethod
     async def edit_telegram_message(
@@ -657,42 +3035,46 @@ class MessageHandler:
         Редактирует сообщение в Telegram
         Для сообщений с медиа использует editMessageCaption, для текстовых - editMessageText
         """
-        try:
-            if has_media:
-                url = f"https://api.telegram.org/bot{telegram_bot_token}/editMessageCaption"
-                data = {
-                    'chat_id': chat_id,
-                    'message_id': message_id,
-                    'parse_mode': parse_mode,
-                    'disable_web_page_preview': True
-                }
-                if text:
-                    data['caption'] = text
-            else:
-                url = f"https://api.telegram.org/bot{telegram_bot_token}/editMessageText"
-                data = {
-                    'chat_id': chat_id,
-                    'message_id': message_id,
-                    'text': text if text else ' ',
-                    'parse_mode': parse_mode,
-                    'disable_web_page_preview': True
-                }
+        with span_tracer.span('telegram.edit', chat=chat_id, has_media=has_media) as span:
+            try:
+                if has_media:
+                    method = 'editMessageCaption'
+                    data = {
+                        'chat_id': chat_id,
+                        'message_id': message_id,
+                        'parse_mode': parse_mode,
+                        'disable_web_page_preview': True
+                    }
+                    if text:
+                        data['caption'] = text
+                else:
+                    method = 'editMessageText'
+                    data = {
+                        'chat_id': chat_id,
+                        'message_id': message_id,
+                        'text': text if text else ' ',
+                        'parse_mode': parse_mode,
+                        'disable_web_page_preview': True
+                    }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        if result.get('ok'):
-                            return True
-                        else:
-                            logger.warning(f"Не удалось отредактировать сообщение в Telegram: {result.get('description', 'Unknown error')}")
-                            return False
+                status, result = await telegram_client.request(telegram_bot_token, method, data)
+                if status == 200:
+                    if result.get('ok'):
+                        return True
                     else:
-                        logger.warning(f"Ошибка при редактировании сообщения в Telegram: статус {resp.status}")
+                        logger.warning("Не удалось отредактировать сообщение в Telegram: %s", result.get('description', 'Unknown error'))
+                        span.fail(result.get('description', 'Unknown error'))
                         return False
-        except Exception as e:
-            logger.error(f"Ошибка при редактировании сообщения в Telegram: {e}")
-            return False
+                else:
+                    logger.warning("Ошибка при редактировании сообщения в Telegram: статус %s", status)
+                    span.fail(f"статус {status}")
+                    return False
+            except TelegramUnavailable:
+                raise
+            except Exception as e:
+                logger.error("Ошибка при редактировании сообщения в Telegram: %s", e)
+                span.fail(e)
+                return False
 
     @staticmethod
     async def unpin_telegram_message(telegram_bot_token: str, chat_id: str, message_id: int) -> bool:
@@ -701,45 +3083,45 @@ class MessageHandler:
         Возвращает True даже если сообщение не было закреплено
         """
         try:
-            url = f"https://api.telegram.org/bot{telegram_bot_token}/unpinChatMessage"
             data = {
                 'chat_id': chat_id,
                 'message_id': message_id
             }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        return result.get('ok', True)
-                    return True
+            status, result = await telegram_client.request(telegram_bot_token, 'unpinChatMessage', data)
+            if status == 200:
+                return result.get('ok', True)
+            return True
         except Exception as e:
-            logger.debug(f"Ошибка при откреплении сообщения в Telegram: {e}")
+            logger.debug("Ошибка при откреплении сообщения в Telegram: %s", e)
             return True
 
     @staticmethod
     async def delete_telegram_message(telegram_bot_token: str, chat_id: str, message_id: int) -> bool:
         """Удаляет сообщение в Telegram через API"""
-        try:
-            url = f"https://api.telegram.org/bot{telegram_bot_token}/deleteMessage"
-            data = {
-                'chat_id': chat_id,
-                'message_id': message_id
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, json=data) as resp:
-                    if resp.status == 200:
-                        result = await resp.json()
-                        if result.get('ok'):
-                            return True
-                        else:
-                            logger.warning(f"Не удалось удалить сообщение в Telegram: {result.get('description', 'Unknown error')}")
-                            return False
+        with span_tracer.span('telegram.delete', chat=chat_id) as span:
+            try:
+                data = {
+                    'chat_id': chat_id,
+                    'message_id': message_id
+                }
+                status, result = await telegram_client.request(telegram_bot_token, 'deleteMessage', data)
+                if status == 200:
+                    if result.get('ok'):
+                        return True
                     else:
-                        logger.error(f"Ошибка при удалении сообщения в Telegram: статус {resp.status}")
+                        logger.warning("Не удалось удалить сообщение в Telegram: %s", result.get('description', 'Unknown error'))
+                        span.fail(result.get('description', 'Unknown error'))
                         return False
-        except Exception as e:
-            logger.error(f"Ошибка при удалении сообщения в Telegram: {e}")
-            return False
+                else:
+                    logger.error("Ошибка при удалении сообщения в Telegram: статус %s", status)
+                    span.fail(f"статус {status}")
+                    return False
+            except TelegramUnavailable:
+                raise
+            except Exception as e:
+                logger.error("Ошибка при удалении сообщения в Telegram: %s", e)
+                span.fail(e)
+                return False
 
     @staticmethod
     async def delete_forwarded_message(
@@ -751,41 +3133,48 @@ class MessageHandler:
         """
         global message_mapping
         try:
-            message_map = message_mapping.get(original_message.id)
-            if not message_map:
-                logger.warning(f"Нет маппинга для удаления: {original_message.id}")
-                return False
+            with span_tracer.span('delete', source_id=original_message.id) as span:
+                async with forward_dedup.ordered(original_message.id):
+                    message_map = await lookup_mapping(original_message.id)
+                    if not message_map:
+                        logger.warning("Нет маппинга для удаления: %s", original_message.id)
+                        span.fail("нет маппинга")
+                        return False
             
-            success = True
+                    success = True
             
-            forwarded_discord_id = message_map.get('discord') if isinstance(message_map, dict) else message_map
-            if forwarded_discord_id:
-                try:
-                    sent_message = await target_channel.fetch_message(forwarded_discord_id)
-                    await sent_message.delete()
-                except discord.NotFound:
-                    pass
-                except Exception as e:
-                    logger.error(f"Ошибка при удалении сообщения в Discord: {e}")
-                    success = False
+                    forwarded_discord_id = message_map.get('discord') if isinstance(message_map, dict) else message_map
+                    if forwarded_discord_id:
+                        with span_tracer.span('discord.delete', discord_id=forwarded_discord_id) as discord_span:
+                            try:
+                                sent_message = await target_channel.fetch_message(forwarded_discord_id)
+                                await sent_message.delete()
+                            except discord.NotFound:
+                                discord_span.set(not_found=True)
+                            except Exception as e:
+                                logger.error("Ошибка при удалении сообщения в Discord: %s", e)
+                                discord_span.fail(e)
+                                success = False
             
-            telegram_message_id = message_map.get('telegram') if isinstance(message_map, dict) else None
-            if telegram_message_id:
-                telegram_bot_token = os.getenv('TELEGRAM_TOKEN')
-                telegram_chat_id = os.getenv('TELEGRAM_GROUP_ID')
-                if telegram_bot_token and telegram_chat_id:
-                    telegram_success = await MessageHandler.delete_telegram_message(
-                        telegram_bot_token, 
-                        telegram_chat_id, 
-                        telegram_message_id
-                    )
-                    if not telegram_success:
-                        success = False
+                    telegram_ids = telegram_message_ids(message_map)
+                    if telegram_ids:
+                        telegram_bot_token = os.getenv('TELEGRAM_TOKEN')
+                        if telegram_bot_token:
+                            # Отложенное из-за недоступности Telegram удаление считается успешным — выполнится позже
+                            telegram_success = await telegram_scheduler.submit(TelegramJob(
+                                f"удаление {original_message.id}",
+                                lambda: MessageHandler.delete_forward_in_telegram(telegram_bot_token, telegram_ids),
+                                lane=TelegramJob.LANE_DELETE,
+                                spec={'op': 'delete', 'source_id': original_message.id, 'telegram_ids': telegram_ids}
+                            ))
+                            if not telegram_success:
+                                span.fail("удаление в Telegram не выполнено")
+                                success = False
             
-            message_mapping.pop(original_message.id, None)
-            return success
+                    forget_mapping(original_message.id)
+                    return success
         except Exception as e:
-            logger.error(f"Ошибка при удалении сообщения {original_message.id}: {e}")
+            logger.error("Ошибка при удалении сообщения %s: %s", original_message.id, e)
             return False
 
 """
@@ -819,22 +3208,351 @@ async def periodic_unpin_task():
             await asyncio.sleep(3600)
             
             telegram_bot_token = os.getenv('TELEGRAM_TOKEN')
-            telegram_chat_id = os.getenv('TELEGRAM_GROUP_ID')
             
-            if not telegram_bot_token or not telegram_chat_id:
+            if not telegram_bot_token or not telegram_targets():
                 continue
             
             global message_mapping
-            for original_id, message_map in message_mapping.items():
-                telegram_message_id = message_map.get('telegram') if isinstance(message_map, dict) else None
-                if telegram_message_id:
+            for original_id, message_map in list(message_mapping.items()):
+                if not replica.owns(original_id):
+                    continue
+                for key, telegram_message_id in telegram_message_ids(message_map).items():
                     await MessageHandler.unpin_telegram_message(
                         telegram_bot_token,
-                        telegram_chat_id,
+                        telegram_chat_id_from_key(key),
                         telegram_message_id
                     )
         except Exception as e:
-            logger.error(f"Ошибка в периодической задаче открепления: {e}", exc_info=True)
+            logger.error("Ошибка в периодической задаче открепления: %s", e, exc_info=True)
+
+async def forward_batch(messages: List[discord.Message], target_channel: discord.TextChannel) -> int:
+    """
+    Пересылает пачку сообщений: загрузки вложений идут параллельно (до BACKFILL_CONCURRENCY),
+    отправка — строго по порядку, чтобы в Discord и Telegram сохранилась хронология
+    Возвращает количество пересланных сообщений
+    """
+    semaphore = asyncio.Semaphore(BACKFILL_CONCURRENCY)
+    scopes = [temp_storage.scope(message.id) for message in messages]
+    # Корень трассы охватывает и подготовку, и отправку, хотя они идут в разных задачах
+    roots = {
+        message.id: span_tracer.span('forward', source_id=message.id, backfill=True, attachments=len(message.attachments))
+        for message in messages
+    }
+
+    async def prepare(message: discord.Message, scope: TempScope) -> PreparedForward:
+        log_context.set({'message_id': message.id, 'event': 'backfill'})
+        current_span.set(roots[message.id])
+        async with semaphore:
+            return await MessageHandler.prepare_forward(message, scope)
+
+    # Все ID пачки держат водяной знак, пока их не перешлют по порядку
+    for message in messages:
+        forward_progress.begin(message.id)
+    forwarded = 0
+    try:
+        prepared_list = await asyncio.gather(
+            *(prepare(message, scope) for message, scope in zip(messages, scopes)),
+            return_exceptions=True
+        )
+        for message, prepared in zip(messages, prepared_list):
+            if isinstance(prepared, BaseException):
+                logger.error("Ошибка подготовки сообщения %s при догонке: %s", message.id, prepared)
+                roots[message.id].fail(prepared)
+                if is_permanent_forward_error(prepared):
+                    forward_progress.reject(message.id, prepared)
+                else:
+                    forward_progress.finish(message.id, False)
+                continue
+            token = log_context.set({'message_id': message.id, 'event': 'backfill'})
+            span_token = current_span.set(roots[message.id])
+            try:
+                if await forward_dedup.run(
+                    message.id,
+                    functools.partial(MessageHandler.deliver_forward, message, prepared, target_channel)
+                ):
+                    forwarded += 1
+            except Exception as e:
+                logger.error("Ошибка при перенаправлении сообщения %s при догонке: %s", message.id, e)
+                roots[message.id].fail(e)
+            finally:
+                current_span.reset(span_token)
+                log_context.reset(token)
+                roots[message.id].end()
+    finally:
+        for scope in scopes:
+            scope.release()
+        for root in roots.values():
+            root.end()
+        for message in messages:
+            if message.id not in forward_dedup.in_flight:
+                forward_progress.abandon(message.id)
+    return forwarded
+
+
+async def sync_recent_edits_and_deletes(
+    source_channel: discord.TextChannel,
+    target_channel: discord.TextChannel
+) -> None:
+    """
+    Сверяет последние пересланные сообщения с исходным каналом:
+    удалённые за время простоя удаляются, изменённые — редактируются
+    История читается страницами по диапазону ID, а не запросом на каждое сообщение
+    """
+    owned_ids = sorted(source_id for source_id in message_mapping if replica.owns(source_id))
+    recent_ids = owned_ids[-BACKFILL_SYNC_LIMIT:] if BACKFILL_SYNC_LIMIT > 0 else []
+    if not recent_ids:
+        return
+    present = {}
+    async for message in source_channel.history(
+        limit=None,
+        after=discord.Object(id=recent_ids[0] - 1),
+        before=discord.Object(id=recent_ids[-1] + 1),
+        oldest_first=True
+    ):
+        present[message.id] = message
+
+    edited = deleted = 0
+    for source_id in recent_ids:
+        entry = message_mapping.get(source_id)
+        if entry is None:
+            continue
+        message = present.get(source_id)
+        if message is None:
+            if await MessageHandler.delete_forwarded_message(discord.Object(id=source_id), target_channel):
+                deleted += 1
+            continue
+        known_edit = entry.get('edited_at') if isinstance(entry, dict) else None
+        if message.edited_at and (known_edit is None or message.edited_at.timestamp() > known_edit):
+            if await MessageHandler.edit_forwarded_message(message, target_channel):
+                edited += 1
+    if edited or deleted:
+        logger.info("Догонка: синхронизировано правок %s, удалений %s", edited, deleted)
+
+
+async def resume_spec(spec: dict, source_channel: discord.TextChannel, target_channel: discord.TextChannel) -> None:
+    """Повторяет одну операцию, сохранённую при остановке"""
+    source_id = spec['source_id']
+    telegram_bot_token = os.getenv('TELEGRAM_TOKEN')
+    if spec['op'] in ('forward', 'send'):
+        try:
+            message = await source_channel.fetch_message(source_id)
+        except discord.NotFound:
+            # Исходное сообщение удалили, пока бот был выключен: копии уберёт сверка удалений
+            return
+        if spec['op'] == 'forward':
+            await forward_dedup.run(source_id, lambda: MessageHandler.forward_message(message, target_channel))
+            return
+        if not telegram_bot_token or await lookup_mapping(source_id) is None:
+            return
+        # Файлы прошлого запуска удалены, вложения скачиваются заново
+        scope = temp_storage.scope(source_id)
+        try:
+            prepared = await MessageHandler.prepare_forward(message, scope)
+            for file in prepared.files:
+                file.close()
+            await MessageHandler.submit_forward_to_telegram(
+                source_id, telegram_bot_token, telegram_targets(), spec['text'], prepared.telegram_files(), scope
+            )
+        finally:
+            scope.release()
+    elif spec['op'] == 'sync':
+        # Правка или удаление пришли во время остановки: сверяем копию с исходным сообщением
+        try:
+            message = await source_channel.fetch_message(source_id)
+        except discord.NotFound:
+            await MessageHandler.delete_forwarded_message(discord.Object(id=source_id), target_channel)
+            return
+        if await lookup_mapping(source_id) is not None:
+            await MessageHandler.edit_forwarded_message(message, target_channel)
+    elif spec['op'] == 'edit' and telegram_bot_token:
+        await telegram_scheduler.submit(TelegramJob(
+            f"правка {source_id}",
+            lambda: MessageHandler.edit_forward_in_telegram(
+                telegram_bot_token, spec['telegram_ids'], spec['text'], spec['has_media']
+            ),
+            lane=TelegramJob.LANE_EDIT,
+            spec=spec
+        ))
+    elif spec['op'] == 'delete' and telegram_bot_token:
+        await telegram_scheduler.submit(TelegramJob(
+            f"удаление {source_id}",
+            lambda: MessageHandler.delete_forward_in_telegram(telegram_bot_token, spec['telegram_ids']),
+            lane=TelegramJob.LANE_DELETE,
+            spec=spec
+        ))
+
+
+async def resume_unfinished_work(source_channel: discord.TextChannel, target_channel: discord.TextChannel) -> None:
+    """
+    Повторяет работу, не завершённую при прошлой остановке: пересылки, отправки в Telegram,
+    правки и удаления. Операции чужих разделов остаются в списке для их реплик
+    """
+    mine = await asyncio.to_thread(state_store.claim_unfinished, replica.owns)
+    if not mine:
+        return
+    logger.info("Повтор незавершённой работы прошлого запуска: %s операций", len(mine))
+    for spec in mine:
+        token = log_context.set({'message_id': spec['source_id'], 'event': 'resume'})
+        try:
+            await resume_spec(spec, source_channel, target_channel)
+        except Exception as e:
+            logger.error("Ошибка повтора операции %s для сообщения %s: %s", spec['op'], spec['source_id'], e, exc_info=True)
+        finally:
+            log_context.reset(token)
+
+
+async def catch_up_missed_messages() -> None:
+    """
+    Догоняет сообщения, пропущенные пока бот был выключен
+    Читает историю исходного канала после последнего пересланного ID и пересылает её пачками,
+    затем сверяет правки и удаления уже пересланных сообщений
+    """
+    try:
+        if not replica.active:
+            return
+        target_channel_id = ConfigManager.load_target_channel()
+        if not target_channel_id:
+            return
+        source_channel = bot.get_channel(SOURCE_CHANNEL_ID)
+        target_channel = bot.get_channel(target_channel_id)
+        if not isinstance(source_channel, discord.TextChannel) or not isinstance(target_channel, discord.TextChannel):
+            logger.error("Догонка невозможна: исходный или целевой канал не найден")
+            return
+
+        await resume_unfinished_work(source_channel, target_channel)
+
+        # Для разделов — самый ранний прогресс среди своих (новый раздел ещё без ключа — общий прогресс)
+        progress = [
+            state_store.last_source_id(replica.progress_key(partition)) or state_store.last_source_id()
+            for partition in range(replica.partitions)
+            if replica.owns(partition)
+        ]
+        progress = [value for value in progress if value is not None]
+        last_source_id = min(progress) if progress else None
+        if last_source_id is None:
+            logger.info("Нет сохранённого ID последнего сообщения, догонка пропущена")
+            return
+
+        forwarded = 0
+        read = 0
+        batch: List[discord.Message] = []
+        # Живые пересылки, завершившиеся между пачками, не сдвигают знак за непрочитанную историю
+        forward_progress.hold(last_source_id + 1)
+        try:
+            async for message in source_channel.history(
+                limit=BACKFILL_LIMIT,
+                after=discord.Object(id=last_source_id),
+                oldest_first=True
+            ):
+                read += 1
+                if message.author == bot.user or message.id in message_mapping or forward_dedup.is_known(message.id):
+                    continue
+                if not replica.owns(message.id):
+                    continue
+                batch.append(message)
+                if len(batch) >= BACKFILL_BATCH_SIZE:
+                    forwarded += await forward_batch(batch, target_channel)
+                    batch = []
+                    forward_progress.hold(message.id + 1)
+            if batch:
+                forwarded += await forward_batch(batch, target_channel)
+        finally:
+            forward_progress.hold(None)
+        if BACKFILL_LIMIT and read >= BACKFILL_LIMIT:
+            logger.warning(
+                "Догонка остановилась на лимите BACKFILL_LIMIT=%s: более поздние пропущенные сообщения не пересланы",
+                BACKFILL_LIMIT
+            )
+        if forwarded:
+            logger.info("Догонка: переслано %s пропущенных сообщений", forwarded)
+
+        await sync_recent_edits_and_deletes(source_channel, target_channel)
+    except Exception as e:
+        logger.error("Ошибка догонки пропущенных сообщений: %s", e, exc_info=True)
+
+
+def _command_signature_hash() -> str:
+    """Хеш описаний всех слеш-команд в том виде, в котором они уходят в Discord"""
+    commands = sorted(
+        (command.to_dict(tree) for command in tree.get_commands()),
+        key=lambda command: command.get('name', '')
+    )
+    raw = json.dumps({'application_id': bot.application_id, 'commands': commands}, sort_keys=True, default=str)
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+async def sync_commands_if_changed() -> bool:
+    """
+    Синхронизирует слеш-команды, только если их описание изменилось с прошлой синхронизации
+    Глобальный tree.sync() медленный и ограничен rate limit, поэтому хеш хранится в DATA_DIR
+    и записывается только после успешной синхронизации
+    Возвращает True, если команды в Discord актуальны
+    """
+    hash_path = os.path.join(DATA_DIR, COMMAND_HASH_FILE)
+    try:
+        current_hash = _command_signature_hash()
+        stored_hash = None
+        if os.path.exists(hash_path):
+            with open(hash_path, 'r', encoding='utf-8') as f:
+                stored_hash = f.read().strip()
+        if stored_hash == current_hash and os.getenv('FORCE_COMMAND_SYNC') != '1':
+            logger.info("Слеш-команды не изменились, синхронизация пропущена")
+            return True
+        synced = await tree.sync()
+        logger.info("Синхронизировано %s слеш-команд", len(synced))
+        os.makedirs(DATA_DIR, exist_ok=True)
+        with open(hash_path, 'w', encoding='utf-8') as f:
+            f.write(current_hash)
+        return True
+    except Exception as e:
+        logger.error("Ошибка синхронизации команд: %s", e, exc_info=True)
+        return False
+
+
+async def keep_commands_synced() -> None:
+    """Повторяет неудавшуюся синхронизацию команд с нарастающей паузой, пока она не пройдёт"""
+    delay = COMMAND_SYNC_RETRY_SECONDS
+    while not await sync_commands_if_changed():
+        logger.warning("Повтор синхронизации слеш-команд через %s с", delay)
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, COMMAND_SYNC_RETRY_MAX_SECONDS)
+
+
+def start_catch_up() -> None:
+    """Запускает догонку; если она уже идёт — повторяет после неё (например, для новых разделов)"""
+    task = background_tasks.get('catch_up')
+    if task is None or task.done():
+        background_tasks['catch_up'] = asyncio.get_running_loop().create_task(catch_up_missed_messages())
+    else:
+        task.add_done_callback(lambda _: start_catch_up())
+
+
+def start_background_tasks() -> None:
+    """
+    Запускает фоновые задачи один раз за время жизни процесса
+    on_ready приходит и после переподключений, повторный запуск не создаёт дубликатов
+    """
+    factories = {
+        'unpin': periodic_unpin_task,
+        'temp_janitor': temp_storage.janitor,
+        'state_flusher': state_store.flusher,
+        'telegram_scheduler': telegram_scheduler.run,
+        'trace_flusher': trace_recorder.flusher,
+        'span_exporter': span_tracer.flusher,
+        'loop_watchdog': loop_watchdog.run,
+        'replica': replica.run,
+        # Догонка перезапускается на каждом READY (после переподключения тоже), но не параллельно
+        'catch_up': catch_up_missed_messages,
+    }
+    for name, factory in factories.items():
+        task = background_tasks.get(name)
+        if task is None or task.done():
+            background_tasks[name] = bot.loop.create_task(factory())
+    # Синхронизация команд не блокирует пересылку после READY; после успеха не повторяется,
+    # а если задача повторов оборвалась (отмена, падение), следующий READY запускает её снова
+    task = background_tasks.get('command_sync')
+    if task is None or (task.done() and (task.cancelled() or task.exception() is not None)):
+        background_tasks['command_sync'] = bot.loop.create_task(keep_commands_synced())
 
 """
 События Discord бота
@@ -845,17 +3563,10 @@ async def on_ready():
     """Событие запуска бота"""
     global start_time
     start_time = datetime.datetime.now()
-    logger.info(f'Бот {bot.user} готов к работе!')
-    logger.info(f'ID бота: {bot.user.id}')
-    logger.info(f'Бот подключен к {len(bot.guilds)} серверам')
-    
-    try:
-        synced = await tree.sync()
-        logger.info(f"Синхронизировано {len(synced)} слеш-команд")
-    except Exception as e:
-        logger.error(f"Ошибка синхронизации команд: {e}", exc_info=True)
-    
-    bot.loop.create_task(periodic_unpin_task())
+    logger.info("Бот %s готов к работе!", bot.user)
+    logger.info("ID бота: %s", bot.user.id)
+    logger.info("Бот подключен к %s серверам", len(bot.guilds))
+    start_background_tasks()
 
 @tree.command(
     name="set", 
@@ -891,14 +3602,14 @@ async def set_target(interaction: discord.Interaction):
             await interaction.followup.send(f"Ошибка: канал {channel_name} не найден.", ephemeral=True)
             return
         
-        if ConfigManager.save_target_channel(channel_id):
+        if await asyncio.to_thread(ConfigManager.save_target_channel, channel_id):
             channel = interaction.client.get_channel(channel_id)
             channel_mention = channel.mention if isinstance(channel, discord.TextChannel) else str(channel_id)
             await interaction.followup.send(f"Сообщения будут перенаправляться в: {channel_mention}")
         else:
             await interaction.followup.send("Ошибка при сохранении конфигурации!", ephemeral=True)
     except Exception as e:
-        logger.error(f"Ошибка в команде /set: {e}", exc_info=True)
+        logger.error("Ошибка в команде /set: %s", e, exc_info=True)
         try:
             await interaction.followup.send(f"Произошла ошибка: {str(e)}", ephemeral=True)
         except Exception:
@@ -915,9 +3626,10 @@ async def help_command(interaction: discord.Interaction):
         embed.add_field(name="/set", value="Выбрать целевой канал для пересылки сообщений", inline=False)
         embed.add_field(name="/help", value="Показать этот список команд", inline=False)
         embed.add_field(name="/status", value="Показать статус бота и текущий целевой канал", inline=False)
+        embed.add_field(name="/perf", value="Профилирование на время (только администраторы)", inline=False)
         await interaction.response.send_message(embed=embed)
     except Exception as e:
-        logger.error(f"Ошибка в команде /help: {e}", exc_info=True)
+        logger.error("Ошибка в команде /help: %s", e, exc_info=True)
         try:
             await interaction.response.send_message(f"Произошла ошибка: {str(e)}", ephemeral=True)
         except:
@@ -955,69 +3667,355 @@ async def status_command(interaction: discord.Interaction):
         else:
             channel_mention = "Не задан"
         embed.add_field(name="🎯 Целевой канал", value=f"{channel_mention}\n", inline=False)
+        breaker_state = {
+            CircuitBreaker.CLOSED: "🟢 доступен",
+            CircuitBreaker.HALF_OPEN: "🟡 проверка",
+            CircuitBreaker.OPEN: "🔴 недоступен",
+        }[telegram_client.breaker.state]
+        embed.add_field(
+            name="✈️ Telegram",
+            value=(
+                f"{breaker_state}, в очереди: {telegram_scheduler.pending()}, "
+                f"отложено: {len(telegram_scheduler.parked)}"
+            ),
+            inline=True
+        )
+        if replica.mode != 'single':
+            embed.add_field(name="🔁 Реплика", value=replica.describe(), inline=False)
+        temp_files, temp_bytes = await asyncio.to_thread(temp_storage.usage)
+        embed.add_field(
+            name="🗑️ Временные файлы",
+            value=f"{temp_files} шт., {temp_bytes / 1024 / 1024:.1f} МБ из {TEMP_QUOTA_MB} МБ",
+            inline=True
+        )
         embed.set_footer(text=f"Запросил: {interaction.user.display_name}")
         await interaction.response.send_message(embed=embed)
     except Exception as e:
-        logger.error(f"Ошибка в команде /status: {e}", exc_info=True)
+        logger.error("Ошибка в команде /status: %s", e, exc_info=True)
         try:
             await interaction.response.send_message(f"Произошла ошибка: {str(e)}", ephemeral=True)
         except:
             pass
 
+perf_lock = asyncio.Lock()
+
+
+async def sample_loop_lag(duration: float, interval: float = 0.1) -> List[float]:
+    """
+    Замеряет задержку цикла событий: насколько позже запланированного просыпается asyncio.sleep
+    Возвращает список задержек в секундах
+    """
+    lags = []
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + duration
+    while loop.time() < deadline:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - expected))
+    return lags
+
+
+def runtime_summary(lags: List[float], temp_usage: tuple) -> List[str]:
+    """Состояние бота для отчёта /perf: маппинг, задачи в работе, временные файлы, задержка цикла"""
+    running = [name for name, task in background_tasks.items() if not task.done()]
+    temp_files, temp_bytes = temp_usage
+    lines = [
+        f"Маппинг в памяти: {len(message_mapping)} сообщений",
+        f"Пересылки в работе: {len(forward_dedup.in_flight)}",
+        f"Задачи Telegram: в очереди {telegram_scheduler.pending()}, отложено {len(telegram_scheduler.parked)}",
+        f"Задачи asyncio: {len(asyncio.all_tasks())}",
+        f"Фоновые задачи: {', '.join(running) or 'нет'}",
+        f"Временные файлы: {temp_files} шт., {temp_bytes / 1024 / 1024:.1f} МБ из {TEMP_QUOTA_MB} МБ",
+        f"Блокировки цикла событий: {loop_watchdog.blocks}, максимальная задержка {loop_watchdog.max_lag * 1000:.0f} мс",
+    ]
+    lines.extend(f"  {line}" for line in loop_watchdog.summary())
+    if lags:
+        ordered = sorted(lags)
+        p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+        lines.append(
+            f"Задержка цикла событий: средняя {sum(lags) / len(lags) * 1000:.1f} мс, "
+            f"p95 {p95 * 1000:.1f} мс, максимум {ordered[-1] * 1000:.1f} мс"
+        )
+    return lines
+
+
+def render_perf_report(
+    seconds: int,
+    profiler: cProfile.Profile,
+    snapshot: Optional[tracemalloc.Snapshot],
+    summary: List[str],
+) -> str:
+    """Собирает текстовый отчёт /perf: состояние, топ функций и мест выделения памяти"""
+    out = io.StringIO()
+    out.write(f"Профилирование за {seconds} с, {datetime.datetime.now().isoformat(timespec='seconds')}\n\n")
+    for line in summary:
+        out.write(line + "\n")
+
+    out.write(f"\n=== Топ {PERF_TOP_ENTRIES} функций по суммарному времени ===\n")
+    stats = pstats.Stats(profiler, stream=out)
+    stats.strip_dirs().sort_stats(pstats.SortKey.CUMULATIVE).print_stats(PERF_TOP_ENTRIES)
+
+    out.write(f"\n=== Топ {PERF_TOP_ENTRIES} мест выделения памяти ===\n")
+    if snapshot is None:
+        out.write("tracemalloc уже был включён до команды, снимок не делался\n")
+    else:
+        for stat in snapshot.statistics('lineno')[:PERF_TOP_ENTRIES]:
+            out.write(f"{stat}\n")
+    return out.getvalue()
+
+
+@tree.command(
+    name="perf",
+    description="Профилирование бота на заданное время (только для администраторов)"
+)
+@app_commands.describe(seconds="Длительность профилирования в секундах")
+@app_commands.default_permissions(administrator=True)
+@app_commands.guild_only()
+async def perf_command(interaction: discord.Interaction, seconds: int = PERF_DEFAULT_SECONDS):
+    """
+    Включает cProfile и tracemalloc на ограниченное время и присылает отчёт файлом
+    cProfile видит все корутины, так как цикл событий работает в одном потоке
+    """
+    try:
+        permissions = getattr(interaction.user, 'guild_permissions', None)
+        if permissions is None or not permissions.administrator:
+            await interaction.response.send_message("Команда доступна только администраторам!", ephemeral=True)
+            return
+        if perf_lock.locked():
+            await interaction.response.send_message("Профилирование уже запущено, дождитесь отчёта.", ephemeral=True)
+            return
+        seconds = max(1, min(seconds, PERF_MAX_SECONDS))
+        await interaction.response.defer(ephemeral=True, thinking=True)
+
+        async with perf_lock:
+            started_tracemalloc = not tracemalloc.is_tracing()
+            if started_tracemalloc:
+                tracemalloc.start()
+            profiler = cProfile.Profile()
+            logger.info("Профилирование запущено на %d с (%s)", seconds, interaction.user)
+            profiler.enable()
+            try:
+                lags = await sample_loop_lag(seconds)
+            finally:
+                profiler.disable()
+                snapshot = tracemalloc.take_snapshot() if started_tracemalloc else None
+                if started_tracemalloc:
+                    tracemalloc.stop()
+
+        temp_usage = await asyncio.to_thread(temp_storage.usage)
+        summary = runtime_summary(lags, temp_usage)
+        report = await asyncio.to_thread(render_perf_report, seconds, profiler, snapshot, summary)
+        filename = f"perf-{datetime.datetime.now().strftime('%Y%m%d-%H%M%S')}.txt"
+        summary_text = "\n".join(summary)
+        await interaction.followup.send(
+            f"Профилирование за {seconds} с завершено\n```\n{summary_text[:1800]}\n```",
+            file=discord.File(io.BytesIO(report.encode('utf-8')), filename=filename),
+            ephemeral=True
+        )
+    except Exception as e:
+        logger.error("Ошибка в команде /perf: %s", e, exc_info=True)
+        try:
+            await interaction.followup.send(f"Произошла ошибка: {str(e)}", ephemeral=True)
+        except Exception:
+            pass
+
+def resolve_target_channel() -> Optional[discord.TextChannel]:
+    """Целевой канал из конфигурации или None, если он не выбран или не найден"""
+    target_channel_id = ConfigManager.load_target_channel()
+    if not target_channel_id:
+        return None
+    
+    target_channel = bot.get_channel(target_channel_id)
+    if not target_channel or not isinstance(target_channel, discord.TextChannel):
+        logger.error("Целевой канал %s не найден", target_channel_id)
+        return None
+    return target_channel
+
 @bot.event
 async def on_message(message: discord.Message):
     """Обработка новых сообщений в исходном канале"""
+    await handle_create(message)
+
+@bot.event
+async def on_message_edit(before: discord.Message, after: discord.Message):
+    """Обработка редактирования сообщений в исходном канале"""
+    await handle_edit(before, after)
+
+@bot.event
+async def on_message_delete(message: discord.Message):
+    """Обработка удаления сообщений в исходном канале"""
+    await handle_delete(message)
+
+async def handle_create(message: discord.Message, target_channel: Optional[discord.TextChannel] = None):
+    """
+    Пересылает новое сообщение исходного канала
+    target_channel по умолчанию берётся из конфигурации; воспроизведение трассы передаёт свой
+    """
     if message.author == bot.user or message.channel.id != SOURCE_CHANNEL_ID:
         return
-    
-    target_channel_id = ConfigManager.load_target_channel()
-    if not target_channel_id:
+    if shutting_down:
+        await defer_until_restart('forward', message.id)
+        return
+    track_handler()
+    log_context.set({'message_id': message.id, 'event': 'create'})
+    trace_recorder.record('create', trace_message_payload(message))
+    if not replica.owns(message.id):
         return
     
-    target_channel = bot.get_channel(target_channel_id)
-    if not target_channel or not isinstance(target_channel, discord.TextChannel):
-        logger.error(f"Целевой канал {target_channel_id} не найден")
+    target_channel = target_channel or resolve_target_channel()
+    if target_channel is None:
         return
     
-    await MessageHandler.forward_message(message, target_channel)
+    await forward_dedup.run(message.id, lambda: MessageHandler.forward_message(message, target_channel))
 
-@bot.event
-async def on_message_edit(before: discord.Message, after: discord.Message):
-    """Обработка редактирования сообщений в исходном канале"""
+async def handle_edit(
+    before: discord.Message,
+    after: discord.Message,
+    target_channel: Optional[discord.TextChannel] = None
+):
+    """Применяет правку сообщения исходного канала к копиям"""
     if before.channel.id != SOURCE_CHANNEL_ID:
         return
-    
-    target_channel_id = ConfigManager.load_target_channel()
-    if not target_channel_id:
+    if shutting_down:
+        await defer_until_restart('sync', after.id)
+        return
+    track_handler()
+    log_context.set({'message_id': after.id, 'event': 'edit'})
+    trace_recorder.record('update', trace_message_payload(after))
+    if not replica.owns(after.id):
         return
     
-    target_channel = bot.get_channel(target_channel_id)
-    if not target_channel or not isinstance(target_channel, discord.TextChannel):
-        logger.error(f"Целевой канал {target_channel_id} не найден")
+    target_channel = target_channel or resolve_target_channel()
+    if target_channel is None:
         return
     
     await MessageHandler.edit_forwarded_message(after, target_channel)
 
-@bot.event
-async def on_message_delete(message: discord.Message):
-    """Обработка удаления сообщений в исходном канале"""
+async def handle_delete(message: discord.Message, target_channel: Optional[discord.TextChannel] = None):
+    """Удаляет копии удалённого сообщения исходного канала"""
     if message.channel.id != SOURCE_CHANNEL_ID:
         return
-    
-    target_channel_id = ConfigManager.load_target_channel()
-    if not target_channel_id:
+    if shutting_down:
+        await defer_until_restart('sync', message.id)
+        return
+    track_handler()
+    log_context.set({'message_id': message.id, 'event': 'delete'})
+    trace_recorder.record('delete', {'id': message.id, 'channel_id': message.channel.id})
+    if not replica.owns(message.id):
         return
     
-    target_channel = bot.get_channel(target_channel_id)
-    if not target_channel or not isinstance(target_channel, discord.TextChannel):
-        logger.error(f"Целевой канал {target_channel_id} не найден")
+    target_channel = target_channel or resolve_target_channel()
+    if target_channel is None:
         return
     
+    forward_progress.forget(message.id)
     await MessageHandler.delete_forwarded_message(message, target_channel)
 
+async def defer_until_restart(op: str, source_id: int) -> None:
+    """Событие, пришедшее во время остановки, записывается в базу и обрабатывается при запуске"""
+    if not replica.owns(source_id):
+        return
+    try:
+        await asyncio.to_thread(state_store.save_unfinished, [{'op': op, 'source_id': source_id}])
+    except Exception as e:
+        logger.error("Ошибка сохранения события %s для сообщения %s: %s", op, source_id, e)
+
+def track_handler() -> None:
+    """Запоминает текущий обработчик события, чтобы при остановке дождаться его"""
+    task = asyncio.current_task()
+    if task is not None:
+        handler_tasks.add(task)
+        task.add_done_callback(handler_tasks.discard)
+
+
+async def graceful_shutdown() -> None:
+    """
+    Остановка по SIGTERM/SIGINT: новые события не обрабатываются, а записываются в базу; текущие
+    пересылки и задачи Telegram дорабатывают до SHUTDOWN_TIMEOUT. Что не успело — сохраняется в базе
+    и повторяется при запуске.
+    Затем состояние записывается на диск, аренды реплики отпускаются, HTTP-сессии закрываются
+    """
+    global shutting_down
+    if shutting_down:
+        return
+    shutting_down = True
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + SHUTDOWN_TIMEOUT
+    logger.info("Остановка: новые события откладываются до запуска, ждём текущие пересылки до %d с", SHUTDOWN_TIMEOUT)
+
+    pending = handler_tasks | set(forward_dedup.in_flight.values())
+    if pending:
+        await asyncio.wait(pending, timeout=SHUTDOWN_TIMEOUT)
+    while not telegram_scheduler.idle() and loop.time() < deadline:
+        await asyncio.sleep(0.1)
+
+    # Пересылки, не дошедшие до Discord, повторяются целиком; остальное — задачи Telegram
+    unfinished = [
+        {'op': 'forward', 'source_id': source_id}
+        for source_id in forward_dedup.in_flight
+        if source_id not in message_mapping
+    ]
+    jobs = telegram_scheduler.take_unfinished()
+    unfinished.extend(job.spec for job in jobs if job.spec)
+
+    tasks = handler_tasks | set(forward_dedup.in_flight.values()) | set(background_tasks.values())
+    tasks.discard(asyncio.current_task())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    for job in jobs:
+        job.finish()
+
+    if unfinished:
+        try:
+            await asyncio.to_thread(state_store.save_unfinished, unfinished)
+        except Exception as e:
+            logger.error("Ошибка сохранения незавершённой работы: %s", e, exc_info=True)
+        logger.warning("Не успели завершиться %s операций, они будут повторены при запуске", len(unfinished))
+    for name, flush in (('состояния', state_store.flush), ('трассы', trace_recorder.flush), ('спанов', span_tracer.flush)):
+        try:
+            await flush()
+        except Exception as e:
+            logger.error("Ошибка записи %s при остановке: %s", name, e, exc_info=True)
+    await span_tracer.close()
+    try:
+        await replica.release()
+    except Exception as e:
+        logger.error("Ошибка освобождения аренды реплики: %s", e, exc_info=True)
+    await telegram_client.close()
+    logger.info("Остановка завершена")
+
+
+async def run_bot(token: str) -> None:
+    """Запускает бота и по сигналу остановки выполняет graceful_shutdown до закрытия соединения"""
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, RuntimeError):
+            # Windows: SIGINT придёт как KeyboardInterrupt, остановка выполнится в finally
+            pass
+    async with bot:
+        bot_task = asyncio.create_task(bot.start(token))
+        stop_task = asyncio.create_task(stop.wait())
+        try:
+            await asyncio.wait({bot_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            stop_task.cancel()
+            await graceful_shutdown()
+            await bot.close()
+            if bot_task.done() and not bot_task.cancelled():
+                bot_task.result()
+            else:
+                bot_task.cancel()
+                await asyncio.gather(bot_task, return_exceptions=True)
+
+
 def main():
     """Точка входа: запуск бота"""
     load_dotenv()
+    setup_logging()
     init_runtime_config()
     if not validate_runtime_config():
         return
@@ -1025,7 +4023,35 @@ def main():
     if not token:
         logger.error("Переменная окружения BOT_TOKEN не задана!")
         return
-    bot.run(token)
+    telegram_client.breaker = CircuitBreaker(BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_SECONDS)
+    replica.configure(REPLICA_MODE, REPLICA_PARTITIONS)
+    if replica.mode != 'single':
+        temp_storage.isolate(replica.replica_id)
+    state_store.open(os.path.join(DATA_DIR, STATE_FILE))
+    message_mapping.update(state_store.load_mapping(MAPPING_CACHE_SIZE))
+    state_store.processed_limit = DEDUP_CAPACITY
+    forward_dedup.capacity = DEDUP_CAPACITY
+    forward_dedup.load(state_store.load_processed(DEDUP_CAPACITY))
+    logger.info("Загружено %s записей маппинга из %s", len(message_mapping), state_store.path)
+    trace_file = os.getenv('TRACE_FILE')
+    if trace_file:
+        trace_recorder.open(trace_file)
+        logger.info("События исходного канала записываются в %s", trace_file)
+    span_tracer.configure(os.getenv('SPANS_FILE'), os.getenv('OTLP_ENDPOINT'))
+    if span_tracer.enabled:
+        logger.info(
+            "Спаны пересылки выгружаются в %s (медленнее %s мс и ошибки — всегда, остальные — %s%%)",
+            span_tracer.path or span_tracer.endpoint, SPANS_SLOW_MS, SPANS_SAMPLE_PERCENT
+        )
+    if os.getenv('FAST_RUNTIME', '1') != '0' and uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        logger.info("Используется цикл событий uvloop")
+    # Вместо bot.run: свой цикл нужен, чтобы по SIGTERM дождаться пересылок и сохранить состояние.
+    # Логи discord.py идут через общую очередь, свой обработчик он не ставит
+    try:
+        asyncio.run(run_bot(token))
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     main()
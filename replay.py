@@ -0,0 +1,454 @@
+"""
+Воспроизведение трассы событий для нагрузочного тестирования
+
+Трасса, записанная ботом с TRACE_FILE, подаётся в те же обработчики
+(handle_create, handle_edit, handle_delete) с ускорением 1x–100x. Discord и Telegram
+заменены локальными заглушками: целевой канал передаётся обработчикам напрямую,
+клиент Telegram направлен на локальный HTTP-сервер, который отдаёт и файлы,
+и страницы Tenor, поэтому наружу не уходит ни одного запроса.
+
+Запуск: python replay.py <трасса> [--speed N]
+"""
+
+import argparse
+import asyncio
+import datetime
+import gzip
+import io
+import logging
+import os
+import struct
+import sys
+import tempfile
+import types
+from typing import List, Optional
+
+import discord
+
+import main as bot_main
+
+logger = logging.getLogger(__name__)
+
+REPLAY_TARGET_CHANNEL_ID = 1
+REPLAY_MEDIA_SIZE = 64 * 1024
+# Начало файла по расширению: классификатор медиа выбирает метод по сигнатуре, а не по имени
+REPLAY_SIGNATURES = {
+    '.png': b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', 640, 480),
+    '.jpg': b'\xff\xd8\xff\xc0' + struct.pack('>HBHHB', 17, 8, 480, 640, 3) + bytes(9),
+    '.gif': b'GIF89a' + struct.pack('<HH', 640, 480),
+    '.webp': b'RIFF' + struct.pack('<I', 22) + b'WEBPVP8X' + struct.pack('<I', 10) + bytes(4)
+             + (639).to_bytes(3, 'little') + (479).to_bytes(3, 'little'),
+    '.mp4': b'\x00\x00\x00\x18ftypisom' + bytes(12),
+    '.mov': b'\x00\x00\x00\x14ftypqt  ' + bytes(8),
+    '.webm': b'\x1a\x45\xdf\xa3',
+}
+REPLAY_SIGNATURES['.jpeg'] = REPLAY_SIGNATURES['.jpg']
+REPLAY_SIGNATURES['.m4v'] = REPLAY_SIGNATURES['.mp4']
+
+
+def load_trace(path: str) -> List[dict]:
+    """Читает трассу (.jsonl.gz или .jsonl); оборванная последняя строка пропускается"""
+    opener = gzip.open if path.endswith('.gz') else open
+    events = []
+    with opener(path, 'rb') as f:
+        for line_number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            try:
+                events.append(bot_main.json_loads(line))
+            except ValueError:
+                logger.warning("Строка %s трассы %s повреждена и пропущена", line_number, path)
+    events.sort(key=lambda event: event['t'])
+    return events
+
+
+class ReplayAttachment:
+    """Вложение из трассы: при сохранении пишет сигнатуру по расширению и нули до записанного размера"""
+    def __init__(self, data: dict):
+        self.filename = data['filename']
+        self.size = data.get('size') or 0
+        self.description = data.get('description')
+        self._spoiler = data.get('spoiler', False)
+
+    def is_spoiler(self) -> bool:
+        return self._spoiler
+
+    def content(self) -> bytes:
+        head = REPLAY_SIGNATURES.get(os.path.splitext(self.filename)[1].lower(), b'')
+        return head + bytes(max(0, self.size - len(head)))
+
+    def _write(self, path: str) -> None:
+        with open(path, 'wb') as f:
+            f.write(self.content())
+
+    async def save(self, path: str) -> None:
+        await asyncio.to_thread(self._write, path)
+
+    async def to_file(self) -> discord.File:
+        return discord.File(io.BytesIO(self.content()), filename=self.filename)
+
+
+class ReplayMessage:
+    """Исходное сообщение из трассы с теми полями, которые читают обработчики"""
+    def __init__(self, data: dict, media_base_url: str):
+        self.id = data['id']
+        self.channel = types.SimpleNamespace(id=data['channel_id'])
+        self.author = types.SimpleNamespace(id=data.get('author_id'))
+        self.content = data.get('content') or ''
+        edited_at = data.get('edited_at')
+        self.edited_at = datetime.datetime.fromtimestamp(edited_at, datetime.timezone.utc) if edited_at else None
+        self.attachments = [ReplayAttachment(item) for item in data.get('attachments', [])]
+        self.embeds = [
+            discord.Embed.from_dict(ReplayMessage.localize_embed(embed, media_base_url))
+            for embed in data.get('embeds', [])
+        ]
+        self.stickers = []
+
+    @staticmethod
+    def localize_embed(embed: dict, base_url: str) -> dict:
+        """Направляет ссылки на медиа в embed на локальный сервер (путь сохраняется, Tenor узнаётся)"""
+        def localize(url):
+            return f"{base_url}/{url.split('://', 1)[-1]}" if url else url
+        embed = dict(embed)
+        if embed.get('url'):
+            embed['url'] = localize(embed['url'])
+        for key in ('image', 'video', 'thumbnail'):
+            if isinstance(embed.get(key), dict):
+                embed[key] = {**embed[key], 'url': localize(embed[key].get('url'))}
+        return embed
+
+
+class ReplaySentMessage:
+    def __init__(self, channel: 'ReplayChannel', message_id: int, content: Optional[str]):
+        self.channel = channel
+        self.id = message_id
+        self.content = content
+
+    async def edit(self, content: Optional[str] = None, embeds=None, **kwargs) -> 'ReplaySentMessage':
+        await asyncio.sleep(self.channel.latency)
+        self.content = content
+        return self
+
+    async def delete(self) -> None:
+        await asyncio.sleep(self.channel.latency)
+        self.channel.messages.pop(self.id, None)
+
+
+class ReplayChannel(discord.TextChannel):
+    """Целевой канал Discord в памяти с задержкой на каждый вызов API"""
+    def __init__(self, channel_id: int, latency: float):
+        self.id = channel_id
+        self.guild = types.SimpleNamespace(id=0)
+        self.latency = latency
+        self.messages: dict[int, ReplaySentMessage] = {}
+        self.calls = 0
+        self._next_id = 0
+
+    async def send(self, content: Optional[str] = None, files=None, **kwargs) -> ReplaySentMessage:
+        self.calls += 1
+        for file in files or []:
+            file.close()
+        await asyncio.sleep(self.latency)
+        self._next_id += 1
+        sent = ReplaySentMessage(self, self._next_id, content)
+        self.messages[sent.id] = sent
+        return sent
+
+    async def fetch_message(self, message_id: int) -> ReplaySentMessage:
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        sent = self.messages.get(message_id)
+        if sent is None:
+            raise discord.NotFound(types.SimpleNamespace(status=404, reason='Not Found'), 'Unknown Message')
+        return sent
+
+
+class ReplayServer:
+    """
+    Локальный HTTP-сервер: Bot API Telegram в памяти и раздача медиа для embed (включая страницы Tenor)
+    """
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.base_url = ''
+        self.messages: dict[tuple, str] = {}
+        self.calls: dict[str, int] = {}
+        self._next_id: dict[str, int] = {}
+        self._next_file = 0
+        self._runner = None
+
+    async def start(self) -> None:
+        from aiohttp import web
+        app = web.Application(client_max_size=1024 ** 3)
+        app.router.add_post('/bot{token}/{method}', self.handle_api)
+        app.router.add_get('/{path:.*}', self.handle_media)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, '127.0.0.1', 0)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+    async def handle_media(self, request):
+        from aiohttp import web
+        path = request.match_info['path']
+        if 'tenor.com/view/' in path:
+            gif_url = f"{self.base_url}/media.tenor.com/{path.rsplit('/', 1)[-1]}.gif"
+            return web.Response(
+                text=f'<html><head><meta property="og:image" content="{gif_url}"></head></html>',
+                content_type='text/html'
+            )
+        return web.Response(body=b'GIF89a' + bytes(REPLAY_MEDIA_SIZE))
+
+    async def handle_api(self, request):
+        from aiohttp import web
+        method = request.match_info['method']
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if request.content_type == 'multipart/form-data':
+            data = dict(await request.post())
+        else:
+            data = await request.json()
+        await asyncio.sleep(self.latency)
+
+        chat_id = str(data.get('chat_id'))
+        if method.startswith('send'):
+            self._next_id[chat_id] = self._next_id.get(chat_id, 0) + 1
+            message_id = self._next_id[chat_id]
+            self.messages[(chat_id, message_id)] = data.get('text') or data.get('caption') or ''
+            result = {'message_id': message_id, 'chat': {'id': chat_id}}
+            if method != 'sendMessage':
+                field_name = method[len('send'):].lower()
+                file_id = data.get(field_name)
+                if not isinstance(file_id, str):
+                    self._next_file += 1
+                    file_id = f"replay-file-{self._next_file}"
+                result[field_name] = [{'file_id': file_id}] if field_name == 'photo' else {'file_id': file_id}
+            return web.json_response({'ok': True, 'result': result})
+
+        key = (chat_id, data.get('message_id'))
+        if method in ('editMessageText', 'editMessageCaption', 'deleteMessage') and key not in self.messages:
+            return web.json_response({'ok': False, 'description': 'Bad Request: message not found'}, status=400)
+        if method == 'editMessageText':
+            self.messages[key] = data.get('text') or ''
+        elif method == 'editMessageCaption':
+            self.messages[key] = data.get('caption') or ''
+        elif method == 'deleteMessage':
+            del self.messages[key]
+        return web.json_response({'ok': True, 'result': True})
+
+
+def latency_summary(values: List[float]) -> str:
+    if not values:
+        return "нет данных"
+    ordered = sorted(values)
+
+    def percentile(p: float) -> float:
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p))] * 1000
+    return (
+        f"p50 {percentile(0.5):.0f} мс, p90 {percentile(0.9):.0f} мс, "
+        f"p99 {percentile(0.99):.0f} мс, максимум {ordered[-1] * 1000:.0f} мс"
+    )
+
+
+def replay_divergence(events: List[dict], channel: ReplayChannel, server: ReplayServer, targets: tuple) -> List[str]:
+    """Сравнивает итоговый маппинг и заглушки с тем, что должно получиться по трассе"""
+    expected: dict[int, str] = {}
+    deleted = set()
+    for event in events:
+        if event['event'] == 'create':
+            expected[event['id']] = event.get('content') or ''
+        elif event['event'] == 'update' and event['id'] in expected:
+            expected[event['id']] = event.get('content') or ''
+        elif event['event'] == 'delete':
+            expected.pop(event['id'], None)
+            deleted.add(event['id'])
+
+    problems = []
+    missing = [source_id for source_id in expected if source_id not in bot_main.message_mapping]
+    if missing:
+        problems.append(f"Нет в маппинге, хотя сообщение живо: {len(missing)} (например {missing[:5]})")
+    stale = [source_id for source_id in deleted if source_id in bot_main.message_mapping]
+    if stale:
+        problems.append(f"Остались в маппинге после удаления: {len(stale)} (например {stale[:5]})")
+
+    referenced_discord = set()
+    referenced_telegram = set()
+    wrong_discord, wrong_telegram, incomplete = [], [], []
+    for source_id, entry in bot_main.message_mapping.items():
+        discord_id = entry.get('discord') if isinstance(entry, dict) else entry
+        referenced_discord.add(discord_id)
+        telegram_ids = bot_main.telegram_message_ids(entry)
+        for key, message_id in telegram_ids.items():
+            referenced_telegram.add((bot_main.telegram_chat_id_from_key(key), message_id))
+        if source_id not in expected:
+            continue
+        content = expected[source_id]
+        sent = channel.messages.get(discord_id)
+        if sent is not None and sent.content != content:
+            wrong_discord.append(source_id)
+        if len(telegram_ids) < len(targets):
+            incomplete.append(source_id)
+        # Тот же текст, что собирает бот, включая ссылку на канал из CHANNELS
+        telegram_text = bot_main.MessageHandler.telegram_text(
+            bot_main.MessageHandler.convert_discord_to_telegram_html(content), channel
+        )
+        for key, message_id in telegram_ids.items():
+            actual = server.messages.get((bot_main.telegram_chat_id_from_key(key), message_id))
+            if content and actual is not None and actual != telegram_text:
+                wrong_telegram.append(source_id)
+                break
+    if wrong_discord:
+        problems.append(f"Устаревший текст в Discord: {len(wrong_discord)} (например {wrong_discord[:5]})")
+    if wrong_telegram:
+        problems.append(f"Устаревший текст в Telegram: {len(wrong_telegram)} (например {wrong_telegram[:5]})")
+    if incomplete:
+        problems.append(f"Дошли не во все чаты Telegram: {len(incomplete)} (например {incomplete[:5]})")
+
+    orphan_discord = [message_id for message_id in channel.messages if message_id not in referenced_discord]
+    if orphan_discord:
+        problems.append(f"Сообщения в Discord без маппинга: {len(orphan_discord)}")
+    orphan_telegram = [key for key in server.messages if key not in referenced_telegram]
+    if orphan_telegram:
+        problems.append(f"Сообщения в Telegram без маппинга: {len(orphan_telegram)}")
+    return problems
+
+
+async def replay_trace(
+    events: List[dict],
+    speed: float,
+    discord_latency: float,
+    telegram_latency: float,
+    workdir: str,
+) -> bool:
+    """
+    Проигрывает события через обработчики бота и печатает отчёт
+    Возвращает True, если итоговое состояние совпало с ожидаемым
+    """
+    server = ReplayServer(telegram_latency)
+    await server.start()
+    channel = ReplayChannel(REPLAY_TARGET_CHANNEL_ID, discord_latency)
+
+    # Состояние и временные файлы — в рабочем каталоге прогона, Bot API — локальный сервер
+    bot_main.telegram_client.api_url = server.base_url
+    bot_main.temp_storage.root = os.path.join(workdir, 'trsh')
+    bot_main.state_store.open(os.path.join(workdir, bot_main.STATE_FILE))
+
+    helpers = [
+        asyncio.create_task(bot_main.telegram_scheduler.run()),
+        asyncio.create_task(bot_main.state_store.flusher()),
+        asyncio.create_task(bot_main.loop_watchdog.run()),
+        asyncio.create_task(bot_main.span_tracer.flusher()),
+    ]
+    loop = asyncio.get_running_loop()
+    latencies: dict[str, List[float]] = {'create': [], 'update': [], 'delete': []}
+    errors = 0
+
+    async def dispatch(event: dict, at: float) -> None:
+        nonlocal errors
+        await asyncio.sleep(max(0.0, at - loop.time()))
+        try:
+            if event['event'] == 'delete':
+                message = ReplayMessage({'attachments': [], 'embeds': [], **event}, server.base_url)
+                await bot_main.handle_delete(message, channel)
+            else:
+                message = ReplayMessage(event, server.base_url)
+                if event['event'] == 'create':
+                    await bot_main.handle_create(message, channel)
+                else:
+                    await bot_main.handle_edit(message, message, channel)
+        except Exception as e:
+            errors += 1
+            logger.error("Ошибка обработки события %s %s: %s", event['event'], event['id'], e, exc_info=True)
+        latencies[event['event']].append(loop.time() - at)
+
+    first = events[0]['t']
+    started = loop.time()
+    await asyncio.gather(*(
+        dispatch(event, started + (event['t'] - first) / speed)
+        for event in events
+        if event.get('event') in latencies
+    ))
+    scheduler = bot_main.telegram_scheduler
+    while scheduler.pending() or scheduler.parked or bot_main.forward_dedup.in_flight:
+        await asyncio.sleep(0.05)
+    elapsed = loop.time() - started
+
+    for task in helpers:
+        task.cancel()
+    await asyncio.gather(*helpers, return_exceptions=True)
+    await bot_main.state_store.flush()
+    await bot_main.span_tracer.flush()
+    await bot_main.span_tracer.close()
+    await bot_main.telegram_client.close()
+    await server.stop()
+
+    targets = bot_main.telegram_targets()
+    problems = replay_divergence(events, channel, server, targets)
+    trace_span = events[-1]['t'] - first
+    total = sum(len(values) for values in latencies.values())
+    print(f"Событий: {total} за {elapsed:.1f} с (в трассе {trace_span:.1f} с, ускорение {speed:g}x)")
+    print(f"Пропускная способность: {total / elapsed if elapsed else 0:.1f} событий/с")
+    for event_type, values in latencies.items():
+        print(f"Задержка {event_type} ({len(values)}): {latency_summary(values)}")
+    print(f"Задержка всех событий: {latency_summary([v for values in latencies.values() for v in values])}")
+    print(f"Вызовы Discord: {channel.calls}, вызовы Telegram: {sum(server.calls.values())} {server.calls}")
+    print(f"Ошибки обработчиков: {errors}")
+    watchdog = bot_main.loop_watchdog
+    print(f"Блокировки цикла событий: {watchdog.blocks}, максимальная задержка {watchdog.max_lag * 1000:.0f} мс")
+    for line in watchdog.summary():
+        print(f"  {line}")
+    print(f"Маппинг: {len(bot_main.message_mapping)} записей, чатов Telegram: {len(targets)}")
+    tracer = bot_main.span_tracer
+    if tracer.enabled:
+        print(f"Спанов выгружено: {tracer.exported}, отброшено: {tracer.dropped}")
+    if problems:
+        print("Расхождения итогового состояния:")
+        for problem in problems:
+            print(f"  - {problem}")
+    else:
+        print("Расхождений итогового состояния нет")
+    return not problems
+
+
+def replay_main(argv: List[str]) -> int:
+    """python replay.py <трасса> [--speed N]: нагрузочный прогон записанной трассы"""
+    parser = argparse.ArgumentParser(prog='replay.py', description="Воспроизведение трассы событий")
+    parser.add_argument('trace', help="файл трассы (.jsonl.gz), записанный с TRACE_FILE")
+    parser.add_argument('--speed', type=float, default=1.0, help="ускорение от 1 до 100 (по умолчанию 1)")
+    parser.add_argument('--targets', default='-1001', help="чаты Telegram через запятую, как TELEGRAM_GROUP_ID")
+    parser.add_argument('--discord-latency-ms', type=float, default=50, help="задержка заглушки Discord")
+    parser.add_argument('--telegram-latency-ms', type=float, default=100, help="задержка заглушки Telegram")
+    args = parser.parse_args(argv)
+    if not 1 <= args.speed <= 100:
+        parser.error("--speed должен быть от 1 до 100")
+
+    events = load_trace(args.trace)
+    if not events:
+        logger.error("В трассе %s нет событий", args.trace)
+        return 1
+    # Прогон — отдельный процесс: настройки бота указывают на исходный канал трассы и заглушки,
+    # настоящие токены не нужны
+    os.environ['SOURCE_CHANNEL_ID'] = str(events[0]['channel_id'])
+    os.environ['TELEGRAM_TOKEN'] = 'replay'
+    os.environ['TELEGRAM_GROUP_ID'] = args.targets
+    bot_main.init_runtime_config()
+    bot_main.telegram_client.breaker = bot_main.CircuitBreaker(
+        bot_main.BREAKER_FAILURE_THRESHOLD, bot_main.BREAKER_RESET_SECONDS
+    )
+    bot_main.span_tracer.configure(os.getenv('SPANS_FILE'), os.getenv('OTLP_ENDPOINT'))
+    with tempfile.TemporaryDirectory(prefix='replay-') as workdir:
+        ok = asyncio.run(replay_trace(
+            events,
+            args.speed,
+            args.discord_latency_ms / 1000,
+            args.telegram_latency_ms / 1000,
+            workdir,
+        ))
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(replay_main(sys.argv[1:]))
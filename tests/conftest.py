@@ -0,0 +1,17 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import main  # noqa: E402
+
+
+@pytest.fixture
+def state_store(tmp_path, monkeypatch):
+    """Отдельная база состояния на тест вместо общей state_store модуля"""
+    store = main.StateStore()
+    store.open(str(tmp_path / 'state.db'))
+    monkeypatch.setattr(main, 'state_store', store)
+    return store
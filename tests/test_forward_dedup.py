@@ -0,0 +1,176 @@
+import asyncio
+from types import SimpleNamespace
+
+import discord
+import pytest
+
+import main
+from main import ForwardDeduplicator, ForwardProgress, StateStore
+
+
+@pytest.fixture
+def progress(state_store, monkeypatch):
+    tracker = ForwardProgress()
+    monkeypatch.setattr(main, 'forward_progress', tracker)
+    return tracker
+
+
+def test_concurrent_events_forward_once(progress):
+    async def scenario():
+        dedup = ForwardDeduplicator(10)
+        calls = []
+
+        async def forward():
+            calls.append(1)
+            await asyncio.sleep(0.01)
+            return 'sent'
+
+        results = await asyncio.gather(dedup.run(1, forward), dedup.run(1, forward))
+        repeated = await dedup.run(1, forward)
+        return calls, results, repeated
+
+    calls, results, repeated = asyncio.run(scenario())
+    assert calls == [1]
+    assert results == ['sent', 'sent']
+    assert repeated is None
+
+
+def test_failed_forward_can_be_retried(progress):
+    async def scenario():
+        dedup = ForwardDeduplicator(10)
+        outcomes = iter([None, 'sent'])
+
+        async def forward():
+            return next(outcomes)
+
+        first = await dedup.run(1, forward)
+        second = await dedup.run(1, forward)
+        return first, second, dedup.is_known(1)
+
+    assert asyncio.run(scenario()) == (None, 'sent', True)
+
+
+def test_recent_ids_are_bounded(progress):
+    dedup = ForwardDeduplicator(2)
+    dedup.load([1, 2, 3])
+    assert not dedup.is_known(1)
+    assert dedup.is_known(2) and dedup.is_known(3)
+
+
+def test_edit_and_delete_wait_for_forward_in_event_order(progress):
+    async def scenario():
+        dedup = ForwardDeduplicator(10)
+        log = []
+        uploaded = asyncio.Event()
+
+        async def forward():
+            await uploaded.wait()
+            log.append('forward')
+            return 'sent'
+
+        async def follow_up(name, delay):
+            async with dedup.ordered(1):
+                await asyncio.sleep(delay)
+                log.append(name)
+
+        forwarding = asyncio.ensure_future(dedup.run(1, forward))
+        edit = asyncio.ensure_future(follow_up('edit', 0.02))
+        delete = asyncio.ensure_future(follow_up('delete', 0))
+        await asyncio.sleep(0.01)
+        uploaded.set()
+        await asyncio.gather(forwarding, edit, delete)
+        return log, dedup.locks
+
+    log, locks = asyncio.run(scenario())
+    assert log == ['forward', 'edit', 'delete']
+    assert locks == {}
+
+
+def test_watermark_stops_before_pending_and_failed(progress, state_store):
+    for source_id in (1, 2, 3, 4):
+        progress.begin(source_id)
+    progress.finish(2, True)
+    assert state_store.last_source_id() is None
+    progress.finish(1, True)
+    assert state_store.last_source_id() == 2
+    progress.finish(3, False)
+    progress.finish(4, True)
+    assert state_store.last_source_id() == 2
+    # Догонка переслала неудавшееся сообщение
+    progress.begin(3)
+    progress.finish(3, True)
+    assert state_store.last_source_id() == 4
+
+
+def test_deleted_failure_releases_watermark(progress, state_store):
+    progress.begin(5)
+    progress.finish(5, False)
+    progress.begin(6)
+    progress.finish(6, True)
+    assert state_store.last_source_id() is None
+    progress.forget(5)
+    assert state_store.last_source_id() == 6
+
+
+def test_dedup_reports_progress(progress, state_store):
+    async def scenario():
+        dedup = ForwardDeduplicator(10)
+
+        async def fail():
+            raise RuntimeError("Discord недоступен")
+
+        async def ok():
+            return 'sent'
+
+        with pytest.raises(RuntimeError):
+            await dedup.run(1, fail)
+        await dedup.run(2, ok)
+
+    asyncio.run(scenario())
+    assert state_store.last_source_id(StateStore.LAST_SOURCE_ID) is None
+    assert progress.failed[StateStore.LAST_SOURCE_ID] == {1}
+
+
+def payload_too_large() -> discord.HTTPException:
+    response = SimpleNamespace(status=413, reason='Payload Too Large')
+    return discord.HTTPException(response, {'code': 40005, 'message': 'Request entity too large'})
+
+
+def test_rejected_forward_releases_watermark(progress, state_store):
+    async def scenario():
+        dedup = ForwardDeduplicator(10)
+
+        async def too_large():
+            raise payload_too_large()
+
+        async def swallowed():
+            # Как forward_message: ошибка записана в лог, результат None
+            progress.reject(2, payload_too_large())
+            return None
+
+        async def ok():
+            return 'sent'
+
+        with pytest.raises(discord.HTTPException):
+            await dedup.run(1, too_large)
+        await dedup.run(2, swallowed)
+        await dedup.run(3, ok)
+
+    asyncio.run(scenario())
+    assert state_store.last_source_id() == 3
+    assert not progress.failed.get(StateStore.LAST_SOURCE_ID)
+
+
+def test_catch_up_cursor_holds_watermark(progress, state_store):
+    progress.hold(3)
+    progress.begin(1)
+    progress.finish(1, True)
+    assert state_store.last_source_id() == 1
+    # Живая пересылка завершилась раньше, чем догонка прочитала 3 и 4
+    progress.begin(5)
+    progress.finish(5, True)
+    assert state_store.last_source_id() == 1
+    progress.hold(5)
+    assert state_store.last_source_id() == 1
+    progress.hold(None)
+    assert state_store.last_source_id() == 5
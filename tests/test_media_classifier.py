@@ -0,0 +1,168 @@
+import asyncio
+import struct
+
+import pytest
+
+import main
+from main import MediaClassifier
+
+MB = 1024 * 1024
+
+
+def riff(chunk: bytes, payload: bytes) -> bytes:
+    return b'RIFF' + struct.pack('<I', 4 + 8 + len(payload)) + b'WEBP' + chunk + struct.pack('<I', len(payload)) + payload
+
+
+def jpeg(width: int, height: int) -> bytes:
+    app0 = b'\xff\xe0' + struct.pack('>H', 16) + b'JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00'
+    dqt = b'\xff\xdb' + struct.pack('>H', 67) + bytes(65)
+    sof0 = b'\xff\xc0' + struct.pack('>HBHHB', 17, 8, height, width, 3) + bytes(9)
+    return b'\xff\xd8' + app0 + dqt + sof0
+
+
+def vp8(width: int, height: int) -> bytes:
+    frame = b'\x00\x00\x00' + b'\x9d\x01\x2a' + struct.pack('<HH', width, height)
+    return riff(b'VP8 ', frame)
+
+
+def vp8l(width: int, height: int) -> bytes:
+    bits = (width - 1) | ((height - 1) << 14)
+    return riff(b'VP8L', b'\x2f' + struct.pack('<I', bits) + bytes(16))
+
+
+def vp8x(width: int, height: int, animated: bool = False) -> bytes:
+    flags = 0x02 if animated else 0x00
+    payload = bytes([flags, 0, 0, 0]) + (width - 1).to_bytes(3, 'little') + (height - 1).to_bytes(3, 'little')
+    return riff(b'VP8X', payload)
+
+
+@pytest.mark.parametrize('head, expected', [
+    (jpeg(10, 10), 'jpeg'),
+    (b'\x89PNG\r\n\x1a\n' + bytes(16), 'png'),
+    (b'GIF89a' + bytes(10), 'gif'),
+    (b'GIF87a' + bytes(10), 'gif'),
+    (vp8(10, 10), 'webp'),
+    (vp8x(10, 10), 'webp'),
+    (vp8x(10, 10, animated=True), 'webp-animated'),
+    (b'\x00\x00\x00\x18ftypisom' + bytes(8), 'mp4'),
+    (b'\x00\x00\x00\x14ftypqt  ' + bytes(8), 'mov'),
+    (b'\x00\x00\x00\x18ftypmp42' + bytes(8), 'mp4'),
+    (b'\x00\x00\x00\x18ftypM4V ' + bytes(8), 'mp4'),
+    (b'\x00\x00\x00\x18ftypheic' + bytes(8), 'unknown'),
+    (b'\x00\x00\x00\x1cftypavif' + bytes(8), 'unknown'),
+    (b'\x00\x00\x00\x18ftypmif1' + bytes(8), 'unknown'),
+    (b'\x00\x00\x00\x20ftypM4A ' + bytes(8), 'unknown'),
+    (b'\x00\x00\x00\x14ftyp3gp4' + bytes(8), 'unknown'),
+    (b'\x1a\x45\xdf\xa3' + bytes(8), 'webm'),
+    (b'RIFF\x00\x00\x00\x00AVI LIST', 'avi'),
+    (b'%PDF-1.7\n', 'unknown'),
+    (b'', 'unknown'),
+])
+def test_sniff(head, expected):
+    assert MediaClassifier.sniff(head) == expected
+
+
+def test_image_size_png():
+    head = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', 640, 480)
+    assert MediaClassifier.image_size(head, 'png') == (640, 480)
+
+
+def test_image_size_jpeg_skips_segments_before_sof():
+    assert MediaClassifier.image_size(jpeg(1920, 1080), 'jpeg') == (1920, 1080)
+
+
+def test_image_size_jpeg_without_sof_in_head():
+    head = jpeg(100, 100)
+    assert MediaClassifier.image_size(head[:40], 'jpeg') is None
+
+
+@pytest.mark.parametrize('head', [vp8(300, 200), vp8l(300, 200), vp8x(300, 200)])
+def test_image_size_webp(head):
+    assert MediaClassifier.image_size(head, 'webp') == (300, 200)
+
+
+@pytest.mark.parametrize('fmt, size, dimensions, expected', [
+    ('jpeg', MB, (1000, 800), 'sendPhoto'),
+    ('png', MB, None, 'sendPhoto'),
+    ('webp', MB, (512, 512), 'sendPhoto'),
+    ('jpeg', MediaClassifier.PHOTO_LIMIT + 1, (1000, 800), 'sendDocument'),
+    ('png', MB, (6000, 4001), 'sendDocument'),
+    ('png', MB, (6000, 4000), 'sendPhoto'),
+    ('png', MB, (2100, 100), 'sendDocument'),
+    ('png', MB, (2000, 100), 'sendPhoto'),
+    ('png', MB, (0, 100), 'sendDocument'),
+    ('gif', 20 * MB, None, 'sendAnimation'),
+    ('mp4', 40 * MB, None, 'sendVideo'),
+    ('mov', 40 * MB, None, 'sendVideo'),
+    ('webm', MB, None, 'sendDocument'),
+    ('webp-animated', MB, None, 'sendDocument'),
+    ('unknown', MB, None, 'sendDocument'),
+    ('mp4', MediaClassifier.UPLOAD_LIMIT + 1, None, None),
+])
+def test_choose_method(fmt, size, dimensions, expected):
+    assert MediaClassifier.choose_method(fmt, size, dimensions) == expected
+
+
+@pytest.fixture
+def digests(monkeypatch):
+    """Считает хеширования файлов"""
+    calls = []
+    file_digest = main.hashlib.file_digest
+
+    def counting(f, digest):
+        calls.append(f.name)
+        return file_digest(f, digest)
+
+    monkeypatch.setattr(main.hashlib, 'file_digest', counting)
+    return calls
+
+
+def test_classify_hashes_file_once(tmp_path, digests):
+    path = tmp_path / 'clip.mp4'
+    path.write_bytes(b'\x00\x00\x00\x18ftypisom' + bytes(64))
+    classifier = MediaClassifier()
+
+    async def scenario():
+        return [await classifier.classify(str(path)) for _ in range(3)]
+
+    kinds = asyncio.run(scenario())
+    assert digests == [str(path)]
+    assert {kind.method for kind in kinds} == {'sendVideo'}
+    assert len({kind.key for kind in kinds}) == 1
+
+
+def test_classify_skips_hash_over_upload_limit(tmp_path, digests):
+    path = tmp_path / 'huge.mp4'
+    with open(path, 'wb') as f:
+        f.write(b'\x00\x00\x00\x18ftypisom')
+        f.truncate(MediaClassifier.UPLOAD_LIMIT + 1)
+    kind = asyncio.run(MediaClassifier().classify(str(path)))
+    assert digests == []
+    assert kind.method is None and kind.key is None
+
+
+@pytest.mark.parametrize('description', [
+    'Bad Request: PHOTO_INVALID_DIMENSIONS',
+    'Bad Request: PHOTO_SAVE_FILE_INVALID',
+    'Bad Request: PHOTO_EXT_INVALID',
+    'Bad Request: IMAGE_PROCESS_FAILED',
+    'Bad Request: VIDEO_FILE_INVALID',
+    'Bad Request: VIDEO_CONTENT_TYPE_INVALID',
+])
+def test_is_media_rejection(description):
+    assert MediaClassifier.is_media_rejection(description)
+
+
+@pytest.mark.parametrize('description', [
+    'Bad Request: chat not found',
+    'Bad Request: not enough rights to send photos to the chat',
+    'Bad Request: not enough rights to send videos to the chat',
+    'Bad Request: wrong file identifier/HTTP URL specified',
+    'Bad Request: file must be non-empty',
+    'Bad Request: message caption is too long',
+    "Bad Request: can't parse entities: Unsupported start tag \"image\" at byte offset 12",
+    'Bad Request: message thread not found',
+    '',
+])
+def test_is_not_media_rejection(description):
+    assert not MediaClassifier.is_media_rejection(description)
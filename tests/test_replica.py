@@ -0,0 +1,90 @@
+import asyncio
+
+import main
+from main import ReplicaCoordinator
+
+
+def coordinator(name: str, partitions: int = 4) -> ReplicaCoordinator:
+    replica = ReplicaCoordinator()
+    replica.replica_id = name
+    replica.configure('partition', partitions)
+    return replica
+
+
+def owned(replica: ReplicaCoordinator) -> list:
+    return sorted(replica.owned)
+
+
+def test_partitions_are_shared_between_replicas(state_store):
+    async def scenario():
+        first, second = coordinator('a'), coordinator('b')
+        assert await first._rebalance() == [0, 1, 2, 3]
+        # Вторая реплика видна первой только после её аренды: пока все разделы заняты
+        assert await second._rebalance() == []
+        await first._rebalance()
+        assert owned(first) == [0, 1]
+        assert await second._rebalance() == [2, 3]
+        return first, second
+
+    first, second = asyncio.run(scenario())
+    assert all(first.owns(source_id) for source_id in (4, 5))
+    assert not any(first.owns(source_id) for source_id in (6, 7))
+    assert all(second.owns(source_id) for source_id in (6, 7))
+    assert second.progress_key(6) == f"{main.StateStore.LAST_SOURCE_ID}:2"
+
+
+def test_released_partitions_move_to_remaining_replica(state_store):
+    async def scenario():
+        first, second = coordinator('a'), coordinator('b')
+        await first._rebalance()
+        await second._rebalance()
+        await first._rebalance()
+        await second._rebalance()
+        await first.release()
+        gained = await second._rebalance()
+        return first, second, gained
+
+    first, second, gained = asyncio.run(scenario())
+    assert gained == [0, 1]
+    assert owned(second) == [0, 1, 2, 3]
+    assert not first.active
+
+
+def test_expired_lease_is_taken_over(state_store, monkeypatch):
+    monkeypatch.setattr(main, 'LEASE_TTL_SECONDS', 0.05)
+
+    async def scenario():
+        active, standby = coordinator('a', 1), coordinator('b', 1)
+        await active._rebalance()
+        assert await standby._rebalance() == []
+        await asyncio.sleep(0.1)
+        return await standby._rebalance()
+
+    assert asyncio.run(scenario()) == [0]
+
+
+def test_warm_up_replaces_cached_entries_of_gained_partitions(state_store, monkeypatch):
+    replica = coordinator('a', 2)
+    monkeypatch.setattr(main, 'replica', replica)
+    monkeypatch.setattr(main, 'message_mapping', {2: {'discord': 'stale'}, 4: {'discord': 'deleted'}, 3: {'discord': 'own'}})
+    state_store.remember(2, {'discord': 'fresh'})
+    state_store.remember(3, {'discord': 'db'})
+    state_store.remember(6, {'discord': 'new'})
+    monkeypatch.setattr(main, 'start_catch_up', lambda: None)
+
+    async def scenario():
+        await state_store.flush()
+        await replica._warm_up([0])
+
+    asyncio.run(scenario())
+    assert main.message_mapping == {2: {'discord': 'fresh'}, 3: {'discord': 'own'}, 6: {'discord': 'new'}}
+
+
+def test_unfinished_work_is_claimed_once(state_store):
+    def owner(source_id):
+        return source_id % 2 == 0
+
+    state_store.save_unfinished([{'op': 'forward', 'source_id': source_id} for source_id in (1, 2, 3, 4)])
+    assert [spec['source_id'] for spec in state_store.claim_unfinished(owner)] == [2, 4]
+    assert state_store.claim_unfinished(owner) == []
+    assert [spec['source_id'] for spec in state_store.claim_unfinished(lambda source_id: True)] == [1, 3]
@@ -0,0 +1,116 @@
+import asyncio
+
+import pytest
+
+import main
+from main import TelegramJob, TelegramScheduler, TelegramUnavailable
+
+
+@pytest.fixture(autouse=True)
+def settings(monkeypatch):
+    monkeypatch.setattr(main, 'TELEGRAM_WORKERS', 1)
+    monkeypatch.setattr(main, 'TELEGRAM_MEDIA_CONCURRENCY', 1)
+    monkeypatch.setattr(main, 'TELEGRAM_RATE_PER_SECOND', 0)
+
+
+def job(name: str, lane: int, log: list, result=True) -> TelegramJob:
+    async def factory():
+        log.append(name)
+        return result
+    return TelegramJob(name, factory, lane=lane)
+
+
+async def running(scheduler: TelegramScheduler, coro):
+    task = asyncio.create_task(scheduler.run())
+    try:
+        return await asyncio.wait_for(coro, 5)
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def test_lanes_run_by_priority():
+    async def scenario():
+        scheduler = TelegramScheduler(main.telegram_client)
+        log = []
+        futures = [
+            scheduler.enqueue(job('media', TelegramJob.LANE_MEDIA, log)),
+            scheduler.enqueue(job('text', TelegramJob.LANE_TEXT, log)),
+            scheduler.enqueue(job('edit', TelegramJob.LANE_EDIT, log)),
+            scheduler.enqueue(job('delete', TelegramJob.LANE_DELETE, log)),
+        ]
+        await running(scheduler, asyncio.gather(*futures))
+        return log
+
+    assert asyncio.run(scenario()) == ['delete', 'edit', 'text', 'media']
+
+
+def test_media_upload_does_not_block_light_jobs():
+    async def scenario():
+        scheduler = TelegramScheduler(main.telegram_client)
+        upload_done = asyncio.Event()
+        log = []
+
+        async def upload():
+            await upload_done.wait()
+            log.append('media')
+            return True
+
+        async def body():
+            media = scheduler.enqueue(TelegramJob('media', upload, lane=TelegramJob.LANE_MEDIA))
+            await asyncio.sleep(0.01)
+            await scheduler.submit(job('edit', TelegramJob.LANE_EDIT, log))
+            assert scheduler.pending() == 1
+            upload_done.set()
+            await media
+
+        await running(scheduler, body())
+        return log
+
+    assert asyncio.run(scenario()) == ['edit', 'media']
+
+
+def test_unavailable_jobs_are_parked_and_replayed_in_order():
+    async def scenario():
+        scheduler = TelegramScheduler(main.telegram_client)
+        log = []
+        attempts = [0]
+
+        async def flaky():
+            attempts[0] += 1
+            # Первая попытка паркует задачу, вторая (пробная из разборщика) тоже не проходит
+            if attempts[0] <= 2:
+                raise TelegramUnavailable("нет связи")
+            log.append('first')
+            return True
+
+        async def body():
+            first = await scheduler.submit(TelegramJob('first', flaky, lane=TelegramJob.LANE_TEXT))
+            second = scheduler.enqueue(job('second', TelegramJob.LANE_DELETE, log))
+            assert first is TelegramScheduler.PARKED
+            assert await second is TelegramScheduler.PARKED
+            while len(log) < 2:
+                await asyncio.sleep(0.01)
+
+        await running(scheduler, body())
+        return log
+
+    assert asyncio.run(scenario()) == ['first', 'second']
+
+
+def test_take_unfinished_keeps_submission_order():
+    async def scenario():
+        scheduler = TelegramScheduler(main.telegram_client)
+        log = []
+        jobs = [
+            job('media', TelegramJob.LANE_MEDIA, log),
+            job('delete', TelegramJob.LANE_DELETE, log),
+            job('text', TelegramJob.LANE_TEXT, log),
+        ]
+        for item in jobs:
+            scheduler.enqueue(item)
+        return [item.name for item in scheduler.take_unfinished()], log
+
+    names, log = asyncio.run(scenario())
+    assert names == ['media', 'delete', 'text']
+    assert log == []
@@ -0,0 +1,60 @@
+import asyncio
+import struct
+
+import pytest
+
+import main
+from main import MessageHandler
+
+
+@pytest.fixture
+def photo(tmp_path):
+    path = tmp_path / 'photo.png'
+    path.write_bytes(b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', 640, 480) + bytes(64))
+    return str(path)
+
+
+@pytest.fixture
+def api(monkeypatch):
+    """Подменяет запросы к Bot API ответами из списка и записывает вызванные методы"""
+    calls = []
+    responses = []
+
+    async def request(token, method, payload=None, form=None):
+        calls.append(method)
+        return responses.pop(0)
+
+    async def sleep(delay):
+        calls.append(f'sleep {delay}')
+
+    monkeypatch.setattr(main.telegram_client, 'request', request)
+    monkeypatch.setattr(main.asyncio, 'sleep', sleep)
+    return calls, responses
+
+
+def send(path: str):
+    return asyncio.run(MessageHandler.post_telegram_message('token', '-1001', 'text', files=[path]))
+
+
+def test_rate_limited_upload_is_retried(photo, api):
+    calls, responses = api
+    responses.extend([
+        (429, {'ok': False, 'parameters': {'retry_after': 3}}),
+        (200, {'ok': True, 'result': {'message_id': 7}}),
+    ])
+    assert send(photo) == {'message_id': 7}
+    assert calls == ['sendPhoto', 'sleep 3', 'sendPhoto']
+
+
+def test_rejected_photo_is_resent_as_document(photo, api, monkeypatch):
+    monkeypatch.setattr(main, 'media_classifier', main.MediaClassifier())
+    calls, responses = api
+    responses.extend([
+        (400, {'ok': False, 'description': 'Bad Request: PHOTO_INVALID_DIMENSIONS'}),
+        (200, {'ok': True, 'result': {'message_id': 7}}),
+        (200, {'ok': True, 'result': {'message_id': 8}}),
+    ])
+    assert send(photo) == {'message_id': 7}
+    # Решение запомнено: то же содержимое сразу уходит документом
+    assert send(photo) == {'message_id': 8}
+    assert calls == ['sendPhoto', 'sendDocument', 'sendDocument']